@@ -4,10 +4,10 @@ import ast
 import time
 import os
 import csv
-from Proxy.IPProxy import getIPProxies
+from Proxy.IPProxy import default_pool
 import traceback
 
-def manification(js_code, compilation_level, output_info):
+def manification(js_code, compilation_level, output_info, attempts=None):
     # TODO Using Proxies to Reduce Server Decline Rate
     params = {
         'js_code': js_code,
@@ -19,17 +19,26 @@ def manification(js_code, compilation_level, output_info):
     code_url: location of the JS script
     compilation_level: WHITESPACE_ONLY, SIMPLE_OPTIMIZATIONS, ADVANCED_OPTIMIZATIONS
     output_info:compiled_code, warnings,errors, statistics
+    attempts: requests tried before giving up, None tries forever
     '''
     # Using POST method to process js file
     succeed_flag = 0  # Check if compiling succeed
     headers = {"Content=type": "application/x-www-form-urlencode"}
+    pool = default_pool()  # the proxy list is fetched once and refreshed in the background
     while(succeed_flag == 0):
+        if attempts is not None:
+            if attempts <= 0:
+                return 1, 'Closure Compiler unreachable'
+            attempts -= 1
+        proxy = pool.proxies()
+        start = time.time()
         try:
-            proxy = getIPProxies()
-            print(proxy)
             conn = requests.post('https://closure-compiler.appspot.com/compile', proxies=proxy, data=params, headers=headers)
+            pool.report(proxy, conn.status_code < 500, time.time() - start)
             succeed_flag = 1
         except Exception as e:
+            # a failing proxy is scored down and, after a few failures, quarantined
+            pool.report(proxy, False)
             print(str(e))
     # Do not change header
     result = ast.literal_eval(conn.text)  # Using ast lib to convert str to dict
@@ -1,92 +1,175 @@
-import re
-import requests
-from bs4 import BeautifulSoup
 import hashlib
+import json
 import os
+import threading
 import time
-# from JSMinimizing.CCJS import *
-from JSMinimizing.JSMinifyer import *
 import traceback
-from Proxy.IPProxy import getIPProxies
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin
+
+import requests
+from bs4 import BeautifulSoup
+
+from JSMinimizing.minifiers import default_pool
+
+#  <script type=...> holding JavaScript, anything else (json, templates) is left alone
+JS_TYPES = ('', 'text/javascript', 'application/javascript', 'application/x-javascript', 'text/ecmascript',
+            'application/ecmascript', 'module')
+
+#  requests.Session is not thread safe: each thread, site or download worker, keeps its own
+_local = threading.local()
+
+
+def session():
+    '''
+    :return: the requests.Session of the calling thread, its connections are kept alive as long as the thread lives
+    '''
+    current = getattr(_local, 'session', None)
+    if current is None:
+        current = _local.session = requests.Session()
+    return current
 
 
 class SiteSrcFiles:
-    #  Minimize JS Files and then write them over the original JS script
+    #  Minimize the JS of a page and write the page with the minimized scripts
     '''
-    html_files:where html cache is stored
     url:site url
     header:user header
-    compile_level : see CC
+    pool: JSMinimizing.minifiers.MinifierPool, shared by the pages so a script seen on any page is minified once
+    cache_dir: where the pages are written, the external scripts go to cache_dir/js
+    fetch_workers: external scripts downloaded at the same time
+    save_original: also write the page as downloaded
     '''
 
-    def __init__(self, url, header):
+    def __init__(self, url, header, pool=None, cache_dir=None, fetch_workers=8, timeout=30,
+                 save_original=False):
         self.url = url
         self.header = header
         self.compile_level = 'SIMPLE_OPTIMIZATIONS'
+        self.pool = pool or default_pool()
+        self.cache_dir = cache_dir or os.path.abspath('Cache')
+        self.fetch_workers = fetch_workers
+        self.timeout = timeout
+        self.save_original = save_original
+
+    @staticmethod
+    def is_javascript(script):
+        return (script.get('type') or '').strip().lower() in JS_TYPES
+
+    def collect_scripts(self, page):
+        '''
+        :return: [(script tag, absolute src url or None for an inline script)] in document order
+        '''
+        scripts = []
+        for script in page.find_all('script'):
+            if not self.is_javascript(script):
+                continue
+            src = script.get('src')
+            if src:
+                scripts.append((script, urljoin(self.url, src.strip())))
+            elif script.string and script.string.strip():
+                scripts.append((script, None))
+        return scripts
+
+    def fetch(self, url):
+        '''
+        :return: (text, seconds, error)
+        '''
+        start = time.time()
+        try:
+            response = session().get(url, headers=self.header, timeout=self.timeout)
+        except requests.RequestException as e:
+            return None, time.time() - start, str(e)
+        if response.status_code != 200:
+            return None, time.time() - start, 'HTTP %d' % response.status_code
+        return response.text, time.time() - start, None
+
+    def write(self, name, text):
+        path = os.path.join(self.cache_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        return path
 
     def getjsmodified(self):
+        '''
+        Download the page and its external scripts, minify every script concurrently, write the page once
+        :return: report dict, per script and for the page; None if the page could not be downloaded
+        '''
+        page_start = time.time()
         try:
-            response = requests.get(self.url, self.header)
-            if (response.status_code != 200):
-                print('Error Occured with return code ' +
-                      str(response.status_code))
-            else:
-                jsfile_counter = 1
-                hashed_cache = (hashlib.sha256(bytes(self.url, encoding='utf-8'))).hexdigest()
-                sortedHTML = BeautifulSoup(response.text, "html.parser")
-                file = open(os.path.abspath('Cache') + '\\' + hashed_cache + 'Uncompressed' + '.html',
-                            'w', encoding='utf-8')  # Using SHA256
-                file.write(str(sortedHTML))
-                file.close()
-                jsfile_list1 = sortedHTML.find_all('script',{'type':'text/javascript'})
-                jsfile_list2 = sortedHTML.find_all('script',{'type':''})
-                jsfile_num = len(jsfile_list1) + len(jsfile_list2)
-                print("The Page You Requested Contains {} JavaScript Files".format(jsfile_num))
-                for script in jsfile_list1:
-                    # create a new script tag with modified script
-                    mod_script_tag = sortedHTML.new_tag('script')
-                    # add modified script to this new tag (THIS WILL REMOVE <script tpye='text/javascript> TYPE!)
-                    compile_start = time.time()
-                    compiled_result = manification(script.text, self.compile_level, 'compiled_code') #JS Miniyer
-                    mod_script_tag.string = compiled_result
-                    script.replace_with(mod_script_tag)
-                    # err_check, compiled_result = manification(script.text, self.compile_level, 'compiled_code') #CC
-                    compiled_end = time.time()
-                    time_cost1 = compiled_end - compile_start
-                    print("js_file NO.{} compiling finished, time cost:{}".format(jsfile_counter, time_cost1))
-                    jsfile_counter += 1
-                for script in jsfile_list2:
-                    # create a new script tag with modified script
-                    mod_script_tag = sortedHTML.new_tag('script')
-                    # add modified script to this new tag (THIS WILL REMOVE <script tpye='text/javascript> TYPE!)
-                    compile_start = time.time()
-                    compiled_result = manification(script.text, self.compile_level, 'compiled_code')  # JS Miniyer
-                    mod_script_tag.string = compiled_result
-                    script.replace_with(mod_script_tag)
-                    # err_check, compiled_result = manification(script.text, self.compile_level, 'compiled_code') #CC
-                    compiled_end = time.time()
-                    time_cost2 = compiled_end - compile_start
-                    print("js_file NO.{} compiling finished, time cost:{}".format(jsfile_counter, time_cost2))
-                    jsfile_counter += 1
-                    '''
-                    if (err_check):
-                        print("JS file No.{} ".format(jsfile_counter) + "Compiling Failed with ERROR CODE:"
-                              + str(compiled_result["code"]) + " " + compiled_result["error"])
-                        jsfile_counter += 1
-                        print("Will Try again with Proxy ON")
-
-                    else:
-                        print("JS file No.{} ".format(jsfile_counter) + "Compiling Succeeded!" +
-                              "Time Usage:" + str(int(time_cost)) + "s")
-                        mod_script_tag.string = compiled_result
-                        # Replace the original script with the minimized one
-                        script.replace_with(mod_script_tag)
-                        jsfile_counter += 1
-                    '''
-                # file = open(os.path.abspath('JSMinimizing') + '\\jsfile.js', 'w', encoding='utf-8')
-                file = open(os.path.abspath('Cache') + '\\' + hashed_cache + '.html',
-                            'w', encoding='utf-8')  # Using SHA256
-                file.write(str(sortedHTML))
-                file.close()
-        except Exception as e:
+            text, fetch_seconds, error = self.fetch(self.url)
+            if error:
+                print('Error Occured with ' + error)
+                return None
+            hashed_cache = (hashlib.sha256(bytes(self.url, encoding='utf-8'))).hexdigest()
+            sortedHTML = BeautifulSoup(text, "html.parser")
+            if self.save_original:
+                self.write(hashed_cache + 'Uncompressed.html', str(sortedHTML))
+            scripts = self.collect_scripts(sortedHTML)
+            print("The Page You Requested Contains {} JavaScript Files".format(len(scripts)))
+
+            #  inline scripts go to the minifier first, while the external ones download in parallel,
+            #  each handed to the minifier as soon as it is there
+            inline = [self.pool.submit(str(script.string)) for script, src in scripts if src is None]
+            externals = sorted(set(src for _, src in scripts if src))
+            fetched = {}
+            futures = {}
+            with ThreadPoolExecutor(max_workers=max(1, min(self.fetch_workers, len(externals)))) as fetcher:
+                downloads = dict((fetcher.submit(self.fetch, src), src) for src in externals)
+                for download in as_completed(downloads):
+                    src = downloads[download]
+                    result = fetched[src] = download.result()
+                    if result[0] is not None:
+                        futures[src] = self.pool.submit(result[0])
+
+            report = []
+            inline = iter(inline)
+            for number, (script, src) in enumerate(scripts, 1):
+                entry = {'no': number, 'src': src}
+                if src is None:
+                    result = next(inline).result()
+                    script.string = result.code
+                else:
+                    code, seconds, error = fetched[src]
+                    entry['fetch_seconds'] = round(seconds, 4)
+                    if error:
+                        #  left pointing at the original
+                        entry['error'] = error
+                        report.append(entry)
+                        continue
+                    result = futures[src].result()
+                    digest = hashlib.sha256(result.code.encode('utf-8', 'surrogatepass')).hexdigest()
+                    self.write(os.path.join('js', digest + '.js'), result.code)
+                    script['src'] = 'js/' + digest + '.js'
+                    #  the hash of the original no longer matches, and the copy is not cross-origin
+                    for attr in ('integrity', 'crossorigin'):
+                        if script.has_attr(attr):
+                            del script[attr]
+                entry.update({'original_size': result.original_size, 'size': result.size,
+                              'minify_seconds': round(result.seconds, 4), 'cached': result.cached})
+                if result.error:
+                    entry['error'] = result.error
+                report.append(entry)
+
+            html_path = self.write(hashed_cache + '.html', str(sortedHTML))
+            minified = [entry for entry in report if 'size' in entry]
+            summary = {
+                'url': self.url,
+                'html': html_path,
+                'scripts': len(scripts),
+                'inline': sum(1 for _, src in scripts if src is None),
+                'external': len(externals),
+                'errors': sum(1 for entry in report if 'error' in entry),
+                'cached': sum(1 for entry in minified if entry['cached']),
+                'original_size': sum(entry['original_size'] for entry in minified),
+                'size': sum(entry['size'] for entry in minified),
+                'page_fetch_seconds': round(fetch_seconds, 4),
+                'seconds': round(time.time() - page_start, 4),
+                'files': report,
+            }
+            self.write(hashed_cache + '.json', json.dumps(summary, indent=1))
+            return summary
+        except Exception:
             traceback.print_exc()
+            return None
@@ -0,0 +1,583 @@
+#!usr/bin/python3.6
+# -*- coding: utf-8 -*-
+"""
+Pluggable JavaScript minifier backends, run on a worker pool behind a content-hash cache.
+
+manification() used to POST every script to javascript-minifier.com (and CCJS
+to closure-compiler.appspot.com through a random proxy), retrying forever, one
+script after the other: seconds per script and nothing at all offline. Here
+ - a backend is an object with minify(js) -> str raising MinifyError:
+   LocalMinifier (pure Python, always there), RJSMinMinifier (when rjsmin is
+   installed), UglifyJSMinifier (node + lib/UglifyJS or an uglifyjs on the PATH),
+   and the two web services as ClosureMinifier / WebMinifier
+ - MinifierPool runs a backend on worker processes (local, cpu bound backends)
+   or threads (subprocess and web backends); a script the backend fails on is
+   passed on unchanged
+ - ResultCache keeps results by sha256 of (backend, source), in memory and
+   optionally in a directory, so a script seen before costs one hash
+
+    pool = MinifierPool(get_backend('auto'), cache=ResultCache(directory='Cache/js'))
+    futures = [pool.submit(js) for js in scripts]
+    codes = [f.result().code for f in futures]
+"""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UGLIFYJS = os.path.join(ROOT, 'lib', 'UglifyJS', 'bin', 'uglifyjs')
+
+
+class MinifyError(Exception):
+    pass
+
+
+#  the pure Python minifier
+_WS = re.compile(r'\s+')
+_WORD = re.compile(r'[\w$\\]+')
+_LINE_COMMENT = re.compile('//[^\r\n\u2028\u2029]*')
+_DIGITS = re.compile(r'^\d+$')
+_STRINGS = {"'": re.compile(r"'(?:[^'\\\r\n]|\\.)*'", re.S), '"': re.compile(r'"(?:[^"\\\r\n]|\\.)*"', re.S)}
+_LINE_TERMINATORS = ('\n', '\r', '\u2028', '\u2029')
+#  keywords after which a / starts a regular expression, not a division
+_REGEX_KEYWORDS = frozenset(('return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case',
+                             'do', 'else', 'yield', 'await'))
+#  a line break between these two is kept, automatic semicolon insertion may depend on it
+_NL_BEFORE = frozenset(')]}\'"`+-/')
+_NL_AFTER = frozenset('([{\'"`+-!~/#*')
+
+
+def _is_word(c):
+    return c.isalnum() or c in '_$\\' or ord(c) > 127
+
+
+def _template(js, i):
+    """
+    :param i: index just after the ` or the } closing a ${...}
+    :return: (index after the literal part, True if it stopped at a ${)
+    """
+    n = len(js)
+    while i < n:
+        c = js[i]
+        if c == '\\':
+            i += 2
+        elif c == '`':
+            return i + 1, False
+        elif c == '$' and js.startswith('${', i):
+            return i + 2, True
+        else:
+            i += 1
+    raise MinifyError('unterminated template literal')
+
+
+def _regex(js, i):
+    """
+    :param i: index of the opening /
+    :return: index after the flags, None if this is no regular expression literal
+    """
+    n = len(js)
+    j = i + 1
+    in_class = False
+    while j < n:
+        c = js[j]
+        if c == '\\':
+            j += 2
+            continue
+        if c in _LINE_TERMINATORS:
+            return None
+        if c == '[':
+            in_class = True
+        elif c == ']':
+            in_class = False
+        elif c == '/' and not in_class:
+            flags = _WORD.match(js, j + 1)
+            return flags.end() if flags else j + 1
+        j += 1
+    return None
+
+
+def minify(js):
+    """
+    Drop comments and whitespace, keeping strings, templates, regular expressions
+    and the line breaks semicolon insertion depends on. /*! comments are kept.
+    :return: minified source
+    """
+    out = []
+    last = ''  # last character written
+    last_token = ''  # last token written
+    regex_ok = True
+    space = newline = False  # whitespace or a comment since the last token
+    braces = []  # '{' for a block, '`' for the ${ of a template
+    i, n = 0, len(js)
+
+    while i < n:
+        c = js[i]
+        #  whitespace and comments
+        if c.isspace():
+            end = _WS.match(js, i).end()
+            space = True
+            newline = newline or any(t in js[i:end] for t in _LINE_TERMINATORS)
+            i = end
+            continue
+        if c == '/' and js.startswith('//', i):
+            i = _LINE_COMMENT.match(js, i).end()
+            space = True
+            continue
+        if c == '/' and js.startswith('/*', i):
+            end = js.find('*/', i + 2)
+            if end < 0:
+                raise MinifyError('unterminated comment')
+            comment = js[i:end + 2]
+            i = end + 2
+            if comment.startswith('/*!'):
+                #  license comment
+                out.append(('\n' if out else '') + comment + '\n')
+                last, last_token = '\n', ''
+                space = newline = False
+                continue
+            space = True
+            newline = newline or any(t in comment for t in _LINE_TERMINATORS)
+            continue
+
+        #  the next token
+        regex_next = None  # set when the token decides it on its own
+        if c in _STRINGS:
+            match = _STRINGS[c].match(js, i)
+            if match is None:
+                raise MinifyError('unterminated string at %d' % i)
+            end = match.end()
+        elif c == '`':
+            end, interpolation = _template(js, i + 1)
+            if interpolation:
+                braces.append('`')
+            regex_next = interpolation
+        elif c == '}' and braces and braces[-1] == '`':
+            braces.pop()
+            end, interpolation = _template(js, i + 1)
+            if interpolation:
+                braces.append('`')
+            regex_next = interpolation
+        elif _is_word(c):
+            end = _WORD.match(js, i).end()
+            if end == i:
+                end = i + 1
+        elif c == '/' and regex_ok:
+            end = _regex(js, i)
+            if end is None:
+                end = i + 1
+                regex_next = True
+        else:
+            end = i + 1
+            if c == '{':
+                braces.append('{')
+            elif c == '}' and braces:
+                braces.pop()
+        token = js[i:end]
+        first = token[0]
+
+        if (space or newline) and out:
+            if newline and (_is_word(last) or last in _NL_BEFORE) and (_is_word(first) or first in _NL_AFTER):
+                out.append('\n')
+            elif (_is_word(last) and _is_word(first)) or (last == first and last in '+-') or \
+                    (last == '/' and first in '/*') or (first == '.' and _DIGITS.match(last_token)):
+                out.append(' ')
+        out.append(token)
+        space = newline = False
+
+        #  may the next / start a regular expression?
+        if regex_next is not None:
+            regex_ok = regex_next
+        elif _is_word(first) and not first.isdigit():
+            regex_ok = token in _REGEX_KEYWORDS
+        elif first in '\'"`' or first.isdigit() or (first == '/' and len(token) > 1):
+            regex_ok = False
+        elif first in ')]':
+            regex_ok = False
+        elif first in '+-' and last == first:
+            #  a++ / b
+            regex_ok = False
+        else:
+            regex_ok = True
+        last, last_token = token[-1], token
+        i = end
+    return ''.join(out).strip()
+
+
+#  backends
+class Minifier(object):
+    """
+    Backend interface: minify(js) returns the minified source or raises MinifyError
+    """
+    name = 'identity'
+    #  minify() burns cpu in this process: a MinifierPool runs it on worker processes
+    cpu_bound = False
+
+    def key(self):
+        """
+        :return: what, besides the source, the output depends on; part of the cache key
+        """
+        return self.name
+
+    def available(self):
+        return True
+
+    def minify(self, js):
+        return js
+
+
+class LocalMinifier(Minifier):
+    name = 'local'
+    cpu_bound = True
+
+    def minify(self, js):
+        return minify(js)
+
+
+class RJSMinMinifier(Minifier):
+    name = 'rjsmin'
+    cpu_bound = True
+
+    def __init__(self, keep_bang_comments=True):
+        self.keep_bang_comments = keep_bang_comments
+
+    def key(self):
+        return '%s:%s' % (self.name, self.keep_bang_comments)
+
+    def available(self):
+        return rjsmin is not None
+
+    def minify(self, js):
+        if rjsmin is None:
+            raise MinifyError('rjsmin is not installed')
+        return rjsmin.jsmin(js, keep_bang_comments=self.keep_bang_comments)
+
+
+class UglifyJSMinifier(Minifier):
+    name = 'uglifyjs'
+
+    def __init__(self, path=None, node='node', options=('--compress', '--mangle'), timeout=60):
+        """
+        :param path: uglifyjs script, default lib/UglifyJS/bin/uglifyjs, else uglifyjs on the PATH
+        :param options: command line options of uglifyjs
+        :param timeout: seconds one script may take
+        """
+        self.path = path or (UGLIFYJS if os.path.exists(UGLIFYJS) else shutil.which('uglifyjs'))
+        self.node = node
+        self.options = tuple(options)
+        self.timeout = timeout
+
+    def key(self):
+        return '%s:%s' % (self.name, ' '.join(self.options))
+
+    def command(self):
+        if self.path and self.path.startswith(os.path.join(ROOT, 'lib')):
+            #  the checked out copy may not be executable
+            return [self.node, self.path] + list(self.options)
+        return [self.path] + list(self.options)
+
+    def available(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        return not self.command()[0] == self.node or shutil.which(self.node) is not None
+
+    def minify(self, js):
+        if not self.available():
+            raise MinifyError('uglifyjs is not installed')
+        try:
+            done = subprocess.run(self.command(), input=js.encode('utf-8'), stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise MinifyError(str(e))
+        if done.returncode != 0:
+            raise MinifyError(done.stderr.decode('utf-8', 'replace').strip())
+        return done.stdout.decode('utf-8')
+
+
+class ClosureMinifier(Minifier):
+    """
+    closure-compiler.appspot.com, through the proxies of Proxy.IPProxy
+    """
+    name = 'closure'
+
+    def __init__(self, compilation_level='SIMPLE_OPTIMIZATIONS', attempts=5):
+        self.compilation_level = compilation_level
+        self.attempts = attempts
+
+    def key(self):
+        return '%s:%s' % (self.name, self.compilation_level)
+
+    def minify(self, js):
+        from JSMinimizing.CCJS import manification
+        err_flag, result = manification(js, self.compilation_level, 'compiled_code', attempts=self.attempts)
+        if err_flag:
+            raise MinifyError(str(result))
+        return result
+
+
+class WebMinifier(Minifier):
+    """
+    javascript-minifier.com, what manification() used to call
+    """
+    name = 'javascript-minifier'
+    url = 'https://javascript-minifier.com/raw'
+
+    def __init__(self, attempts=3, timeout=30):
+        self.attempts = attempts
+        self.timeout = timeout
+
+    def minify(self, js):
+        error = None
+        for _ in range(self.attempts):
+            try:
+                conn = requests.post(self.url, data=dict(input=js), timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+                continue
+            if conn.status_code == 200:
+                return conn.text
+            error = 'HTTP %d' % conn.status_code
+        raise MinifyError(str(error))
+
+
+BACKENDS = OrderedDict((cls.name, cls) for cls in (UglifyJSMinifier, RJSMinMinifier, LocalMinifier, ClosureMinifier,
+                                                   WebMinifier, Minifier))
+
+
+def get_backend(name='auto', **options):
+    """
+    :param name: a name of BACKENDS, or 'auto': the first local backend available, uglifyjs, rjsmin, local
+    :param options: passed to the backend class
+    """
+    if name == 'auto':
+        for cls in (UglifyJSMinifier, RJSMinMinifier):
+            backend = cls()
+            if backend.available():
+                return backend
+        return LocalMinifier()
+    try:
+        return BACKENDS[name](**options)
+    except KeyError:
+        raise ValueError('Unknown minifier backend: %s' % name)
+
+
+#  cache and pool
+MinifyResult = namedtuple('MinifyResult', 'code original_size size seconds cached error')
+
+
+class ResultCache(object):
+    """
+    Minified sources by sha256 of (backend key, source)
+    """
+
+    def __init__(self, max_entries=4096, directory=None):
+        """
+        :param max_entries: results kept in memory, least recently used are dropped first
+        :param directory: where results are also written, so they survive the process
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stored': 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(backend_key, source):
+        digest = hashlib.sha256(backend_key.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(source.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.js')
+
+    def get(self, key):
+        with self._lock:
+            code = self._entries.get(key)
+            if code is not None:
+                self._entries.move_to_end(key)
+                self._counts['hits'] += 1
+                return code
+        if self.directory:
+            try:
+                with open(self._path(key), encoding='utf-8') as f:
+                    code = f.read()
+            except OSError:
+                code = None
+            if code is not None:
+                self._remember(key, code)
+                with self._lock:
+                    self._counts['disk_hits'] += 1
+                return code
+        with self._lock:
+            self._counts['misses'] += 1
+        return None
+
+    def put(self, key, code):
+        self._remember(key, code)
+        with self._lock:
+            self._counts['stored'] += 1
+        if self.directory:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            #  written aside and renamed: a reader never sees half a file
+            temp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+            with open(temp, 'w', encoding='utf-8') as f:
+                f.write(code)
+            os.replace(temp, path)
+
+    def _remember(self, key, code):
+        with self._lock:
+            self._entries[key] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['entries'] = len(self._entries)
+        return stats
+
+
+def _run(backend, js):
+    """
+    One script on a worker
+    :return: (code, seconds, error message or None)
+    """
+    start = time.time()
+    try:
+        code = backend.minify(js)
+    except MinifyError as e:
+        return None, time.time() - start, str(e) or e.__class__.__name__
+    return code, time.time() - start, None
+
+
+class MinifierPool(object):
+    def __init__(self, backend=None, workers=None, cache=None):
+        """
+        :param backend: a Minifier, default get_backend('auto')
+        :param workers: worker processes for a cpu bound backend, threads otherwise; default the cpu count
+        :param cache: ResultCache, default an in-memory one
+        """
+        self.backend = backend or get_backend('auto')
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache if cache is not None else ResultCache()
+        self._backend_key = self.backend.key()
+        self._executor = None
+        self._inflight = {}  # cache key -> Future, the same script submitted twice is minified once
+        self._lock = threading.Lock()
+        self._counts = {'submitted': 0, 'minified': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+    def _get_executor(self):
+        # with self._lock held
+        if self._executor is None:
+            if self.backend.cpu_bound and self.workers > 1:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def submit(self, js):
+        """
+        :return: Future of a MinifyResult; code is the source itself when the backend failed on it
+        """
+        key = self.cache.key(self._backend_key, js)
+        code = self.cache.get(key)
+        if code is not None:
+            done = Future()
+            done.set_result(MinifyResult(code, len(js), len(code), 0.0, True, None))
+            return done
+        with self._lock:
+            self._counts['submitted'] += 1
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._inflight[key] = future
+            work = self._get_executor().submit(_run, self.backend, js)
+        work.add_done_callback(lambda work: self._finished(key, js, work, future))
+        return future
+
+    def _finished(self, key, js, work, future):
+        try:
+            code, seconds, error = work.result()
+        except Exception as e:
+            #  a worker died, or the backend raised something else than MinifyError
+            code, seconds, error = None, 0.0, repr(e)
+        if error is None:
+            self.cache.put(key, code)
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._counts['seconds'] += seconds
+            self._counts['bytes_in'] += len(js)
+            if error is None:
+                self._counts['minified'] += 1
+                self._counts['bytes_out'] += len(code)
+            else:
+                self._counts['errors'] += 1
+                self._counts['bytes_out'] += len(js)
+        if error is None:
+            future.set_result(MinifyResult(code, len(js), len(code), seconds, False, None))
+        else:
+            future.set_result(MinifyResult(js, len(js), len(js), seconds, False, error))
+
+    def minify(self, js):
+        """
+        :return: MinifyResult, blocking
+        """
+        return self.submit(js).result()
+
+    def map(self, sources):
+        """
+        :return: [MinifyResult] in the order of sources, minified concurrently
+        """
+        return [future.result() for future in [self.submit(js) for js in sources]]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats['backend'] = self._backend_key
+        stats['cache'] = self.cache.stats()
+        return stats
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_pool(backend=None, **options):
+    """
+    :param backend: Minifier or backend name, replaces the backend of the shared pool
+    :return: MinifierPool shared by the process
+    """
+    global _pool
+    if isinstance(backend, str):
+        backend = get_backend(backend)
+    with _pool_lock:
+        if _pool is None or backend is not None:
+            old, _pool = _pool, MinifierPool(backend, **options)
+            if old is not None:
+                _pool.cache = old.cache
+                old.close()
+        return _pool
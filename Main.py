@@ -1,5 +1,9 @@
 # from JSMinimizing.CCJS import manification, evaluate
 from JSMinimizing.getSrc import *
+from JSMinimizing.minifiers import MinifierPool, ResultCache, get_backend
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
 import pagemodifier
 import time
 if __name__ == '__main__':
@@ -86,17 +90,32 @@ if __name__ == '__main__':
         'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.100 Safari/537.36'
     }
     # header is something needed to be modified if deployed
-    i = 1
     custom_site = ['https://www.taobao.com','https://www.facebook.com',
                    'https://www.youtube.com','https://www.weibo.com','https://www.twitter.com',
                    'https://www.imdb.com','https://www.bilibili.com','https://www.niconicovideo.jp']
     failed_site = ['https://www.amazon.co.jp']
-    for site in failed_site:
-        mod_files = SiteSrcFiles(site, header)
-        start_time = time.time()
+    # One minifier pool and one on-disk result cache for every site: a script (jQuery, analytics...)
+    # seen on any page, in this run or an earlier one, is minified once
+    pool = MinifierPool(get_backend('auto'), cache=ResultCache(directory=os.path.join('Cache', 'minified')))
+    site_workers = 8  # pages processed at the same time
+
+    def process(numbered_site):
+        i, site = numbered_site
         print("Processing No.{}".format(i))
-        mod_files = SiteSrcFiles(site, header)
-        mod_files.getjsmodified()
-        end_time = time.time()
-        print("Time Cost for No.{}:{}".format(i, end_time - start_time))
-        i += 1
+        mod_files = SiteSrcFiles(site, header, pool=pool)
+        report = mod_files.getjsmodified()
+        if report is not None:
+            print("Time Cost for No.{}:{}".format(i, report['seconds']))
+        return site, report
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=site_workers) as sites:
+        reports = list(sites.map(process, enumerate(test_sites, 1)))
+    end_time = time.time()
+    # Structured output, one line per site
+    with open(os.path.join('Cache', 'report.jsonl'), 'w', encoding='utf-8') as out:
+        for site, report in reports:
+            out.write(json.dumps(report or {'url': site, 'failed': True}) + '\n')
+    print("Total Time Cost:{}".format(end_time - start_time))
+    print(json.dumps(pool.stats()))
+    pool.close()
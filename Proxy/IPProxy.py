@@ -1,20 +1,269 @@
 #! /usr/bin/env python
 # -*- coding utf-8 -*-
 # 使用ProxyPool获取了足够的IP地址
-import requests as rq
-import random
+"""
+Local manager of the upstream proxies handed out by ProxyPool.
+
+getIPProxies() used to download and literal_eval the whole list from the
+ProxyPool server on every call, and CCJS called it in a retry loop for every JS
+file. IPProxyPool fetches the list once, refreshes it on a background thread
+and keeps per-proxy statistics:
+ - latency (moving average) and success / failure counts, fed back with report()
+ - choose() picks a proxy at random, weighted by success rate over latency
+ - a proxy failing several times in a row is quarantined, for longer each time
+
+Where the list comes from is pluggable: HTTPSource (the ProxyPool server),
+FileSource (a local file) or any callable returning a list of "host:port".
+
+    pool = IPProxyPool(FileSource('proxies.txt'))
+    proxy = pool.choose()
+    ...
+    pool.report(proxy, ok=True, latency=0.8)
+"""
 import ast
+import json
+import os
+import random
+import threading
+import time
 
+import requests as rq
 
-def getIPProxies():
-    url = 'http://47.104.17.141:5010/get_all'  # Proxy IP Server
-    IPAddr = rq.get(url).text
-    IPAddr = ast.literal_eval(IPAddr)  # String to List Conversion
-    # print(type(IPAddr))
-    max = len(IPAddr)
-    item = random.randint(0, max - 1)
-    proxies = {
-        "https": "https://{}" .format(IPAddr[item])
-    }
-    print("Using Proxy at {}".format(proxies))  # Will be Removed!
+PROXYPOOL_URL = os.environ.get('PROXYPOOL_URL', 'http://47.104.17.141:5010/get_all')  # Proxy IP Server
+
+
+def parse_proxy_list(text):
+    """
+    :return: ["host:port"] from a json / python literal list, of strings or of {"proxy": ...}, or one per line
+    """
+    text = text.strip()
+    try:
+        items = json.loads(text)
+    except ValueError:
+        try:
+            items = ast.literal_eval(text)  # String to List Conversion
+        except (ValueError, SyntaxError):
+            items = [line for line in text.splitlines() if line.strip() and not line.startswith('#')]
+    proxies = []
+    for item in items:
+        if isinstance(item, dict):
+            item = item.get('proxy', '')
+        item = str(item).strip()
+        if item:
+            proxies.append(item)
     return proxies
+
+
+class HTTPSource(object):
+    def __init__(self, url=PROXYPOOL_URL, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self):
+        return parse_proxy_list(rq.get(self.url, timeout=self.timeout).text)
+
+
+class FileSource(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        with open(self.path, encoding='utf-8') as f:
+            return parse_proxy_list(f.read())
+
+
+class ProxyStats(object):
+    __slots__ = ('address', 'latency', 'successes', 'failures', 'streak', 'quarantined_until')
+
+    def __init__(self, address):
+        self.address = address
+        self.latency = None  # seconds, moving average
+        self.successes = 0
+        self.failures = 0
+        self.streak = 0  # failures in a row
+        self.quarantined_until = 0.0
+
+    def score(self, default_latency):
+        # Laplace-smoothed success rate per second of latency
+        rate = (self.successes + 1.0) / (self.successes + self.failures + 2.0)
+        return rate / max(self.latency or default_latency, 0.05)
+
+    def as_dict(self, now):
+        return {'latency': self.latency, 'successes': self.successes, 'failures': self.failures,
+                'quarantined': max(0.0, self.quarantined_until - now)}
+
+
+class IPProxyPool(object):
+    def __init__(self, source=None, refresh_interval=300, quarantine=60, max_quarantine=3600, failures=3,
+                 alpha=0.3, scheme='https'):
+        """
+        :param source: callable returning ["host:port"], default HTTPSource()
+        :param refresh_interval: seconds between two fetches of the list, on a background thread
+        :param quarantine: seconds a proxy is left out after failures in a row, doubled on every new quarantine
+        :param failures: failures in a row that put a proxy in quarantine
+        :param alpha: weight of the newest sample in the latency average
+        :param scheme: key of the dict returned by proxies()
+        """
+        self.source = source or HTTPSource()
+        self.refresh_interval = refresh_interval
+        self.quarantine = quarantine
+        self.max_quarantine = max_quarantine
+        self.failures = failures
+        self.alpha = alpha
+        self.scheme = scheme
+        self._stats = {}  # address -> ProxyStats, only the addresses of the latest list
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    #  the list
+    def refresh(self):
+        """
+        Fetch the list, statistics of proxies still on it are kept
+        :return: number of proxies
+        """
+        addresses = self.source()
+        with self._lock:
+            old = self._stats
+            self._stats = dict((a, old.get(a) or ProxyStats(a)) for a in addresses)
+            self.refreshes += 1
+        return len(addresses)
+
+    def start(self):
+        """
+        First fetch (blocking) and the background refresher, done once
+        """
+        with self._lock:
+            first = self._thread is None
+            if first:
+                self._thread = threading.Thread(target=self._refresher, name='IPProxyPool')
+                self._thread.daemon = True
+        if not first:
+            #  another thread is doing the first fetch
+            self._loaded.wait()
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            self.refresh_errors += 1
+            print("Fetching the proxy list failed: %r" % e)
+        finally:
+            self._loaded.set()
+        self._thread.start()
+
+    def _refresher(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                #  keep serving the previous list
+                self.refresh_errors += 1
+                print("Refreshing the proxy list failed: %r" % e)
+
+    #  choosing
+    def choose(self):
+        """
+        :return: "host:port" picked by score, None if the list is empty
+        """
+        self.start()
+        now = time.time()
+        with self._lock:
+            stats = list(self._stats.values())
+            if not stats:
+                return None
+            healthy = [s for s in stats if s.quarantined_until <= now]
+            if not healthy:
+                #  everything quarantined: the one closest to parole
+                return min(stats, key=lambda s: s.quarantined_until).address
+            known = [s.latency for s in healthy if s.latency is not None]
+            #  proxies never tried are assumed as fast as the average, so they get tried
+            default_latency = sum(known) / len(known) if known else 1.0
+            weights = [s.score(default_latency) for s in healthy]
+        pick = random.random() * sum(weights)
+        for s, weight in zip(healthy, weights):
+            pick -= weight
+            if pick <= 0:
+                return s.address
+        return healthy[-1].address
+
+    def proxies(self):
+        """
+        :return: {scheme: "scheme://host:port"} for requests, {} if there is no proxy
+        """
+        address = self.choose()
+        if address is None:
+            return {}
+        return {self.scheme: "{}://{}".format(self.scheme, address)}
+
+    def report(self, proxy, ok, latency=None):
+        """
+        :param proxy: "host:port" or a dict returned by proxies()
+        """
+        if isinstance(proxy, dict):
+            proxy = next(iter(proxy.values()), '').split('://', 1)[-1]
+        with self._lock:
+            s = self._stats.get(proxy)
+            if s is None:
+                return
+            if ok:
+                s.successes += 1
+                s.streak = 0
+                if latency is not None:
+                    s.latency = latency if s.latency is None else self.alpha * latency + (1 - self.alpha) * s.latency
+                return
+            s.failures += 1
+            s.streak += 1
+            if s.streak >= self.failures:
+                rounds = s.streak - self.failures
+                s.quarantined_until = time.time() + min(self.max_quarantine, self.quarantine * 2 ** rounds)
+
+    def request(self, method, url, **kwargs):
+        """
+        requests.request through a chosen proxy, reported back to the pool
+        """
+        proxies = self.proxies()
+        start = time.time()
+        try:
+            response = rq.request(method, url, proxies=proxies, **kwargs)
+        except rq.RequestException:
+            self.report(proxies, False)
+            raise
+        self.report(proxies, response.status_code < 500, time.time() - start)
+        return response
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'proxies': dict((a, s.as_dict(now)) for a, s in self._stats.items()),
+                'quarantined': sum(1 for s in self._stats.values() if s.quarantined_until > now),
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_pool(source=None):
+    """
+    :param source: replaces the source of the shared pool (a local file or a stub server in tests)
+    :return: IPProxyPool shared by the process
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = IPProxyPool(source)
+        elif source is not None:
+            _pool.source = source
+            if _pool._loaded.is_set():
+                _pool.refresh()
+        return _pool
+
+
+def getIPProxies():
+    return default_pool().proxies()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Leaf certificates and ready-made SSLContexts for the intercepting proxy.
+
+connect_intercept used to fork two openssl processes under one global lock the
+first time a host was seen, and to build a new SSL context from the files on
+disk for every CONNECT. A burst of new hosts serialized every tunnel behind
+that lock, and a fresh context per connection also threw away the TLS session
+cache, so no client ever resumed a session.
+
+CertCache instead
+ - mints certificates in-process with pyOpenSSL when it is installed (falling
+   back to the openssl command line), holding a lock per hostname only
+ - signs with the shared cert.key, or with keys taken from a pool generated
+   in the background when there is no shared key
+ - keeps an LRU of SSLContexts by hostname: session ids and session tickets
+   issued by a context let repeat connections skip the full handshake
+ - records mint and handshake latencies, see stats()
+
+    certs = CertCache(cakey, cacert, certdir, certkey)
+    conn = certs.context(hostname).wrap_socket(conn, server_side=True)
+"""
+import os
+import random
+import re
+import socket
+import ssl
+import threading
+import time
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    from OpenSSL import crypto
+except ImportError:
+    crypto = None
+
+re_ip = re.compile(r'^[0-9.]+$|:')
+
+
+class Timings(object):
+    """
+    count / total / max of a latency, in milliseconds
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def snapshot(self):
+        return {'count': self.count, 'mean_ms': self.total / self.count if self.count else 0.0, 'max_ms': self.max}
+
+
+class KeyPool(object):
+    """
+    RSA keys generated ahead of time on a background thread
+    """
+
+    def __init__(self, size=4, bits=2048):
+        self.bits = bits
+        self._keys = Queue(size)
+        self._thread = threading.Thread(target=self._fill, name='KeyPool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def generate(self):
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, self.bits)
+        return key
+
+    def _fill(self):
+        while True:
+            self._keys.put(self.generate())
+
+    def get(self):
+        try:
+            return self._keys.get_nowait()
+        except Empty:
+            #  pool drained by a burst, do not wait for the background thread
+            return self.generate()
+
+
+class CertCache(object):
+    def __init__(self, cakey, cacert, certdir, certkey=None, max_contexts=512, key_pool=4, days=3650):
+        """
+        :param certkey: key shared by every leaf certificate, None takes keys from a KeyPool (needs pyOpenSSL)
+        :param max_contexts: SSLContexts kept, least recently used are dropped first
+        :param key_pool: keys generated ahead when there is no shared key
+        """
+        self.cakey = cakey
+        self.cacert = cacert
+        self.certdir = certdir.rstrip('/')
+        self.certkey = certkey if certkey and os.path.isfile(certkey) else None
+        self.max_contexts = max_contexts
+        self.days = days
+        if self.certkey is None and crypto is None:
+            raise RuntimeError('a shared certkey is required without pyOpenSSL')
+        self._keys = KeyPool(key_pool) if self.certkey is None else None
+        self._ca = None
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._counts = {'hits': 0, 'mints': 0, 'loads': 0, 'handshakes': 0, 'resumed': 0, 'handshake_errors': 0}
+        self._mint_time = Timings()
+        self._handshake_time = Timings()
+
+    def ca(self):
+        #  CA key and certificate parsed once
+        if self._ca is None:
+            with open(self.cakey, 'rb') as f:
+                key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+            with open(self.cacert, 'rb') as f:
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+            self._ca = key, cert
+        return self._ca
+
+    def _host_lock(self, hostname):
+        with self._lock:
+            lock = self._host_locks.get(hostname)
+            if lock is None:
+                lock = self._host_locks[hostname] = threading.Lock()
+            return lock
+
+    def paths(self, hostname):
+        """
+        :return: (certfile, keyfile) of hostname
+        """
+        certpath = "%s/%s.crt" % (self.certdir, hostname)
+        return certpath, self.certkey or "%s/%s.key" % (self.certdir, hostname)
+
+    def context(self, hostname):
+        """
+        :return: server side SSLContext presenting a certificate for hostname
+        """
+        with self._lock:
+            ctx = self._contexts.get(hostname)
+            if ctx is not None:
+                self._contexts.pop(hostname)
+                self._contexts[hostname] = ctx
+                self._counts['hits'] += 1
+                return ctx
+        with self._host_lock(hostname):
+            #  another thread may have built it while we waited
+            with self._lock:
+                ctx = self._contexts.get(hostname)
+            if ctx is not None:
+                return ctx
+            certpath, keypath = self.paths(hostname)
+            if os.path.isfile(certpath) and os.path.isfile(keypath):
+                self._count('loads')
+            else:
+                start = time.time()
+                self.mint(hostname, certpath, keypath)
+                with self._lock:
+                    self._mint_time.add(time.time() - start)
+                    self._counts['mints'] += 1
+            ctx = self.new_context(certpath, keypath)
+            with self._lock:
+                self._contexts[hostname] = ctx
+                while len(self._contexts) > self.max_contexts:
+                    self._contexts.popitem(last=False)
+            return ctx
+
+    def new_context(self, certpath, keypath):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ctx.options |= getattr(ssl, 'OP_NO_SSLv2', 0) | getattr(ssl, 'OP_NO_SSLv3', 0)
+        #  session tickets on: a returning client resumes without a full handshake
+        ctx.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+        ctx.load_cert_chain(certpath, keypath)
+        return ctx
+
+    def mint(self, hostname, certpath, keypath):
+        if crypto is None:
+            self._mint_openssl(hostname, certpath)
+            return
+        ca_key, ca_cert = self.ca()
+        if self.certkey:
+            with open(self.certkey, 'rb') as f:
+                key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+        else:
+            key = self._keys.get()
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.set_serial_number(self.serial_number())
+        cert.get_subject().CN = hostname[:64]
+        cert.gmtime_adj_notBefore(-24 * 3600)
+        cert.gmtime_adj_notAfter(self.days * 24 * 3600)
+        cert.set_issuer(ca_cert.get_subject())
+        san = ('IP:%s' if re_ip.search(hostname) else 'DNS:%s') % hostname
+        cert.add_extensions([crypto.X509Extension(b'subjectAltName', False, san.encode('ascii'))])
+        cert.set_pubkey(key)
+        cert.sign(ca_key, 'sha256')
+        if not self.certkey:
+            self._write(keypath, crypto.dump_privatekey(crypto.FILETYPE_PEM, key), 0o600)
+        self._write(certpath, crypto.dump_certificate(crypto.FILETYPE_PEM, cert), 0o644)
+
+    @staticmethod
+    def serial_number():
+        #  the millisecond alone repeats when two hosts are minted at once, and a browser rejects a
+        #  second certificate with the serial of one it has seen from the same issuer
+        return int(time.time() * 1000) * 1000 + random.randint(0, 999)
+
+    def _mint_openssl(self, hostname, certpath):
+        serial = "%d" % self.serial_number()
+        p1 = Popen(["openssl", "req", "-new", "-key", self.certkey, "-subj", "/CN=%s" % hostname], stdout=PIPE)
+        p2 = Popen(["openssl", "x509", "-req", "-days", str(self.days), "-CA", self.cacert, "-CAkey", self.cakey,
+                    "-set_serial", serial, "-out", certpath], stdin=p1.stdout, stderr=PIPE)
+        p1.stdout.close()
+        p2.communicate()
+
+    @staticmethod
+    def _write(path, data, mode):
+        #  write aside and rename, a concurrent reader never sees half a file
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def wrap(self, sock, hostname):
+        """
+        Server side TLS handshake on sock with the certificate of hostname, timed
+        :return: SSLSocket
+        """
+        ctx = self.context(hostname)
+        start = time.time()
+        try:
+            conn = ctx.wrap_socket(sock, server_side=True)
+        except (ssl.SSLError, socket.error):
+            self._count('handshake_errors')
+            raise
+        with self._lock:
+            self._handshake_time.add(time.time() - start)
+            self._counts['handshakes'] += 1
+            if getattr(conn, 'session_reused', False):
+                self._counts['resumed'] += 1
+        return conn
+
+    def _count(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['contexts'] = len(self._contexts)
+            stats['mint'] = self._mint_time.snapshot()
+            stats['handshake'] = self._handshake_time.snapshot()
+        return stats
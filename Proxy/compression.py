@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Content-Encoding towards the client, chosen independently of the origin.
+
+The proxy used to pass on whatever encoding the origin picked among
+identity/gzip/deflate, and re-gzipped modified bodies at the default level.
+Here
+ - negotiate() picks the best encoding the client accepts: brotli or zstd when
+   their modules are installed (both optional), then gzip, then deflate
+ - AdaptiveLevel picks the compression level from the load average and the
+   body size: strong compression while the cpus are idle, cheap compression
+   for big bodies or when the machine is busy
+ - VariantCache keeps static assets (css, js, svg, fonts, json with a
+   validator) compressed at the highest level, done in the background after
+   the first request, so repeat requests cost no compression at all
+
+    encoding = negotiate(client_accept_encoding)
+    enc = encoder(encoding, levels.level(encoding, size))
+"""
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from streaming import Encoder
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from multiprocessing import cpu_count
+except ImportError:
+    cpu_count = lambda: 1
+
+#  most preferred first, when the client gives two the same q-value
+PREFERENCE = ('br', 'zstd', 'gzip', 'deflate')
+#  levels used for precompressed variants, time does not matter there
+MAX_LEVELS = {'br': 11, 'zstd': 19, 'gzip': 9, 'deflate': 9}
+#  (idle, busy, overloaded) levels
+ADAPTIVE_LEVELS = {'br': (5, 4, 1), 'zstd': (6, 3, 1), 'gzip': (6, 4, 1), 'deflate': (6, 4, 1)}
+COMPRESSIBLE = re.compile(r'^(text/|application/(javascript|x-javascript|json|ld\+json|xml|xhtml\+xml|rss\+xml|'
+                          r'atom\+xml|manifest\+json|wasm)|image/(svg\+xml|x-icon|vnd\.microsoft\.icon)|font/(ttf|otf)|'
+                          r'application/(vnd\.ms-fontobject|x-font-ttf))', re.I)
+STATIC = re.compile(r'^(text/css|text/javascript|application/(x-)?javascript|application/json|image/svg\+xml|'
+                    r'font/|application/(vnd\.ms-fontobject|x-font-ttf|wasm))', re.I)
+
+
+def available():
+    """
+    :return: encodings this process can produce, most preferred first
+    """
+    return tuple(e for e in PREFERENCE if (e != 'br' or brotli is not None) and (e != 'zstd' or zstandard is not None))
+
+
+def parse_accept_encoding(value):
+    """
+    :return: {coding: q}
+    """
+    accepted = {}
+    for part in value.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, number = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate(accept_encoding, offered=None):
+    """
+    :param offered: encodings to choose from, default available()
+    :return: best encoding the client accepts, 'identity' when there is none
+    """
+    accepted = parse_accept_encoding(accept_encoding or '')
+    if 'x-gzip' in accepted and 'gzip' not in accepted:
+        accepted['gzip'] = accepted['x-gzip']
+    best, best_q = 'identity', 0.0
+    for coding in offered or available():
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compressible(content_type):
+    return bool(COMPRESSIBLE.match(content_type or ''))
+
+
+class BrotliEncoder(object):
+    def __init__(self, level):
+        self._c = brotli.Compressor(quality=level)
+
+    def feed(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.finish()
+
+
+class ZstdEncoder(object):
+    def __init__(self, level):
+        self._c = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def feed(self, data):
+        return self._c.compress(data)
+
+    def flush(self):
+        return self._c.flush()
+
+
+def encoder(encoding, level=None):
+    """
+    :return: incremental encoder with feed() and flush(), like streaming.Encoder
+    """
+    if level is None:
+        level = ADAPTIVE_LEVELS.get(encoding, (6,))[0]
+    if encoding == 'br':
+        if brotli is None:
+            raise ValueError('brotli is not installed')
+        return BrotliEncoder(level)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstandard is not installed')
+        return ZstdEncoder(level)
+    return Encoder(encoding, level)
+
+
+def compress(data, encoding, level=None):
+    enc = encoder(encoding, level)
+    return enc.feed(data) + enc.flush()
+
+
+class AdaptiveLevel(object):
+    def __init__(self, busy=0.5, overloaded=1.0, large=1024 * 1024, min_size=1024, interval=1.0):
+        """
+        :param busy: load average per cpu from which the busy levels are used
+        :param overloaded: load average per cpu from which the cheapest levels are used
+        :param large: bodies from this size get one step cheaper
+        :param min_size: bodies below this size are not worth compressing
+        :param interval: seconds the load average is cached
+        """
+        self.busy = busy
+        self.overloaded = overloaded
+        self.large = large
+        self.min_size = min_size
+        self.interval = interval
+        self._cpus = max(1, cpu_count())
+        self._load = 0.0
+        self._checked = 0.0
+
+    def load(self):
+        """
+        :return: 1 minute load average per cpu, 0 where the platform has none
+        """
+        now = time.time()
+        if now - self._checked > self.interval:
+            self._checked = now
+            try:
+                self._load = os.getloadavg()[0] / self._cpus
+            except (AttributeError, OSError):
+                self._load = 0.0
+        return self._load
+
+    def worth_it(self, size):
+        """
+        :param size: body size, None if unknown
+        """
+        return size is None or size >= self.min_size
+
+    def level(self, encoding, size=None):
+        levels = ADAPTIVE_LEVELS.get(encoding)
+        if levels is None:
+            return None
+        load = self.load()
+        tier = 2 if load >= self.overloaded else 1 if load >= self.busy else 0
+        if size is not None and size >= self.large:
+            tier = min(2, tier + 1)
+        return levels[tier]
+
+
+class VariantCache(object):
+    """
+    Static assets compressed at the highest level, by (url, validator, encoding)
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry=2 * 1024 * 1024, workers=1):
+        """
+        :param max_bytes: compressed bytes kept, least recently used are dropped first
+        :param max_entry: larger bodies are not cached
+        :param workers: threads compressing in the background
+        """
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self._entries = OrderedDict()  # key -> compressed bytes
+        self._bytes = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._counts = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    @staticmethod
+    def key(url, headers, encoding, method='GET', status=200):
+        """
+        :param headers: response headers (before filter_headers)
+        :return: cache key, None if the response is not a cacheable static asset
+        """
+        if method != 'GET' or status != 200 or encoding == 'identity':
+            return None
+        if not STATIC.match(headers.get('Content-Type', '')):
+            return None
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return None
+        validator = headers.get('ETag') or headers.get('Last-Modified')
+        if not validator:
+            #  without one a changed asset would be served stale
+            return None
+        return url, validator, encoding
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self._counts['misses'] += 1
+                return None
+            self._entries.pop(key)
+            self._entries[key] = data
+            self._counts['hits'] += 1
+            return data
+
+    def precompress(self, key, plain):
+        """
+        Compress plain at the highest level for key, in the background
+        """
+        if len(plain) > self.max_entry:
+            return
+        with self._lock:
+            if key in self._entries or key in self._pending:
+                return
+            self._pending.add(key)
+        self._executor.submit(self._store, key, plain)
+
+    def _store(self, key, plain):
+        encoding = key[2]
+        try:
+            data = compress(plain, encoding, MAX_LEVELS[encoding])
+        except (ValueError, zlib.error):
+            data = None
+        with self._lock:
+            self._pending.discard(key)
+            if data is None:
+                return
+            self._entries[key] = data
+            self._bytes += len(data)
+            self._counts['stored'] += 1
+            self._counts['bytes_in'] += len(plain)
+            self._counts['bytes_out'] += len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= len(old)
+                self._counts['evicted'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Event-loop serving mode for ProxyRequestHandler.
+
+ThreadingHTTPServer keeps a thread for every client connection for as long as
+it is open: an idle keep-alive connection or a CONNECT tunnel sitting in
+select() costs a thread (and its stack) each. With a few thousand mobile
+clients that is a few thousand threads fighting for the GIL.
+
+EventLoopHTTPServer multiplexes every socket on one poller thread (epoll, poll
+or select, whichever the platform has):
+ - idle client connections are only registered with the poller, which costs
+   the socket and a handler object, no thread
+ - when a request arrives, the connection is handed to a bounded pool of
+   workers, which run the unchanged ProxyRequestHandler (request_handler,
+   response_handler, save_handler, ...) for that one request and hand the
+   connection back
+ - CONNECT tunnels that are not intercepted are relayed by the loop itself,
+   with non-blocking sockets and a small buffer per direction
+
+    httpd = EventLoopHTTPServer(('', 8080), ProxyRequestHandler, workers=32)
+    httpd.serve_forever()
+"""
+import errno
+import os
+import select
+import socket
+import ssl
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from relay import READ, WRITE, Poller, RelayMetrics, TunnelStats, buffered
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Connection(object):
+    """
+    A client connection and the handler object serving it, kept across requests
+    """
+    __slots__ = ('sock', 'handler', 'last_active')
+
+    def __init__(self, sock, handler):
+        self.sock = sock
+        self.handler = handler
+        self.last_active = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class TunnelSide(object):
+    __slots__ = ('sock', 'out', 'peer', 'tunnel', 'eof', 'shut', 'direction')
+
+    def __init__(self, sock, tunnel, direction):
+        self.sock = sock
+        self.out = bytearray()  # waiting to be sent to sock
+        self.peer = None
+        self.tunnel = tunnel
+        self.eof = False  # sock sent its FIN
+        self.shut = False  # the FIN of the peer was passed on to sock
+        self.direction = direction  # TunnelStats field counting what is read from sock
+
+
+class Tunnel(object):
+    """
+    Opaque relay between a client and an upstream socket, driven by the loop
+    """
+
+    def __init__(self, client, upstream, buffer_size, name=''):
+        self.buffer_size = buffer_size
+        self.client = TunnelSide(client, self, 'up')
+        self.upstream = TunnelSide(upstream, self, 'down')
+        self.client.peer, self.upstream.peer = self.upstream, self.client
+        self.last_active = time.time()
+        self.stats = TunnelStats(name, 'loop')
+        self.closed = False
+
+    def sides(self):
+        return self.client, self.upstream
+
+    def events(self, side):
+        """
+        :return: what the loop should wait for on side
+        """
+        events = 0
+        if not side.eof and len(side.peer.out) < self.buffer_size:
+            events |= READ
+        if side.out:
+            events |= WRITE
+        return events
+
+
+class EventLoopHTTPServer(object):
+    address_family = socket.AF_INET
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers=32, idle_timeout=60, tunnel_buffer=64 * 1024):
+        """
+        :param workers: requests processed at the same time, connections beyond that only wait in the loop
+        :param idle_timeout: seconds an idle connection or tunnel is kept open
+        :param tunnel_buffer: bytes buffered per tunnel direction before the loop stops reading that side
+        """
+        self.RequestHandlerClass = RequestHandlerClass
+        self.idle_timeout = idle_timeout
+        self.tunnel_buffer = tunnel_buffer
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self._poller = Poller()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._objects = {}  # fd -> Connection or TunnelSide
+        self._returned = deque()  # (fd, Connection) handed back by workers, Tunnels to start
+        self._wake_r, self._wake_w = os.pipe()
+        self._running = False
+        #  every tunnel reads into this one buffer, only the loop thread touches it
+        self._scratch = memoryview(bytearray(tunnel_buffer))
+        self.relays = RelayMetrics()
+        self.stats = {'connections': 0, 'requests': 0, 'timeouts': 0}
+        self._stats_lock = threading.Lock()  # requests is counted by the workers
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    #  loop
+    def serve_forever(self, poll_interval=1.0):
+        self._running = True
+        self._poller.register(self.socket.fileno(), READ)
+        self._poller.register(self._wake_r, READ)
+        last_sweep = time.time()
+        try:
+            while self._running:
+                for fd, events in self._poller.poll(poll_interval):
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self._wake_r:
+                        os.read(self._wake_r, 4096)
+                    else:
+                        obj = self._objects.get(fd)
+                        if isinstance(obj, Connection):
+                            self._dispatch(fd, obj)
+                        elif isinstance(obj, TunnelSide):
+                            self._pump(fd, obj, events)
+                self._take_returned()
+                if time.time() - last_sweep >= 1.0:
+                    self._sweep()
+                    last_sweep = time.time()
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def shutdown(self):
+        self._running = False
+        self._wake()
+
+    def server_close(self):
+        self.socket.close()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            self.stats['connections'] += 1
+            try:
+                handler = self.new_handler(sock, address)
+            except Exception:
+                sock.close()
+                continue
+            conn = Connection(sock, handler)
+            self._objects[sock.fileno()] = conn
+            self._poller.register(sock.fileno(), READ)
+
+    def new_handler(self, sock, address):
+        """
+        Build the handler without running it: BaseRequestHandler.__init__ would serve the connection to the end
+        """
+        cls = self.RequestHandlerClass
+        if hasattr(cls, '__new__'):
+            handler = cls.__new__(cls)
+        else:
+            handler = types.InstanceType(cls)  # python 2 old-style class, as BaseHTTPRequestHandler is
+        handler.request = sock
+        handler.client_address = address
+        handler.server = self
+        handler.setup()
+        return handler
+
+    def _dispatch(self, fd, conn):
+        # the worker owns the socket until it hands it back
+        self._poller.unregister(fd)
+        del self._objects[fd]
+        self._executor.submit(self._serve, fd, conn)
+
+    def _take_returned(self):
+        while self._returned:
+            item = self._returned.popleft()
+            if isinstance(item, Tunnel):
+                self._start_tunnel(item)
+                continue
+            fd, conn = item
+            conn.sock = conn.handler.connection
+            conn.last_active = time.time()
+            self._objects[fd] = conn
+            self._poller.register(fd, READ)
+
+    def _sweep(self):
+        now = time.time()
+        for fd, obj in list(self._objects.items()):
+            last = obj.tunnel.last_active if isinstance(obj, TunnelSide) else obj.last_active
+            if now - last > self.idle_timeout:
+                self.stats['timeouts'] += 1
+                if isinstance(obj, TunnelSide):
+                    self._close_tunnel(obj.tunnel)
+                else:
+                    self._close(fd, obj)
+
+    def snapshot(self):
+        """
+        :return: stats plus what the loop holds right now
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['open_connections'] = sum(1 for obj in list(self._objects.values()) if isinstance(obj, Connection))
+        stats['tunnels'] = self.relays.snapshot()
+        return stats
+
+    def _close(self, fd, conn):
+        self._objects.pop(fd, None)
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, ValueError, IOError, OSError):
+            pass
+        self.close_handler(conn.handler)
+
+    @staticmethod
+    def close_handler(handler):
+        try:
+            handler.finish()
+        except Exception:
+            pass
+        try:
+            handler.connection.close()
+        except Exception:
+            pass
+
+    #  workers
+    def _serve(self, fd, conn):
+        handler = conn.handler
+        try:
+            handler.connection.settimeout(handler.timeout)
+            while True:
+                handler.close_connection = 1
+                handler.handle_one_request()
+                with self._stats_lock:
+                    self.stats['requests'] += 1
+                tunnel = getattr(handler, 'detached', None)
+                if tunnel is not None:
+                    # the connection became a tunnel: drop the handler's file objects, they keep the socket open
+                    handler.finish()
+                    self._returned.append(tunnel)
+                    self._wake()
+                    return
+                if handler.close_connection:
+                    self.close_handler(handler)
+                    return
+                if not self.has_buffered(handler):
+                    break
+        except (socket.error, ssl.SSLError):
+            self.close_handler(handler)
+            return
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            self.close_handler(handler)
+            return
+        self._returned.append((fd, conn))
+        self._wake()
+
+    @staticmethod
+    def has_buffered(handler):
+        """
+        :return: True if the next request is already read (pipelining, TLS records), the poller would not see it
+        """
+        rbuf = getattr(handler.rfile, '_rbuf', None)  # python 2 socket._fileobject
+        if rbuf is not None and rbuf.tell():
+            return True
+        pending = getattr(handler.connection, 'pending', None)
+        return bool(pending and pending())
+
+    #  tunnels
+    def relay_tunnel(self, handler, upstream):
+        """
+        Called by ProxyRequestHandler.connect_relay from a worker: both sockets go to the loop once the
+        request is over
+        """
+        handler.close_connection = 1
+        tunnel = Tunnel(handler.connection, upstream, self.tunnel_buffer, handler.path)
+        #  bytes the client sent right after CONNECT may sit in the handler's read buffer
+        tunnel.upstream.out += buffered(handler.rfile)
+        tunnel.stats.up += len(tunnel.upstream.out)
+        handler.detached = tunnel
+
+    def _start_tunnel(self, tunnel):
+        self.relays.opened()
+        for side in tunnel.sides():
+            side.sock.setblocking(False)
+            self._objects[side.sock.fileno()] = side
+            self._poller.register(side.sock.fileno(), tunnel.events(side))
+
+    def _pump(self, fd, side, events):
+        tunnel = side.tunnel
+        tunnel.last_active = time.time()
+        try:
+            #  never read more than the peer can still buffer, an empty read would look like the end of stream
+            room = tunnel.buffer_size - len(side.peer.out)
+            if events & READ and not side.eof and room > 0:
+                try:
+                    n = side.sock.recv_into(self._scratch[:room])
+                except socket.error as e:
+                    if e.args[0] not in WOULD_BLOCK:
+                        raise
+                    n = None
+                if n == 0:
+                    side.eof = True
+                elif n:
+                    setattr(tunnel.stats, side.direction, getattr(tunnel.stats, side.direction) + n)
+                    self._forward(side.peer, self._scratch[:n])
+            elif events & READ and side.eof and side.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                #  reset after its FIN: the poller reports it as readable, there is nothing left to read
+                raise socket.error(errno.ECONNRESET, 'connection reset')
+            if events & WRITE and side.out:
+                self._flush(side)
+            for s in tunnel.sides():
+                if s.eof and not s.peer.out and not s.peer.shut:
+                    #  everything s sent is delivered: pass its half close on, the other direction goes on
+                    s.peer.shut = True
+                    s.peer.sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            self._close_tunnel(tunnel)
+            return
+        if tunnel.client.shut and tunnel.upstream.shut:
+            # both directions are done and delivered
+            self._close_tunnel(tunnel)
+            return
+        for s in tunnel.sides():
+            self._poller.modify(s.sock.fileno(), tunnel.events(s))
+
+    @staticmethod
+    def _forward(side, chunk):
+        #  straight from the scratch buffer when nothing is queued, only what the socket refuses is copied
+        sent = 0
+        if not side.out:
+            try:
+                sent = side.sock.send(chunk)
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK:
+                    raise
+        if sent < len(chunk):
+            side.out += chunk[sent:]
+
+    @staticmethod
+    def _flush(side):
+        try:
+            sent = side.sock.send(side.out)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            raise
+        del side.out[:sent]
+
+    def _close_tunnel(self, tunnel):
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        tunnel.stats.ended = time.time()
+        self.relays.closed(tunnel.stats)
+        for side in tunnel.sides():
+            fd = side.sock.fileno()
+            if fd >= 0 and self._objects.get(fd) is side:
+                del self._objects[fd]
+                try:
+                    self._poller.unregister(fd)
+                except (KeyError, ValueError, IOError, OSError):
+                    pass
+            try:
+                side.sock.close()
+            except socket.error:
+                pass
@@ -1,108 +1,537 @@
 #! /usr/bin/env python
-import socket, sys
-from _thread import *
-'''
-try:
-    listening_port = input("[*]Enter Listening Port Number:")
-except KeyboardInterrupt:
-    print("[*] Keyboard Interrupt, Exiting...")
-    sys.exit()
-'''
-max_conn = 5 # Max Connection Allowed
-buffer_size = 8192 # Max Socket Buffer Size=8k
+"""
+Lightweight forwarding HTTP proxy.
 
-def initSocket():
-    try:
-        listening_port = int(input("[*]Enter Listening Port Number:"))
-    except KeyboardInterrupt:
-        print("[*] Keyboard Interrupt, Exiting...")
-        sys.exit()
+ - a connection waiting for its next request (a new or an idle keep-alive one)
+   is only registered with a poller (Parking), and takes one of a fixed pool of
+   worker threads when a request arrives; past max_clients open connections the
+   accept loop waits and the kernel backlog queues them
+ - requests are parsed from a buffered reader: heads and bodies of any size,
+   keep-alive and pipelined requests on one connection
+ - upstream connections come from the shared UpstreamPool, so they are reused
+   across clients and health-checked
+ - CONNECT is relayed with relay() on a pool of its own, at most max_tunnels at a
+   time, so tunnels never starve the plain requests of workers
+ - byte counters (per connection and in total) are served as json on
+   http://proxy2.test/metrics (or GET /metrics to the proxy itself)
+
+    python httpProxy.py 8080
+"""
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+from urllib.parse import urlsplit
+
+from relay import READ, Poller, RelayMetrics, relay
+from upstreampool import UpstreamPool
+
+max_conn = 128  # listen() backlog
+workers = 64  # requests served at the same time
+max_clients = 1024  # client connections open, idle ones included
+max_tunnels = 256  # CONNECT tunnels relayed at the same time
+buffer_size = 256 * 1024  # relay buffer per direction=256k
+idle_timeout = 15  # seconds a keep-alive client connection may stay quiet
+upstream_timeout = 30
+
+MAX_LINE = 65536
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate', 'proxy-authorization', 'te',
+              'trailers', 'transfer-encoding', 'upgrade')
+METRICS_URLS = ('http://proxy2.test/metrics', '/metrics')
+
+upstreams = UpstreamPool(max_per_origin=16, idle_timeout=30, timeout=upstream_timeout)
+tunnels = RelayMetrics()
+tunnel_slots = threading.BoundedSemaphore(max_tunnels)
+
+#  what a worker leaves a connection in
+PARK, TUNNEL, CLOSE = 'park', 'tunnel', 'close'
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ConnectionStats(object):
+    __slots__ = ('client', 'requests', 'bytes_in', 'bytes_out', 'started', 'ended')
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+        self.bytes_in = 0  # from the client
+        self.bytes_out = 0  # to the client
+        self.started = time.time()
+        self.ended = None
+
+    def as_dict(self):
+        return {'client': self.client, 'requests': self.requests, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out, 'seconds': round((self.ended or time.time()) - self.started, 3)}
+
+
+class Metrics(object):
+    def __init__(self, recent=64):
+        self._lock = threading.Lock()
+        self._active = set()
+        self._recent = deque(maxlen=recent)
+        self.totals = {'connections': 0, 'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0}
+
+    def opened(self, stats):
+        with self._lock:
+            self._active.add(stats)
+            self.totals['connections'] += 1
+
+    def closed(self, stats):
+        stats.ended = time.time()
+        with self._lock:
+            self._active.discard(stats)
+            self._recent.append(stats)
+            self.totals['requests'] += stats.requests
+            self.totals['bytes_in'] += stats.bytes_in
+            self.totals['bytes_out'] += stats.bytes_out
+
+    def error(self):
+        with self._lock:
+            self.totals['errors'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'totals': dict(self.totals),
+                'active': [stats.as_dict() for stats in self._active],
+                'recent': [stats.as_dict() for stats in self._recent],
+                'upstream': upstreams.stats(),
+                'tunnels': tunnels.snapshot(),
+            }
+
+
+metrics = Metrics()
+
+
+class CountingSocketIO(socket.SocketIO):
+    """
+    Raw reader of a socket that counts what it reads into a ConnectionStats
+    """
+
+    def __init__(self, sock, stats):
+        socket.SocketIO.__init__(self, sock, 'rb')
+        self.stats = stats
+
+    def readinto(self, b):
+        n = socket.SocketIO.readinto(self, b)
+        if n:
+            self.stats.bytes_in += n
+        return n
+
+
+class ClientConnection(object):
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.stats = ConnectionStats('%s:%d' % addr[:2])
+        self.reader = io.BufferedReader(CountingSocketIO(conn, self.stats), 64 * 1024)
+
+    def send(self, data):
+        self.conn.sendall(data)
+        self.stats.bytes_out += len(data)
+
+    def send_head(self, version, status, reason, headers):
+        lines = ['%s %d %s' % (version, status, reason)]
+        lines.extend('%s: %s' % item for item in headers)
+        self.send(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def send_error(self, status, reason):
+        body = ('%d %s\n' % (status, reason)).encode('latin-1')
+        self.send_head('HTTP/1.1', status, reason, [('Content-Type', 'text/plain'),
+                                                    ('Content-Length', str(len(body))),
+                                                    ('Connection', 'close')])
+        self.send(body)
+
+    #  requests
+    def read_request(self):
+        """
+        :return: (method, target, version, headers), None when the client closed the connection
+        """
+        line = self.reader.readline(MAX_LINE + 1)
+        while line in (b'\r\n', b'\n'):
+            #  stray CRLF between pipelined requests
+            line = self.reader.readline(MAX_LINE + 1)
+        if not line:
+            return None
+        if len(line) > MAX_LINE:
+            raise BadRequest('request line too long')
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise BadRequest('bad request line %r' % line[:100])
+        try:
+            headers = http.client.parse_headers(self.reader)
+        except http.client.HTTPException as e:
+            raise BadRequest('bad headers: %r' % e)
+        return parts[0].upper(), parts[1], parts[2], headers
+
+    def read_body(self, headers):
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            return self.read_chunked()
+        length = headers.get('Content-Length')
+        if not length:
+            return None
+        if not length.strip().isdigit():
+            raise BadRequest('bad Content-Length %r' % length)
+        body = self.reader.read(int(length))
+        if len(body) < int(length):
+            raise BadRequest('body cut short')
+        return body
+
+    def read_chunked(self):
+        parts = []
+        while True:
+            line = self.reader.readline(MAX_LINE + 1)
+            try:
+                size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise BadRequest('bad chunk size %r' % line[:100])
+            if not size:
+                #  trailers, up to the empty line
+                while self.reader.readline(MAX_LINE + 1) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(parts)
+            parts.append(self.reader.read(size))
+            self.reader.readline(MAX_LINE + 1)
+
+    @staticmethod
+    def keep_alive(version, headers):
+        tokens = ','.join(headers.get_all('Connection', []) + headers.get_all('Proxy-Connection', [])).lower()
+        if version == 'HTTP/1.1':
+            return 'close' not in tokens
+        return 'keep-alive' in tokens
+
+    def serve_ready(self):
+        """
+        Serve the requests that have arrived, on a worker
+        :return: PARK to wait for the next request without a worker, TUNNEL once the connection is a tunnel
+                 to relay, CLOSE
+        """
+        try:
+            #  a request that has started must arrive within idle_timeout
+            self.conn.settimeout(idle_timeout)
+            while True:
+                try:
+                    request = self.read_request()
+                except socket.timeout:
+                    return CLOSE
+                if request is None:
+                    return CLOSE
+                self.stats.requests += 1
+                method, target, version, headers = request
+                if method == 'CONNECT':
+                    return TUNNEL if self.open_tunnel(target) else CLOSE
+                if not self.forward(method, target, version, headers):
+                    return CLOSE
+                if not self.has_buffered():
+                    return PARK
+        except BadRequest as e:
+            metrics.error()
+            print("[*] Bad request from %s: %s" % (self.stats.client, e))
+            try:
+                self.send_error(400, 'Bad Request')
+            except socket.error:
+                pass
+        except (socket.error, http.client.HTTPException):
+            metrics.error()
+        return CLOSE
+
+    def has_buffered(self):
+        """
+        :return: True if the next (pipelined) request is already read, the poller would not see it
+        """
+        self.conn.setblocking(False)
+        try:
+            return bool(self.reader.peek(1))
+        except (BlockingIOError, socket.error):
+            return False
+        finally:
+            self.conn.settimeout(idle_timeout)
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        metrics.closed(self.stats)
+        self.conn.close()
+
+    def forward(self, method, target, version, headers):
+        """
+        :return: True if the connection can carry another request
+        """
+        body = self.read_body(headers)
+        if target in METRICS_URLS:
+            self.send_metrics()
+            return self.keep_alive(version, headers)
+        url = urlsplit(target)
+        if url.scheme not in ('http', 'https') or not url.netloc:
+            if not headers.get('Host'):
+                raise BadRequest('no host in %r' % target)
+            url = urlsplit('http://%s%s' % (headers['Host'], target))
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        dropped = set(HOP_BY_HOP)
+        for value in headers.get_all('Connection', []):
+            dropped.update(token.strip().lower() for token in value.split(','))
+        upstream_headers = [(k, v) for k, v in headers.items() if k.lower() not in dropped]
+        if body is not None:
+            upstream_headers = [(k, v) for k, v in upstream_headers if k.lower() != 'content-length']
+            upstream_headers.append(('Content-Length', str(len(body))))
+        upstream_headers = dict(upstream_headers)
+        upstream_headers['Host'] = url.netloc
+
+        try:
+            conn, res = upstreams.request(url.scheme, url.netloc, method, path, body, upstream_headers)
+        except Exception as e:
+            metrics.error()
+            print("[*] Upstream %s failed: %r" % (url.netloc, e))
+            self.send_error(502, 'Bad Gateway')
+            return False
+        keep = self.keep_alive(version, headers)
+        try:
+            keep = self.relay_response(method, version, res, keep)
+        finally:
+            upstreams.release(conn, res)
+        return keep
+
+    def relay_response(self, method, version, res, keep):
+        has_body = method != 'HEAD' and res.status not in (204, 304) and res.status >= 200
+        dropped = set(HOP_BY_HOP)
+        for value in res.msg.get_all('Connection', []):
+            dropped.update(token.strip().lower() for token in value.split(','))
+        headers = [(k, v) for k, v in res.msg.items() if k.lower() not in dropped]
+        chunked = False
+        if has_body and res.length is None:
+            #  length unknown: chunk it for an HTTP/1.1 client, else end it by closing
+            headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+            if version == 'HTTP/1.1':
+                headers.append(('Transfer-Encoding', 'chunked'))
+                chunked = True
+            else:
+                keep = False
+        headers.append(('Connection', 'keep-alive' if keep else 'close'))
+        self.send_head('HTTP/1.1' if version == 'HTTP/1.1' else 'HTTP/1.0', res.status, res.reason, headers)
+        if has_body:
+            buf = memoryview(bytearray(buffer_size))
+            while True:
+                n = res.readinto(buf)
+                if not n:
+                    break
+                if chunked:
+                    self.send(b''.join((b'%x\r\n' % n, buf[:n], b'\r\n')))
+                else:
+                    self.send(buf[:n])
+            if chunked:
+                self.send(b'0\r\n\r\n')
+        return keep
+
+    def open_tunnel(self, target):
+        """
+        Connect upstream and answer the CONNECT, run_tunnel() relays
+        :return: False if there is no tunnel, the client has its error response
+        """
+        if not tunnel_slots.acquire(False):
+            metrics.error()
+            self.send_error(503, 'Service Unavailable')
+            return False
+        host, _, port = target.rpartition(':')
+        try:
+            self.upstream = socket.create_connection((host.strip('[]'), int(port or 443)), timeout=upstream_timeout)
+        except (socket.error, ValueError):
+            tunnel_slots.release()
+            metrics.error()
+            self.send_error(502, 'Bad Gateway')
+            return False
+        try:
+            self.send(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+        except socket.error:
+            tunnel_slots.release()
+            self.upstream.close()
+            raise
+        self.target = target
+        return True
+
+    def run_tunnel(self):
+        """
+        Relay until the tunnel is done, on the tunnel pool
+        """
+        #  bytes the client sent right behind the CONNECT, without waiting for more
+        self.conn.setblocking(False)
+        try:
+            leftover = self.reader.read1(buffer_size) or b''
+        except (BlockingIOError, socket.error):
+            leftover = b''
+        finally:
+            self.conn.setblocking(True)
+        try:
+            stats = relay(self.conn, self.upstream, buffer_size, idle_timeout * 4, leftover=leftover,
+                          name=self.target, metrics=tunnels)
+            self.stats.bytes_in += stats.up - len(leftover)
+            self.stats.bytes_out += stats.down
+        except (socket.error, OSError):
+            metrics.error()
+        finally:
+            tunnel_slots.release()
+            self.upstream.close()
+
+    def send_metrics(self):
+        body = json.dumps(metrics.snapshot(), indent=2, sort_keys=True).encode('utf-8')
+        self.send_head('HTTP/1.1', 200, 'OK', [('Content-Type', 'application/json'),
+                                               ('Content-Length', str(len(body)))])
+        self.send(body)
+
+
+class Parking(object):
+    """
+    Client connections waiting for their next request, on one poller thread: an idle keep-alive
+    connection costs no worker, it gets one when a request arrives and is parked again after it
+    """
+
+    def __init__(self, pool, tunnel_pool, closed):
+        """
+        :param closed: closed(client) called once a connection is closed
+        """
+        self.pool = pool
+        self.tunnel_pool = tunnel_pool
+        self.closed = closed
+        self._poller = Poller()
+        self._parked = {}  # fd -> (ClientConnection, parked at)
+        self._returned = deque()  # ClientConnections to park, from any thread
+        self._wake_r, self._wake_w = os.pipe()
+
+    def park(self, client):
+        self._returned.append(client)
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def run(self):
+        self._poller.register(self._wake_r, READ)
+        last_sweep = time.time()
+        while True:
+            for fd, _ in self._poller.poll(1.0):
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    continue
+                client, _ = self._parked.pop(fd)
+                self._poller.unregister(fd)
+                self.pool.submit(self.serve, client)
+            while self._returned:
+                client = self._returned.popleft()
+                try:
+                    fd = client.fileno()
+                    self._poller.register(fd, READ)
+                except (socket.error, OSError, ValueError):
+                    self.close(client)
+                    continue
+                self._parked[fd] = (client, time.time())
+            if time.time() - last_sweep >= 1.0:
+                last_sweep = time.time()
+                self.sweep(last_sweep)
+
+    def sweep(self, now):
+        for fd, (client, parked) in list(self._parked.items()):
+            if now - parked > idle_timeout:
+                del self._parked[fd]
+                self._poller.unregister(fd)
+                self.close(client)
+
+    def serve(self, client):
+        # on a worker
+        try:
+            outcome = client.serve_ready()
+        except Exception as e:
+            metrics.error()
+            print("[*] Connection %s failed: %r" % (client.stats.client, e))
+            outcome = CLOSE
+        if outcome == PARK:
+            self.park(client)
+        elif outcome == TUNNEL:
+            self.tunnel_pool.submit(self.tunnel, client)
+        else:
+            self.close(client)
+
+    def tunnel(self, client):
+        try:
+            client.run_tunnel()
+        finally:
+            self.close(client)
+
+    def close(self, client):
+        try:
+            client.close()
+        finally:
+            self.closed(client)
+
+
+def serve(listening_port, host=''):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('',listening_port)) #bind socket
-        s.listen(max_conn) # Listening for Incoming Connections
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, listening_port))  # bind socket
+        s.listen(max_conn)  # Listening for Incoming Connections
         print("[*] Initializing Sockets...Done")
         print("[*] Sockets Binded Successfully")
-        print("[*] Server started at [%d]" %listening_port)
+        print("[*] Server started at [%d]" % listening_port)
     except Exception as e:
         print("ERROR:" + str(e))
         print("[*] Unable to Initialize")
         sys.exit(2)
-    while (1):
-        try:
-            conn, addr = s.accept()
-            data = conn.recv(buffer_size)
-            # print(conn)
-            # print(addr)
-            # print(data)
-            #start_new_thread(conn_string,(conn,data,addr))
-            start_new_thread(conn_string, (conn,data,addr))
-            # print(1)
-        except KeyboardInterrupt:
-            print("User Interrupt, server shutting Down")
-            sys.exit(1)
-            s.close()
-    s.close()
-def conn_string(conn, data, addr):
-    # print(data)
-    first_line = (data.split(b'\n')[0]) # Get First Line
-    # print(first_line)
-    url = first_line.split(b' ')[1] # Get URL
-    # print(url)
-    http_pos = (url.find(b"://")) # Get rid of http:// or https://
-    # print(http_pos)
-    if(http_pos == -1):
-        temp = url
-    else:
-        temp = url[(http_pos+3):] # find the url
-    # print(temp)
-    port_pos = (temp.find(b":")) # Find the port, if any
-    webserver_pos = (temp.find(b'/')) # Find the server
-    if(webserver_pos == -1):
-        webserver_pos = len(temp)
-    if(port_pos == -1 or webserver_pos < port_pos):
-        # Default Port 80
-        port = 80
-        webserver = temp[:webserver_pos]
-    else:
-        # Other ports than 80
-        port = int((temp[(port_pos + 1):])[:webserver_pos-port_pos-1])
-        webserver = temp[:port_pos]
-    # print("Webserver: " + str(webserver))
-    # print("Port Number: " + str(port))
-    proxy_server(webserver, port, conn, data,addr )
-def proxy_server(webserver, port, conn, data, addr):
+    pool = ThreadPoolExecutor(max_workers=workers)
+    tunnel_pool = ThreadPoolExecutor(max_workers=max_tunnels)
+    #  open client connections, parked, served or tunneled
+    slots = threading.BoundedSemaphore(max_clients)
+    parking = Parking(pool, tunnel_pool, lambda client: slots.release())
+    loop = threading.Thread(target=parking.run, name='parking')
+    loop.daemon = True
+    loop.start()
+
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((webserver,port))
-        print(data)
-        s.send(data)
-
-        while(1):
-            reply = s.recv(buffer_size)
-            # print(reply)
-            # print("PROXY WORKING!")
-            if(len(reply) > 0):
-                # Get data back from web server
-                conn.send(reply) # Send reply back to client
-                # There is someting you should do
-                #TODO Something Related to Optimization
-                dar = float(len(reply))
-                dar = float(dar/1024)
-                dar = "%.3s" %(str(dar))
-                dar = "%s KB" % (dar)
-                # Calculate Size of the Reply
-                print("[*] Request Done:%s=>%s<=" %(str(addr[0]), str(dar)))
-            else:
-                # print("Nothing Returned!")
-                # Nothing Returned from Web Server
-                break
-    except Exception as e:
-        print(e)
+        while True:
+            slots.acquire()
+            try:
+                conn, addr = s.accept()
+            except socket.error:
+                slots.release()
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ClientConnection(conn, addr)
+            metrics.opened(client.stats)
+            #  even the first request is waited for without a worker
+            parking.park(client)
+    except KeyboardInterrupt:
+        print("User Interrupt, server shutting Down")
+    finally:
         s.close()
-        conn.close()
-        sys.exit(1)
+        pool.shutdown(wait=False)
+        tunnel_pool.shutdown(wait=False)
+
+
+def initSocket():
+    if sys.argv[1:]:
+        listening_port = int(sys.argv[1])
+    else:
+        try:
+            listening_port = int(input("[*]Enter Listening Port Number:"))
+        except KeyboardInterrupt:
+            print("[*] Keyboard Interrupt, Exiting...")
+            sys.exit()
+    serve(listening_port)
+
 
 def demoProxy():
     initSocket()
-demoProxy()
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    demoProxy()
@@ -3,7 +3,6 @@ import sys
 import os
 import socket
 import ssl
-import select
 import httplib
 import urlparse
 import threading
@@ -15,8 +14,14 @@ import re
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from SocketServer import ThreadingMixIn
 from cStringIO import StringIO
-from subprocess import Popen, PIPE
 from HTMLParser import HTMLParser
+from certcache import CertCache
+from eventloop import EventLoopHTTPServer
+from relay import RelayMetrics, buffered, relay
+from upstreampool import UpstreamPool
+from streaming import Capture, ChunkedWriter, Pipeline
+from compression import AdaptiveLevel, VariantCache, available, compress, compressible, negotiate
+from compression import encoder as compression_encoder
 
 
 def with_color(c, s):
@@ -46,12 +51,15 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
     certdir = join_with_script_dir('certs/')
     timeout = 5
     lock = threading.Lock()
-
-    def __init__(self, *args, **kwargs):
-        self.tls = threading.local()
-        self.tls.conns = {}
-
-        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+    certs = None  # CertCache shared by every handler, see cert_cache()
+    relay_buffer = 256 * 1024  # bytes per direction and per call for passthrough tunnels
+    relay_mode = 'auto'  # 'splice' (Linux, python 3.10+), 'copy', or 'auto'
+    relays = RelayMetrics()
+    stream_chunk = 64 * 1024  # bytes read from upstream at a time when streaming
+    capture_bytes = 64 * 1024  # decoded text bodies up to this size are still handed to save_handler
+    levels = AdaptiveLevel()  # compression level from the load average and the body size
+    variants = VariantCache()  # static assets precompressed at the highest level
+    upstreams = UpstreamPool(max_per_origin=16, idle_timeout=30, timeout=timeout)  # shared by every client
 
     def log_error(self, format, *args):
         # surpress "Request timed out: timeout('timed out',)"
@@ -66,21 +74,23 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         else:
             self.connect_relay()
 
+    @classmethod
+    def cert_cache(cls):
+        with cls.lock:
+            if cls.certs is None:
+                cls.certs = CertCache(cls.cakey, cls.cacert, cls.certdir, cls.certkey)
+            return cls.certs
+
     def connect_intercept(self):
         hostname = self.path.split(':')[0]
-        certpath = "%s/%s.crt" % (self.certdir.rstrip('/'), hostname)
-
-        with self.lock:
-            if not os.path.isfile(certpath):
-                epoch = "%d" % (time.time() * 1000)
-                p1 = Popen(["openssl", "req", "-new", "-key", self.certkey, "-subj", "/CN=%s" % hostname], stdout=PIPE)
-                p2 = Popen(["openssl", "x509", "-req", "-days", "3650", "-CA", self.cacert, "-CAkey", self.cakey, "-set_serial", epoch, "-out", certpath], stdin=p1.stdout, stderr=PIPE)
-                p2.communicate()
+        certs = self.cert_cache()
+        # mint (or find) the certificate before the client starts its handshake
+        certs.context(hostname)
 
         self.wfile.write("%s %d %s\r\n" % (self.protocol_version, 200, 'Connection Established'))
         self.end_headers()
 
-        self.connection = ssl.wrap_socket(self.connection, keyfile=self.certkey, certfile=certpath, server_side=True)
+        self.connection = certs.wrap(self.connection, hostname)
         self.rfile = self.connection.makefile("rb", self.rbufsize)
         self.wfile = self.connection.makefile("wb", self.wbufsize)
 
@@ -101,24 +111,27 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         self.send_response(200, 'Connection Established')
         self.end_headers()
 
-        conns = [self.connection, s]
-        self.close_connection = 0
-        while not self.close_connection:
-            rlist, wlist, xlist = select.select(conns, [], conns, self.timeout)
-            if xlist or not rlist:
-                break
-            for r in rlist:
-                other = conns[1] if r is conns[0] else conns[0]
-                data = r.recv(8192)
-                if not data:
-                    self.close_connection = 1
-                    break
-                other.sendall(data)
+        relay_tunnel = getattr(self.server, 'relay_tunnel', None)
+        if relay_tunnel is not None:
+            # event loop mode: the loop relays the tunnel, no thread waits on it
+            relay_tunnel(self, s)
+            return
+
+        self.close_connection = 1
+        try:
+            stats = relay(self.connection, s, self.relay_buffer, self.timeout, self.relay_mode,
+                          buffered(self.rfile), self.path, self.relays)
+        finally:
+            s.close()
+        self.log_message('tunnel %s', stats)
 
     def do_GET(self):
         if self.path == 'http://proxy2.test/':
             self.send_cacert()
             return
+        if self.path == 'http://proxy2.test/metrics':
+            self.send_metrics()
+            return
 
         req = self
         content_length = int(req.headers.get('Content-Length', 0))
@@ -143,36 +156,29 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         assert scheme in ('http', 'https')
         if netloc:
             req.headers['Host'] = netloc
+        # the encodings the client takes, the origin is only offered what decode_content_body reads
+        self.accept_encoding = req.headers.get('Accept-Encoding', '')
         setattr(req, 'headers', self.filter_headers(req.headers))
 
+        conn = None
         try:
-            origin = (scheme, netloc)
-            if not origin in self.tls.conns:
-                if scheme == 'https':
-                    self.tls.conns[origin] = httplib.HTTPSConnection(netloc, timeout=self.timeout)
-                else:
-                    self.tls.conns[origin] = httplib.HTTPConnection(netloc, timeout=self.timeout)
-            conn = self.tls.conns[origin]
-            conn.request(self.command, path, req_body, dict(req.headers))
-            res = conn.getresponse()
+            conn, res = self.upstreams.request(scheme, netloc, self.command, path, req_body, dict(req.headers))
 
             version_table = {10: 'HTTP/1.0', 11: 'HTTP/1.1'}
             setattr(res, 'headers', res.msg)
             setattr(res, 'response_version', version_table[res.version])
 
-            # support streaming
-            if not 'Content-Length' in res.headers and 'no-store' in res.headers.get('Cache-Control', ''):
-                self.response_handler(req, req_body, res, '')
-                setattr(res, 'headers', self.filter_headers(res.headers))
-                self.relay_streaming(res)
-                with self.lock:
-                    self.save_handler(req, req_body, res, '')
+            # stream unless a handler wants the whole body
+            if not self.buffer_response(req, req_body, res):
+                self.relay_streaming(req, req_body, res)
+                self.upstreams.release(conn, res)
                 return
 
             res_body = res.read()
+            self.upstreams.release(conn, res)
         except Exception as e:
-            if origin in self.tls.conns:
-                del self.tls.conns[origin]
+            if conn is not None:
+                self.upstreams.discard(conn)
             self.send_error(502)
             return
 
@@ -185,8 +191,15 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
             return
         elif res_body_modified is not None:
             res_body_plain = res_body_modified
-            res_body = self.encode_content_body(res_body_plain, content_encoding)
+
+        content_type = res.headers.get('Content-Type', '')
+        target = self.client_encoding(content_encoding, content_type, len(res_body_plain))
+        if res_body_modified is not None or not self.same_encoding(target, content_encoding):
+            res_body = self.encode_content_body(res_body_plain, target, self.levels.level(target, len(res_body_plain)))
             res.headers['Content-Length'] = str(len(res_body))
+            if compressible(content_type):
+                for keyword, value in self.encoding_headers(res, target):
+                    res.headers[keyword] = value
 
         setattr(res, 'headers', self.filter_headers(res.headers))
 
@@ -200,21 +213,157 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         with self.lock:
             self.save_handler(req, req_body, res, res_body_plain)
 
-    def relay_streaming(self, res):
+    def relay_streaming(self, req, req_body, res):
+        content_encoding = res.headers.get('Content-Encoding', 'identity').strip().lower()
+        content_type = res.headers.get('Content-Type', '')
+        length = res.headers.get('Content-Length', '')
+        size = int(length) if length.isdigit() else None
+        has_body = self.command != 'HEAD' and res.status not in (204, 304) and res.status >= 200
+        transformers = self.response_transformers(req, req_body, res)
+
+        target = content_encoding
+        if has_body:
+            target = self.client_encoding(content_encoding, content_type, size)
+        variant_key = None
+        if has_body and not transformers:
+            variant_key = self.variants.key(req.path, res.headers, target, self.command, res.status)
+        if variant_key is not None:
+            data = self.variants.get(variant_key)
+            if data is not None:
+                self.send_variant(req, req_body, res, target, data)
+                return
+
+        pipeline = None
+        if transformers or not self.same_encoding(target, content_encoding):
+            try:
+                encoder = compression_encoder(target, self.levels.level(target, size))
+                pipeline = Pipeline(content_encoding, transformers, encoder=encoder)
+            except ValueError:
+                # an encoding we can not decode goes through untouched
+                target, variant_key = content_encoding, None
+        text = content_type.startswith(('text/', 'application/json'))
+        capture = None
+        if text or variant_key is not None:
+            limit = max(self.capture_bytes, self.variants.max_entry) if variant_key is not None else self.capture_bytes
+            capture = Capture(content_encoding, limit)
+
+        setattr(res, 'headers', self.filter_headers(res.headers))
+        chunked = False
+        framing = []
+        if has_body and compressible(content_type):
+            framing.extend(self.encoding_headers(res, target))
+        if has_body and (pipeline is not None or not 'Content-Length' in res.headers):
+            # the length is not known before the end
+            del res.headers['Content-Length']
+            if self.request_version == 'HTTP/1.1':
+                framing.append(('Transfer-Encoding', 'chunked'))
+                chunked = True
+            else:
+                framing.append(('Connection', 'close'))
+                self.close_connection = 1
+
         self.wfile.write("%s %d %s\r\n" % (self.protocol_version, res.status, res.reason))
         for line in res.headers.headers:
             self.wfile.write(line)
+        for keyword, value in framing:
+            self.send_header(keyword, value)
         self.end_headers()
+        out = ChunkedWriter(self.wfile) if chunked else self.wfile
         try:
-            while True:
-                chunk = res.read(8192)
+            while has_body:
+                chunk = res.read(self.stream_chunk)
                 if not chunk:
                     break
-                self.wfile.write(chunk)
+                if capture is not None:
+                    capture.feed(chunk)
+                if pipeline is not None:
+                    chunk = pipeline.feed(chunk)
+                if chunk:
+                    out.write(chunk)
+            if has_body and pipeline is not None:
+                out.write(pipeline.finish())
+            if chunked:
+                out.close()
             self.wfile.flush()
-        except socket.error:
-            # connection closed by client
+        except (socket.error, httplib.HTTPException, zlib.error):
+            # client or origin gone mid-body, the status line is already out: all we can do is hang up
+            self.close_connection = 1
+            return
+
+        res_body = capture.body() if capture is not None else None
+        if variant_key is not None and res_body is not None:
+            # compressed at the highest level in the background, for the next client
+            self.variants.precompress(variant_key, res_body)
+        if res_body is not None and (not text or len(res_body) > self.capture_bytes):
+            res_body = None
+        with self.lock:
+            self.save_handler(req, req_body, res, res_body)
+
+    def client_encoding(self, content_encoding, content_type, size):
+        """
+        :return: Content-Encoding to send the client, content_encoding to pass the body on as the origin sent it
+        """
+        if not compressible(content_type):
+            return content_encoding
+        if content_encoding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+            return content_encoding
+        if self.levels.worth_it(size):
+            return negotiate(self.accept_encoding)
+        # too small to compress again: passed on when the client takes the origin's encoding, decoded otherwise
+        if content_encoding == 'identity':
+            return content_encoding
+        offered = 'gzip' if content_encoding == 'x-gzip' else content_encoding
+        if negotiate(self.accept_encoding, (offered,)) == offered:
+            return content_encoding
+        return 'identity'
+
+    @staticmethod
+    def same_encoding(a, b):
+        return a == b or set((a, b)) == set(('gzip', 'x-gzip'))
+
+    @staticmethod
+    def encoding_headers(res, encoding):
+        """
+        Take Content-Encoding and Vary out of res.headers
+        :return: [(keyword, value)] to send instead
+        """
+        vary = [v.strip() for v in res.headers.get('Vary', '').split(',') if v.strip()]
+        del res.headers['Content-Encoding']
+        del res.headers['Vary']
+        headers = []
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        if not 'accept-encoding' in [v.lower() for v in vary]:
+            vary.append('Accept-Encoding')
+        headers.append(('Vary', ', '.join(vary)))
+        return headers
+
+    def send_variant(self, req, req_body, res, encoding, data):
+        # the upstream body is not needed, read it anyway so the connection can be reused
+        try:
+            while res.read(self.stream_chunk):
+                pass
+        except (socket.error, httplib.HTTPException):
             pass
+        setattr(res, 'headers', self.filter_headers(res.headers))
+        del res.headers['Content-Length']
+        # the origin's Content-Encoding and Vary taken out before the header lines go out
+        framing = self.encoding_headers(res, encoding)
+        self.wfile.write("%s %d %s\r\n" % (self.protocol_version, res.status, res.reason))
+        for line in res.headers.headers:
+            self.wfile.write(line)
+        for keyword, value in framing:
+            self.send_header(keyword, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+            self.wfile.flush()
+        except socket.error:
+            self.close_connection = 1
+            return
+        with self.lock:
+            self.save_handler(req, req_body, res, None)
 
     do_HEAD = do_GET
     do_POST = do_GET
@@ -236,19 +385,11 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
 
         return headers
 
-    def encode_content_body(self, text, encoding):
-        if encoding == 'identity':
-            data = text
-        elif encoding in ('gzip', 'x-gzip'):
-            io = StringIO()
-            with gzip.GzipFile(fileobj=io, mode='wb') as f:
-                f.write(text)
-            data = io.getvalue()
-        elif encoding == 'deflate':
-            data = zlib.compress(text)
-        else:
+    def encode_content_body(self, text, encoding, level=None):
+        try:
+            return compress(text, encoding, level)
+        except ValueError:
             raise Exception("Unknown Content-Encoding: %s" % encoding)
-        return data
 
     def decode_content_body(self, data, encoding):
         if encoding == 'identity':
@@ -277,6 +418,33 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(data)
 
+    def metrics(self):
+        """
+        :return: dict served as json on http://proxy2.test/metrics
+        """
+        metrics = {}
+        if self.certs is not None:
+            metrics['tls'] = self.certs.stats()
+        metrics['upstream'] = self.upstreams.stats()
+        metrics['compression'] = {'encodings': available(), 'load': self.levels.load(),
+                                  'variants': self.variants.stats()}
+        snapshot = getattr(self.server, 'snapshot', None)
+        if snapshot is not None:
+            metrics['eventloop'] = snapshot()
+        else:
+            metrics['tunnels'] = self.relays.snapshot()
+        return metrics
+
+    def send_metrics(self):
+        data = json.dumps(self.metrics(), indent=2, sort_keys=True)
+
+        self.wfile.write("%s %d %s\r\n" % (self.protocol_version, 200, 'OK'))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(data))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
     def print_info(self, req, req_body, res, res_body):
         def parse_qsl(s):
             return '\n'.join("%-20s %s" % (k, v) for k, v in urlparse.parse_qsl(s, keep_blank_values=True))
@@ -360,6 +528,19 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
     def request_handler(self, req, req_body):
         pass
 
+    def buffer_response(self, req, req_body, res):
+        """
+        :return: True to read the whole body and pass it to response_handler, False to stream it
+        """
+        # a subclass overriding response_handler wants whole bodies
+        return self.response_handler.__func__ is not ProxyRequestHandler.response_handler.__func__
+
+    def response_transformers(self, req, req_body, res):
+        """
+        :return: StreamTransformers the decoded body of a streamed response goes through
+        """
+        return []
+
     def response_handler(self, req, req_body, res, res_body):
         pass
 
@@ -372,6 +553,9 @@ def test(HandlerClass=ProxyRequestHandler, ServerClass=ThreadingHTTPServer, prot
         port = int(sys.argv[1])
     else:
         port = 8080
+    if sys.argv[2:] and sys.argv[2] == 'eventloop':
+        # python proxyserver.py 8080 eventloop
+        ServerClass = EventLoopHTTPServer
     server_address = ("172.16.1.2", port)
 
     HandlerClass.protocol_version = protocol
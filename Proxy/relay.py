@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Byte relay for passthrough tunnels (CONNECT that is not intercepted).
+
+The old loops did recv(8192) + sendall(): a new bytes object per 8 KB chunk and
+every byte copied into Python and back out, so a bulk download cost CPU in
+proportion to its size. relay() moves the bytes either
+ - with os.splice (Linux, Python 3.10+): socket -> pipe -> socket inside the
+   kernel, the bytes never reach userspace
+ - or with recv_into a buffer allocated once per direction and sent straight
+   from a memoryview of it: no allocation per chunk, one copy in and one out
+
+Each tunnel returns (and can report into a RelayMetrics) a TunnelStats with the
+bytes moved in each direction and the throughput.
+
+    stats = relay(client, upstream, buffer_size=256 * 1024, timeout=60)
+    print(stats)
+"""
+import errno
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SPLICE = hasattr(os, 'splice')
+#  not every Python that has fcntl names it
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+READ, WRITE = 1, 4
+
+
+class Poller(object):
+    """
+    epoll, poll or select behind one interface, events are READ | WRITE; only select has a limit on the
+    descriptor numbers (FD_SETSIZE, 1024), it is the last resort
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+            self.register = lambda fd, events: self._epoll.register(fd, self._epoll_mask(events))
+            self.modify = lambda fd, events: self._epoll.modify(fd, self._epoll_mask(events))
+            self.unregister = self._epoll.unregister
+            self.poll = self._poll_epoll
+            self.close = self._epoll.close
+        elif hasattr(select, 'poll'):
+            self._poll = select.poll()
+            self.register = lambda fd, events: self._poll.register(fd, self._poll_mask(events))
+            self.modify = lambda fd, events: self._poll.modify(fd, self._poll_mask(events))
+            self.unregister = self._poll.unregister
+            self.poll = self._poll_poll
+            self.close = lambda: None
+        else:
+            self._fds = {}
+            self.register = self.modify = self._set
+            self.unregister = lambda fd: self._fds.pop(fd, None)
+            self.poll = self._poll_select
+            self.close = lambda: None
+
+    @staticmethod
+    def _epoll_mask(events):
+        return (select.EPOLLIN if events & READ else 0) | (select.EPOLLOUT if events & WRITE else 0)
+
+    def _poll_epoll(self, timeout):
+        ready = []
+        for fd, mask in self._epoll.poll(-1 if timeout is None else timeout):
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+    @staticmethod
+    def _poll_mask(events):
+        return (select.POLLIN | select.POLLPRI if events & READ else 0) | (select.POLLOUT if events & WRITE else 0)
+
+    def _poll_poll(self, timeout):
+        ready = []
+        #  milliseconds here
+        for fd, mask in self._poll.poll(None if timeout is None else timeout * 1000):
+            events = 0
+            if mask & (select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                events |= READ
+            if mask & select.POLLOUT:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+    def _set(self, fd, events):
+        self._fds[fd] = events
+
+    def _poll_select(self, timeout):
+        rlist = [fd for fd, ev in self._fds.items() if ev & READ]
+        wlist = [fd for fd, ev in self._fds.items() if ev & WRITE]
+        r, w, _ = select.select(rlist, wlist, [], timeout)
+        ready = dict((fd, READ) for fd in r)
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return list(ready.items())
+
+
+class TunnelStats(object):
+    __slots__ = ('name', 'mode', 'up', 'down', 'started', 'ended')
+
+    def __init__(self, name='', mode='copy'):
+        self.name = name
+        self.mode = mode
+        self.up = 0  # client -> upstream
+        self.down = 0  # upstream -> client
+        self.started = time.time()
+        self.ended = None
+
+    def seconds(self):
+        return (self.ended or time.time()) - self.started
+
+    def throughput(self):
+        """
+        :return: bytes per second, both directions together
+        """
+        seconds = self.seconds()
+        return (self.up + self.down) / seconds if seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {'name': self.name, 'mode': self.mode, 'up': self.up, 'down': self.down,
+                'seconds': round(self.seconds(), 3), 'bytes_per_second': round(self.throughput(), 1)}
+
+    def __str__(self):
+        return '%s: %d bytes up, %d bytes down in %.2fs (%.2f MB/s, %s)' % (
+            self.name, self.up, self.down, self.seconds(), self.throughput() / 1e6, self.mode)
+
+
+class RelayMetrics(object):
+    """
+    Totals over every tunnel, and the most recent ones
+    """
+
+    def __init__(self, recent=32):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=recent)
+        self.tunnels = 0
+        self.active = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def opened(self):
+        with self._lock:
+            self.active += 1
+
+    def closed(self, stats):
+        with self._lock:
+            self.active -= 1
+            self.tunnels += 1
+            self.bytes += stats.up + stats.down
+            self.seconds += stats.seconds()
+            self._recent.append(stats)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'tunnels': self.tunnels,
+                'active': self.active,
+                'bytes': self.bytes,
+                'bytes_per_second': round(self.bytes / self.seconds, 1) if self.seconds else 0.0,
+                'recent': [stats.as_dict() for stats in self._recent],
+            }
+
+
+def buffered(rfile):
+    """
+    :return: bytes already read into a python 2 socket._fileobject, they belong to the tunnel
+    """
+    rbuf = getattr(rfile, '_rbuf', None)
+    if rbuf is not None and rbuf.tell():
+        return rbuf.getvalue()
+    return b''
+
+
+def can_splice(*socks):
+    #  TLS sockets have to go through the SSL object
+    return SPLICE and not any(isinstance(sock, ssl.SSLSocket) for sock in socks)
+
+
+class _Copy(object):
+    """
+    One direction, through a buffer allocated once
+    """
+
+    def __init__(self, src, dst, buffer_size):
+        self.src = src
+        self.dst = dst
+        self.view = memoryview(bytearray(buffer_size))
+
+    def pump(self):
+        """
+        :return: bytes moved, 0 at end of stream
+        """
+        n = self.src.recv_into(self.view)
+        if n:
+            self.dst.sendall(self.view[:n])
+        return n
+
+    def close(self):
+        self.view = None
+
+
+class _Splice(object):
+    """
+    One direction, socket -> pipe -> socket in the kernel
+    """
+
+    def __init__(self, src, dst, buffer_size):
+        self.src = src.fileno()
+        self.dst = dst.fileno()
+        self.r, self.w = os.pipe()
+        self.size = buffer_size
+        if fcntl is not None and buffer_size > 65536:
+            try:
+                self.size = fcntl.fcntl(self.w, F_SETPIPE_SZ, buffer_size)
+            except (IOError, OSError):
+                #  above /proc/sys/fs/pipe-max-size
+                self.size = 65536
+
+    def pump(self):
+        n = os.splice(self.src, self.w, self.size, flags=os.SPLICE_F_MOVE)
+        left = n
+        while left:
+            left -= os.splice(self.r, self.dst, left, flags=os.SPLICE_F_MOVE)
+        return n
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+def relay(client, upstream, buffer_size=65536, timeout=None, mode='auto', leftover=b'', name='',
+          metrics=None):
+    """
+    Relay between two connected sockets until both sides are done or nothing moved for timeout seconds
+    :param buffer_size: bytes moved per call, per direction
+    :param mode: 'splice', 'copy' or 'auto' (splice where possible)
+    :param leftover: bytes from the client already read, sent upstream first
+    :param metrics: RelayMetrics the tunnel is reported to
+    :return: TunnelStats
+    """
+    if mode == 'auto':
+        mode = 'splice' if can_splice(client, upstream) else 'copy'
+    elif mode == 'splice' and not can_splice(client, upstream):
+        raise ValueError('splice needs Linux, Python 3.10+ and plain sockets')
+    stats = TunnelStats(name, mode)
+    if metrics is not None:
+        metrics.opened()
+    Direction = _Splice if mode == 'splice' else _Copy
+    directions = {}
+    poller = None
+    try:
+        #  blocking sockets: a socket with a timeout is non-blocking underneath, and splice() would see EAGAIN
+        client.settimeout(None)
+        upstream.settimeout(None)
+        if leftover:
+            upstream.sendall(leftover)
+            stats.up += len(leftover)
+        directions[client] = Direction(client, upstream, buffer_size)
+        directions[upstream] = Direction(upstream, client, buffer_size)
+        #  poll/epoll: select() can not watch descriptors from 1024 on, which a busy proxy reaches
+        poller = Poller()
+        readers = {client.fileno(): client, upstream.fileno(): upstream}
+        for fd in readers:
+            poller.register(fd, READ)
+        while readers:
+            ready = poller.poll(timeout)
+            if not ready:
+                break
+            for fd, _ in ready:
+                sock = readers.get(fd)
+                if sock is None:
+                    continue
+                n = directions[sock].pump()
+                if n:
+                    if sock is client:
+                        stats.up += n
+                    else:
+                        stats.down += n
+                    continue
+                #  end of stream: pass the half close on, the other direction may still be busy
+                del readers[fd]
+                poller.unregister(fd)
+                other = upstream if sock is client else client
+                try:
+                    other.shutdown(socket.SHUT_WR)
+                except (socket.error, OSError):
+                    readers.clear()
+    except (socket.error, OSError) as e:
+        if e.args and e.args[0] not in (errno.ECONNRESET, errno.EPIPE, errno.EBADF, errno.ETIMEDOUT):
+            raise
+    finally:
+        if poller is not None:
+            poller.close()
+        for direction in directions.values():
+            direction.close()
+        stats.ended = time.time()
+        if metrics is not None:
+            metrics.closed(stats)
+    return stats
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental pieces of the streaming response path of ProxyRequestHandler.
+
+do_GET used to read the whole upstream body, gunzip it, hand it to
+response_handler, gzip it again and only then write it: three copies of the body
+in memory per request, and the client saw nothing until the origin was done.
+A streamed response goes through a Pipeline chunk by chunk instead:
+
+    upstream chunk -> Decoder -> transformer -> ... -> Encoder -> ChunkedWriter -> client
+
+Transformers see the decoded body a chunk at a time and return what to send on,
+see StreamTransformer. Only a handler asking for the whole body with
+buffer_response() gets the old buffered behaviour.
+
+    pipeline = Pipeline('gzip', [Replace(b'http://', b'https://')])
+    for chunk in chunks:
+        out.write(pipeline.feed(chunk))
+    out.write(pipeline.finish())
+"""
+import zlib
+
+
+class Decoder(object):
+    """
+    Incremental inverse of a Content-Encoding
+    """
+
+    def __init__(self, encoding):
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+            raise ValueError('Unknown Content-Encoding: %s' % encoding)
+        self.encoding = encoding
+        self._started = False
+        self._head = b''
+        self._z = None
+        if encoding in ('gzip', 'x-gzip'):
+            self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._z = zlib.decompressobj()
+
+    def feed(self, data):
+        if self._z is None:
+            return data
+        if self.encoding == 'deflate' and not self._started:
+            #  the 2 bytes of the zlib header tell a zlib stream from a raw one, a shorter chunk can not
+            self._head += data
+            if len(self._head) < 2:
+                return b''
+            data, self._head = self._head, b''
+            return self._start(data)
+        return self._z.decompress(data)
+
+    def _start(self, data):
+        self._started = True
+        try:
+            return self._z.decompress(data)
+        except zlib.error:
+            #  "deflate" without the zlib header, as some servers send it
+            self._z = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._z.decompress(data)
+
+    def flush(self):
+        if self._z is None:
+            return b''
+        #  a body shorter than the header
+        head, self._head = self._head, b''
+        return (self._start(head) if head else b'') + self._z.flush()
+
+
+class Encoder(object):
+    """
+    Incremental Content-Encoding, the same formats encode_content_body produces
+    """
+
+    def __init__(self, encoding, level=6):
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._z = zlib.compressobj(level)
+        elif encoding == 'identity':
+            self._z = None
+        else:
+            raise ValueError('Unknown Content-Encoding: %s' % encoding)
+        self.encoding = encoding
+
+    def feed(self, data):
+        return self._z.compress(data) if self._z is not None else data
+
+    def flush(self):
+        return self._z.flush() if self._z is not None else b''
+
+
+class StreamTransformer(object):
+    """
+    Rewrites a decoded body a chunk at a time. feed() may hold bytes back (a
+    match cut in two by a chunk boundary), finish() returns whatever is left.
+    """
+
+    def feed(self, chunk):
+        return chunk
+
+    def finish(self):
+        return b''
+
+
+class Replace(StreamTransformer):
+    """
+    Replaces every occurrence of old with new, across chunk boundaries
+    """
+
+    def __init__(self, old, new):
+        if not old:
+            raise ValueError('nothing to replace')
+        self.old = old
+        self.new = new
+        self._tail = b''
+
+    def feed(self, chunk):
+        data = self._tail + chunk
+        out = []
+        start = 0
+        while True:
+            found = data.find(self.old, start)
+            if found < 0:
+                break
+            out.append(data[start:found])
+            out.append(self.new)
+            start = found + len(self.old)
+        #  the end of data may be the start of a match completed by the next chunk, it is held back as it came in:
+        #  cutting the replaced output instead could complete a match with bytes of new
+        cut = max(start, len(data) - (len(self.old) - 1))
+        out.append(data[start:cut])
+        self._tail = data[cut:]
+        return b''.join(out)
+
+    def finish(self):
+        tail, self._tail = self._tail, b''
+        return tail
+
+
+class Pipeline(object):
+    """
+    Decoder, transformers and Encoder chained
+    """
+
+    def __init__(self, encoding, transformers, level=6, encoder=None):
+        """
+        :param encoder: object with feed() and flush() for the output, default re-encodes the way the origin did
+        """
+        self.decoder = Decoder(encoding)
+        self.encoder = encoder or Encoder(encoding, level)
+        self.transformers = list(transformers)
+
+    def feed(self, chunk):
+        data = self.decoder.feed(chunk)
+        for transformer in self.transformers:
+            if not data:
+                break
+            data = transformer.feed(data)
+        return self.encoder.feed(data) if data else b''
+
+    def finish(self):
+        data = self.decoder.flush()
+        for transformer in self.transformers:
+            if data:
+                data = transformer.feed(data)
+            data += transformer.finish()
+        return self.encoder.feed(data) + self.encoder.flush()
+
+
+class Capture(object):
+    """
+    Decoded copy of the first limit bytes of a body, for save_handler
+    """
+
+    def __init__(self, encoding, limit=64 * 1024):
+        self.limit = limit
+        self._parts = []
+        self._size = 0
+        try:
+            self._decoder = Decoder(encoding)
+        except ValueError:
+            self._decoder = None
+
+    def feed(self, chunk):
+        if self._decoder is None:
+            return
+        try:
+            data = self._decoder.feed(chunk)
+        except zlib.error:
+            self._decoder = None
+            return
+        self._size += len(data)
+        if self._size > self.limit:
+            #  too big to keep: give up rather than hand over half a body
+            self._decoder = None
+            self._parts = []
+            return
+        self._parts.append(data)
+
+    def body(self):
+        """
+        :return: the whole decoded body, None if it was too big or could not be decoded
+        """
+        if self._decoder is None:
+            return None
+        try:
+            self._parts.append(self._decoder.flush())
+        except zlib.error:
+            return None
+        return b''.join(self._parts)
+
+
+class ChunkedWriter(object):
+    """
+    Transfer-Encoding: chunked on top of a file object
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b''.join((('%x\r\n' % len(data)).encode('ascii'), data, b'\r\n')))
+
+    def close(self):
+        self.wfile.write(b'0\r\n\r\n')
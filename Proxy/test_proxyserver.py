@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+proxyserver against a local gzip origin, python test_proxyserver.py
+"""
+import gzip
+import httplib
+import threading
+import time
+import unittest
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler
+from cStringIO import StringIO
+
+from compression import VariantCache
+from proxyserver import ProxyRequestHandler, ThreadingHTTPServer
+
+ASSET = 'function f(a){return a+1}\n' * 2000
+PAGE = '<html><body>' + 'a' * 14500 + '</body></html>'
+
+
+def gzipped(data):
+    io = StringIO()
+    with gzip.GzipFile(fileobj=io, mode='wb') as f:
+        f.write(data)
+    return io.getvalue()
+
+
+class Origin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    bodies = {
+        '/app.js': ('application/javascript', gzipped(ASSET), [('ETag', '"v1"'), ('Vary', 'Accept-Encoding')]),
+        '/page.html': ('text/html', gzipped(PAGE), []),
+    }
+
+    def do_GET(self):
+        content_type, body, extra = self.bodies[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        for keyword, value in extra:
+            self.send_header(keyword, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietProxy(ProxyRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    variants = VariantCache()
+
+    def save_handler(self, req, req_body, res, res_body):
+        pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class ProxyServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.origin = serve(ThreadingHTTPServer(('127.0.0.1', 0), Origin))
+        cls.proxy = serve(ThreadingHTTPServer(('127.0.0.1', 0), QuietProxy))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy.shutdown()
+        cls.origin.shutdown()
+
+    def get(self, path, accept_encoding):
+        conn = httplib.HTTPConnection('127.0.0.1', self.proxy.server_address[1], timeout=10)
+        try:
+            conn.request('GET', 'http://127.0.0.1:%d%s' % (self.origin.server_address[1], path),
+                         headers={'Accept-Encoding': accept_encoding})
+            res = conn.getresponse()
+            return res, res.read()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def decode(res, body):
+        encoding = res.getheader('Content-Encoding', 'identity')
+        if encoding == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            return zlib.decompress(body)
+        return body
+
+    def test_repeat_request_served_from_variant_cache(self):
+        for attempt in range(50):
+            res, body = self.get('/app.js', 'gzip')
+            self.assertEqual(res.getheader('Content-Encoding'), 'gzip')
+            self.assertEqual(len(res.msg.getheaders('Content-Encoding')), 1)
+            self.assertEqual(res.getheader('Vary'), 'Accept-Encoding')
+            self.assertEqual(self.decode(res, body), ASSET)
+            if QuietProxy.variants.stats()['hits']:
+                break
+            # precompressed in the background after the first request
+            time.sleep(0.05)
+        self.assertTrue(QuietProxy.variants.stats()['hits'] >= 1)
+
+    def test_small_encoded_body_decoded_for_identity_client(self):
+        for accept_encoding in ('identity', 'deflate'):
+            res, body = self.get('/page.html', accept_encoding)
+            # too small to be compressed again, so decoded rather than sent as gzip
+            self.assertEqual(res.getheader('Content-Encoding', 'identity'), 'identity')
+            self.assertEqual(self.decode(res, body), PAGE)
+
+    def test_small_encoded_body_passed_on_to_gzip_client(self):
+        res, body = self.get('/page.html', 'gzip')
+        self.assertEqual(res.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(self.decode(res, body), PAGE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Upstream connections shared by every client connection of the proxy.
+
+do_GET used to keep its HTTPConnections in the handler, so they lived as long as
+one client connection: a second client fetching from the same CDN opened its own
+connection (TCP and TLS handshake included), and a connection that failed was
+just forgotten. UpstreamPool keeps them for the whole process:
+ - keyed by (scheme, host, port), at most max_per_origin open per origin; past
+   that a request waits for one to be returned
+ - idle connections are closed after idle_timeout seconds
+ - an idle connection is checked before it is reused: one the origin has closed
+   (or that has unexpected bytes waiting) is thrown away
+ - a request that fails on a reused connection before any response arrived
+   (the origin closed it just as we sent) is retried once on a new connection,
+   if its method is idempotent or nothing of it was sent
+
+    conn, res = pool.request('https', 'cdn.example.com', 'GET', '/a.js', None, headers)
+    body = res.read()
+    pool.release(conn, res)
+"""
+import errno
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+#  what a connection closed by the origin while idle looks like
+STALE_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED, errno.EBADF)
+#  safe to send twice: the origin may have acted on the first one before the connection broke
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def origin_of(scheme, netloc):
+    """
+    :return: (scheme, host, port)
+    """
+    host, port = netloc, DEFAULT_PORTS[scheme]
+    if netloc.startswith('['):
+        # [v6 address]:port
+        end = netloc.index(']')
+        host = netloc[1:end]
+        if netloc[end + 1:end + 2] == ':' and netloc[end + 2:].isdigit():
+            port = int(netloc[end + 2:])
+    elif netloc.count(':') == 1:
+        name, _, number = netloc.partition(':')
+        if number.isdigit():
+            host, port = name, int(number)
+    return scheme, host.lower(), port
+
+
+class UpstreamPool(object):
+    def __init__(self, max_per_origin=8, idle_timeout=30, timeout=5, wait_timeout=10, max_idle=256):
+        """
+        :param max_per_origin: connections open to one origin at the same time, idle ones included
+        :param idle_timeout: seconds an unused connection is kept
+        :param timeout: socket timeout of the connections
+        :param wait_timeout: seconds a request waits for a connection to its origin before PoolTimeout
+        :param max_idle: idle connections kept over all origins
+        """
+        self.max_per_origin = max_per_origin
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.max_idle = max_idle
+        self._idle = {}  # origin -> deque of (conn, returned at), most recently returned on the right
+        self._open = {}  # origin -> connections open, idle or checked out
+        self._idle_count = 0
+        self._last_sweep = time.time()
+        self._cond = threading.Condition()
+        self._counts = {'created': 0, 'reused': 0, 'stale': 0, 'expired': 0, 'retried': 0, 'waited': 0,
+                        'discarded': 0}
+
+    def new_connection(self, origin):
+        scheme, host, port = origin
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        conn.pool_origin = origin
+        return conn
+
+    @staticmethod
+    def healthy(conn):
+        """
+        :return: False if an idle connection can not be reused
+        """
+        sock = conn.sock
+        if sock is None:
+            return False
+        try:
+            #  an idle connection has nothing to read: readable means closed by the origin (or garbage)
+            if hasattr(select, 'poll'):
+                # select() can not take descriptors from FD_SETSIZE (1024) on
+                poller = select.poll()
+                poller.register(sock, select.POLLIN | select.POLLPRI)
+                return not poller.poll(0)
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (socket.error, ValueError, select.error):
+            return False
+        return not readable
+
+    #  checkout / checkin
+    def checkout(self, scheme, netloc, fresh=False):
+        """
+        :param fresh: never hand out an idle connection
+        :return: (connection, True if it was used before)
+        """
+        origin = origin_of(scheme, netloc)
+        deadline = time.time() + self.wait_timeout
+        with self._cond:
+            while True:
+                conn = None if fresh else self._take_idle(origin)
+                if conn is not None:
+                    self._counts['reused'] += 1
+                    conn.pool_checked_out = True
+                    return conn, True
+                if self._open.get(origin, 0) < self.max_per_origin:
+                    self._open[origin] = self._open.get(origin, 0) + 1
+                    self._counts['created'] += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('no connection to %s:%d within %ss' % (origin[1], origin[2], self.wait_timeout))
+                self._counts['waited'] += 1
+                self._cond.wait(remaining)
+        conn = self.new_connection(origin)
+        conn.pool_checked_out = True
+        return conn, False
+
+    def _take_idle(self, origin):
+        # with self._cond held
+        idle = self._idle.get(origin)
+        now = time.time()
+        while idle:
+            conn, returned = idle.pop()
+            self._idle_count -= 1
+            if now - returned > self.idle_timeout:
+                self._counts['expired'] += 1
+            elif self.healthy(conn):
+                return conn
+            else:
+                self._counts['stale'] += 1
+            self._close(conn)
+        return None
+
+    def release(self, conn, res=None):
+        """
+        Give conn back once res is read to the end, close it if it can not carry another request.
+        Does nothing for a connection already released or discarded.
+        """
+        if not conn.pool_checked_out:
+            return
+        if conn.sock is None or (res is not None and (not res.isclosed() or res.will_close)):
+            self.discard(conn)
+            return
+        with self._cond:
+            conn.pool_checked_out = False
+            idle = self._idle.setdefault(conn.pool_origin, deque())
+            idle.append((conn, time.time()))
+            self._idle_count += 1
+            if self._idle_count > self.max_idle:
+                self._evict_oldest()
+            self._cond.notify()
+
+    def discard(self, conn):
+        with self._cond:
+            if not conn.pool_checked_out:
+                return
+            conn.pool_checked_out = False
+            self._counts['discarded'] += 1
+            self._close(conn)
+            self._cond.notify()
+
+    def _close(self, conn):
+        # with self._cond held
+        origin = conn.pool_origin
+        self._open[origin] = self._open.get(origin, 1) - 1
+        if not self._open[origin]:
+            del self._open[origin]
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_oldest(self):
+        # with self._cond held
+        oldest = None
+        for origin, idle in self._idle.items():
+            if idle and (oldest is None or idle[0][1] < self._idle[oldest][0][1]):
+                oldest = origin
+        if oldest is not None:
+            conn, _ = self._idle[oldest].popleft()
+            self._idle_count -= 1
+            self._counts['expired'] += 1
+            self._close(conn)
+
+    def sweep(self):
+        """
+        Close the connections idle for longer than idle_timeout
+        """
+        now = time.time()
+        with self._cond:
+            self._last_sweep = now
+            for origin, idle in list(self._idle.items()):
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    conn, _ = idle.popleft()
+                    self._idle_count -= 1
+                    self._counts['expired'] += 1
+                    self._close(conn)
+                if not idle:
+                    del self._idle[origin]
+
+    #  requests
+    def request(self, scheme, netloc, method, path, body=None, headers=None):
+        """
+        Send a request on a pooled connection, retried once on a new connection if a reused one turns out stale
+        :return: (connection, response), hand both to release() once the response is read
+        """
+        if time.time() - self._last_sweep > 1.0:
+            self.sweep()
+        conn, reused = self.checkout(scheme, netloc)
+        while True:
+            try:
+                conn.request(method, path, body, headers or {})
+                return conn, conn.getresponse()
+            except STALE_ERRORS as e:
+                self.discard(conn)
+                stale = isinstance(e, (httplib.BadStatusLine, httplib.CannotSendRequest)) or \
+                    getattr(e, 'errno', None) in STALE_ERRNOS
+                #  CannotSendRequest is raised before a byte goes out, anything else may have reached the origin
+                replayable = method.upper() in IDEMPOTENT or isinstance(e, httplib.CannotSendRequest)
+                if not (reused and stale and replayable):
+                    raise
+                with self._cond:
+                    self._counts['retried'] += 1
+                #  the retry gets a new connection, never a second stale one
+                conn, reused = self.checkout(scheme, netloc, fresh=True)
+            except Exception:
+                self.discard(conn)
+                raise
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counts)
+            stats['open'] = sum(self._open.values())
+            stats['idle'] = self._idle_count
+            stats['origins'] = len(self._open)
+        return stats
+
+    def close(self):
+        with self._cond:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    self._close(conn)
+            self._idle.clear()
+            self._idle_count = 0
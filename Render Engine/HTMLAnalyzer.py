@@ -3,7 +3,8 @@
 import re
 import sys, urlparse, os
 import urllib
-import requests, base64
+import base64
+import assetcache
 from bs4 import BeautifulSoup
 #  try to build a command line version
 import argparse
@@ -39,7 +40,6 @@ def absurl(index, relpath=None, normpath=None):
         else:
             return index
 
-webpage2html_cache = {}
 def get(index, relpath=None, verbose=False, usecache=True, verify=True, ignore_error=False, output = False):
     """
 
@@ -51,7 +51,6 @@ def get(index, relpath=None, verbose=False, usecache=True, verify=True, ignore_e
     :param ignore_error:
     :return: content(str), extra_data(dict, url, content-type e.t.c)
     """
-    global webpage2html_cache
     if index.startswith('http') or (relpath and relpath.startswith('http')):
         fullpath = absurl(index, relpath)
         if not fullpath:
@@ -62,27 +61,21 @@ def get(index, relpath=None, verbose=False, usecache=True, verify=True, ignore_e
         #  按照标准， URL 只允许一部分 ASCII 字符（数字字母和部分符号），其他的字符（如汉字）是不符合 URL 标准的。
         #  所以 URL 中使用其他字符就需要进行 URL 编码
         fullpath = urllib.quote(fullpath, safe="%/:=&?~#+!$,;'@()*[]")
-        if usecache:
-            if fullpath in webpage2html_cache:
-                if verbose: log('[CACHE-HIT] -%s' %fullpath)
-                return webpage2html_cache[fullpath], None
         headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Win64; x64; Trident/6.0)'
         }
         try:
-            response = requests.get(fullpath, headers=headers, verify=verify)
+            response = assetcache.fetch(fullpath, headers=headers, verify=verify, usecache=usecache)
             #  Some web page not encoded with UTF-8, which could cause problem
             # TODO need an RE here to find out the encoding
 
 
-            if verbose: log('[GET] %d -%s' %(response.status_code, response.url))
+            if verbose and getattr(response, 'from_cache', False): log('[CACHE-HIT] -%s' %fullpath)
+            elif verbose: log('[GET] %d -%s' %(response.status_code, response.url))
             if not ignore_error and response.status_code >= 400 or response.status_code < 200:
                 content = ''
             else:
                 content = response.content
-            if usecache:
-                #  Save as Cache
-                webpage2html_cache[response.url] = response.content
             return content, response.headers
         except Exception as ex:
             if verbose: log('[WARN] Opps - %s %s' %(fullpath, ex), 'yellow')
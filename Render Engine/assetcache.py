@@ -0,0 +1,275 @@
+# coding=utf-8
+"""
+In-process cache of fetched assets, shared by every get() implementation.
+
+It replaces the old global webpage2html_cache dict, which grew forever, was not
+safe under the thread pools, ignored HTTP freshness and stored entries under
+response.url while looking them up under the requested url.
+
+ - entries are kept in LRU order and the total size is bounded by max_bytes
+ - freshness follows Cache-Control (no-store, no-cache, private, max-age,
+   s-maxage), Expires and Age; without any of them a heuristic lifetime of 10%
+   of the time since Last-Modified is used (RFC 7234 4.2.2)
+ - stale entries carrying an ETag or Last-Modified are revalidated with a
+   conditional request, a 304 refreshes the entry without a new download
+ - a redirected url is cached under the final url and the requested one
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+from requests.structures import CaseInsensitiveDict
+
+import fetcher
+
+CACHEABLE_STATUS = (200, 203)
+PERMANENT_REDIRECTS = (301, 308)
+HEURISTIC_MAX_TTL = 24 * 3600
+
+re_cache_directive = re.compile(r'([a-zA-Z-]+)\s*(?:=\s*"?([^",]*)"?)?')
+
+
+def parse_cache_control(value):
+    """
+    :return: {directive: value or None}, directives lower cased
+    """
+    directives = {}
+    for mo in re_cache_directive.finditer(value or ''):
+        directives[mo.group(1).lower()] = mo.group(2)
+    return directives
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if not parsed:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers, now=None, default_ttl=0):
+    """
+    :param headers: response headers
+    :return: seconds the response stays fresh from now, None when it must not be stored
+    """
+    now = now or time.time()
+    cc = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in cc or 'private' in cc:
+        return None
+    if 'no-cache' in cc:
+        return 0
+    try:
+        age = max(0, int(headers.get('age') or 0))
+    except ValueError:
+        age = 0
+    for directive in ('s-maxage', 'max-age'):
+        if cc.get(directive) is not None:
+            try:
+                return max(0, int(cc[directive]) - age)
+            except ValueError:
+                return 0
+    date = parse_http_date(headers.get('date')) or now
+    expires = headers.get('expires')
+    if expires is not None:
+        expires_at = parse_http_date(expires)
+        # an invalid Expires (e.g. "0") means already expired
+        return max(0, expires_at - date - age) if expires_at else 0
+    last_modified = parse_http_date(headers.get('last-modified'))
+    if last_modified and last_modified < date:
+        return min(HEURISTIC_MAX_TTL, int((date - last_modified) / 10))
+    return default_ttl
+
+
+class CacheEntry(object):
+    __slots__ = ('url', 'status_code', 'headers', 'content', 'size', 'expires_at', 'aliases')
+
+    def __init__(self, url, status_code, headers, content, lifetime):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.size = len(content) + sum(len(k) + len(v) for k, v in self.headers.items())
+        self.expires_at = time.time() + lifetime
+        self.aliases = set()
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.expires_at
+
+    def validators(self):
+        """
+        :return: headers for a conditional request, empty if the entry can not be revalidated
+        """
+        conditional = {}
+        if self.headers.get('etag'):
+            conditional['If-None-Match'] = self.headers['etag']
+        if self.headers.get('last-modified'):
+            conditional['If-Modified-Since'] = self.headers['last-modified']
+        return conditional
+
+
+class CachedResponse(object):
+    """
+    Quacks like the part of requests.Response the get() functions use
+    """
+    from_cache = True
+
+    def __init__(self, entry):
+        self.url = entry.url
+        self.status_code = entry.status_code
+        self.headers = CaseInsensitiveDict(entry.headers)
+        self.content = entry.content
+        self.history = []
+
+
+class AssetCache(object):
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=None, default_ttl=60):
+        """
+        :param max_bytes: budget for all entries, least recently used entries are evicted first
+        :param max_entry_bytes: larger responses are not stored, defaults to max_bytes / 8
+        :param default_ttl: lifetime of responses that carry no freshness information at all
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # final url -> CacheEntry, in LRU order
+        self._aliases = {}  # requested url -> final url
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._counts = dict.fromkeys(('hits', 'misses', 'revalidated', 'stores', 'evictions'), 0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def lookup(self, url):
+        """
+        :return: the entry stored for url, fresh or stale, None if there is none
+        """
+        with self._lock:
+            key = self._aliases.get(url, url)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.pop(key)
+                self._entries[key] = entry
+            return entry
+
+    def store(self, url, response):
+        """
+        Store response if it is cacheable, under response.url and under url when it was
+        reached through permanent (or explicitly cacheable) redirects
+        :return: the new entry or None
+        """
+        if response.status_code not in CACHEABLE_STATUS:
+            return None
+        lifetime = freshness_lifetime(response.headers, default_ttl=self.default_ttl)
+        if lifetime is None:
+            return None
+        if lifetime == 0 and not response.headers.get('etag') and not response.headers.get('last-modified'):
+            # stale on arrival and impossible to revalidate, storing it is useless
+            return None
+        content = response.content or b''
+        entry = CacheEntry(response.url, response.status_code, response.headers, content, lifetime)
+        if entry.size > self.max_entry_bytes:
+            return None
+        with self._lock:
+            self._remove(entry.url)
+            self._entries[entry.url] = entry
+            self._bytes += entry.size
+            if url != entry.url and all(r.status_code in PERMANENT_REDIRECTS or freshness_lifetime(r.headers)
+                                        for r in getattr(response, 'history', ())):
+                self._alias(url, entry)
+            self.record('stores')
+            self._evict()
+        return entry
+
+    def refresh(self, entry, not_modified):
+        """
+        Apply a 304 response to a stored entry
+        """
+        with self._lock:
+            for name in ('cache-control', 'expires', 'date', 'age', 'etag', 'last-modified'):
+                if name in not_modified.headers:
+                    entry.headers[name] = not_modified.headers[name]
+            lifetime = freshness_lifetime(entry.headers, default_ttl=self.default_ttl)
+            entry.expires_at = time.time() + (lifetime or 0)
+            self.record('revalidated')
+
+    def _alias(self, url, entry):
+        old = self._aliases.get(url)
+        if old in self._entries:
+            self._entries[old].aliases.discard(url)
+        self._aliases[url] = entry.url
+        entry.aliases.add(url)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for alias in entry.aliases:
+            if self._aliases.get(alias) == key:
+                del self._aliases[alias]
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.record('evictions')
+
+    def invalidate(self, url):
+        with self._lock:
+            self._remove(self._aliases.get(url, url))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+
+shared_cache = AssetCache()
+
+
+def fetch(url, headers=None, verify=True, usecache=True, cache=None):
+    """
+    GET url through the pooled fetcher, answering from the asset cache when possible
+    :return: requests.Response, or CachedResponse (from_cache = True) on a hit
+    """
+    if not usecache:
+        return fetcher.fetch(url, headers=headers, verify=verify)
+    if cache is None:
+        cache = shared_cache
+    entry = cache.lookup(url)
+    if entry is not None and entry.is_fresh():
+        cache.record('hits')
+        return CachedResponse(entry)
+    request_headers = dict(headers or {})
+    if entry is not None:
+        request_headers.update(entry.validators())
+    response = fetcher.fetch(url, headers=request_headers, verify=verify)
+    if entry is not None and response.status_code == 304:
+        cache.refresh(entry, response)
+        cache.record('hits')
+        return CachedResponse(entry)
+    cache.record('misses')
+    if cache.store(url, response) is None and entry is not None:
+        cache.invalidate(url)
+    return response
@@ -0,0 +1,250 @@
+# coding=utf-8
+"""
+Content-addressed store of the base64 payloads inlined into generated pages.
+
+The same logo, web font or jQuery used to be base64 encoded again for every page
+referencing it, and every cached page carried its own copy of the encoded data.
+Here a payload is keyed by the sha256 of the decoded body:
+
+ - encode() returns the payload of a body, encoding it only the first time it is
+   seen (an LRU of recent payloads is kept in memory)
+ - externalize() swaps every large data URI of a page for a reference
+   (data:image/png;asset-sha256,<digest>) and stores the payload once, counting
+   one reference per stored page; internalize() puts the payloads back
+ - payloads nobody references any more are evicted, least recently used first,
+   once the table grows past max_disk_bytes
+
+The table is sqlite, on disk when a path is given and in memory otherwise.
+
+    >>> store = AssetStore('assetstore.db')
+    >>> stored, digests = store.externalize(html)
+    >>> html == store.internalize(stored)
+    True
+    >>> store.decref(digests)  # the page was dropped
+"""
+import base64
+import binascii
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+re_data_uri = re.compile(r';base64,([A-Za-z0-9+/]+={0,2})')
+re_data_uri_b = re.compile(br';base64,([A-Za-z0-9+/]+={0,2})')
+re_asset_ref = re.compile(r';asset-sha256,([0-9a-f]{64})')
+re_asset_ref_b = re.compile(br';asset-sha256,([0-9a-f]{64})')
+
+
+class AssetMissing(KeyError):
+    """
+    A page references a payload the store does not have (any more)
+    """
+
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _text(payload, like):
+    """
+    :return: payload as the same string type as like
+    """
+    if isinstance(like, bytes):
+        return payload if isinstance(payload, bytes) else payload.encode('ascii')
+    return payload if not isinstance(payload, bytes) else payload.decode('ascii')
+
+
+class AssetStore(object):
+    def __init__(self, path=None, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024, min_bytes=512):
+        """
+        :param path: sqlite file, None keeps the table in memory
+        :param max_memory_bytes: budget of the in-memory payload LRU
+        :param max_disk_bytes: the table is trimmed to this size, only unreferenced payloads are evicted
+        :param min_bytes: smaller payloads stay inline, a reference would not save much
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.min_bytes = min_bytes
+        self._memory = OrderedDict()  # digest -> payload, in LRU order
+        self._memory_bytes = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._counts = dict.fromkeys(('hits', 'misses', 'stores', 'evictions'), 0)
+        with self._lock:
+            if path:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS assets '
+                               '(digest TEXT PRIMARY KEY, payload BLOB, size INTEGER, refs INTEGER, atime REAL)')
+            self._conn.commit()
+            self._disk_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM assets').fetchone()[0]
+
+    #  memory tier
+    def _remember(self, digest, payload):
+        # caller holds the lock
+        if digest in self._memory:
+            self._memory.pop(digest)
+        else:
+            self._memory_bytes += len(payload)
+        self._memory[digest] = payload
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    def encode(self, data):
+        """
+        :param data: asset body
+        :return: base64 payload of data, from memory when the body was seen before
+        """
+        digest = digest_of(data)
+        with self._lock:
+            payload = self._memory.get(digest)
+            if payload is not None:
+                self._counts['hits'] += 1
+                self._remember(digest, payload)
+                return _text(payload, '')
+            self._counts['misses'] += 1
+        payload = base64.b64encode(data)
+        with self._lock:
+            self._remember(digest, payload)
+        return _text(payload, '')
+
+    def data_uri(self, data, fmt):
+        return ('data:%s;base64,' % fmt) + self.encode(data)
+
+    #  table
+    def get(self, digest):
+        """
+        :return: payload stored under digest, None if there is none
+        """
+        with self._lock:
+            payload = self._memory.get(digest)
+            if payload is not None:
+                return payload
+            row = self._conn.execute('SELECT payload FROM assets WHERE digest = ?', (digest,)).fetchone()
+            if row is None:
+                return None
+            payload = bytes(row[0])
+            self._conn.execute('UPDATE assets SET atime = ? WHERE digest = ?', (time.time(), digest))
+            self._remember(digest, payload)
+            return payload
+
+    def put(self, payload, digest=None, ref=False):
+        """
+        Store payload
+        :param ref: take a reference, under the same lock so the payload can not be evicted in between
+        :return: digest
+        :raise binascii.Error: payload is not valid base64 (TypeError on python 2)
+        """
+        payload = _text(payload, b'')
+        digest = digest or digest_of(base64.b64decode(payload))
+        with self._lock:
+            cur = self._conn.execute('INSERT OR IGNORE INTO assets (digest, payload, size, refs, atime) VALUES (?, ?, ?, 0, ?)',
+                                     (digest, sqlite3.Binary(payload), len(payload), time.time()))
+            if cur.rowcount:
+                self._disk_bytes += len(payload)
+                self._counts['stores'] += 1
+            if ref:
+                self._conn.execute('UPDATE assets SET refs = refs + 1 WHERE digest = ?', (digest,))
+            self._remember(digest, payload)
+        return digest
+
+    def incref(self, digests):
+        with self._lock:
+            self._conn.executemany('UPDATE assets SET refs = refs + 1 WHERE digest = ?', [(d,) for d in digests])
+            self._conn.commit()
+
+    def decref(self, digests):
+        with self._lock:
+            self._conn.executemany('UPDATE assets SET refs = MAX(refs - 1, 0) WHERE digest = ?', [(d,) for d in digests])
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self):
+        # caller holds the lock
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        rows = self._conn.execute('SELECT digest, size FROM assets WHERE refs <= 0 ORDER BY atime').fetchall()
+        for digest, size in rows:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            self._conn.execute('DELETE FROM assets WHERE digest = ?', (digest,))
+            self._disk_bytes -= size
+            self._counts['evictions'] += 1
+            payload = self._memory.pop(digest, None)
+            if payload is not None:
+                self._memory_bytes -= len(payload)
+        self._conn.commit()
+
+    #  pages
+    def externalize(self, html):
+        """
+        Replace the payload of every data URI of at least min_bytes with a reference
+        :return: (html with references, unique digests), one reference is taken per digest
+        """
+        digests = []
+
+        def repl(mo):
+            payload = mo.group(1)
+            if len(payload) < self.min_bytes:
+                return mo.group(0)
+            try:
+                digest = digest_of(base64.b64decode(payload))
+            except (binascii.Error, TypeError, ValueError):
+                #  unpadded, or cut at a %3D-escaped '=': left inline as it is
+                return mo.group(0)
+            #  the reference is taken as the payload is stored, a concurrent decref() can not evict it
+            self.put(payload, digest, ref=digest not in digests)
+            if digest not in digests:
+                digests.append(digest)
+            return _text(';asset-sha256,', html) + _text(digest, html)
+        try:
+            if isinstance(html, bytes):
+                html = re_data_uri_b.sub(repl, html)
+            else:
+                html = re_data_uri.sub(repl, html)
+        except Exception:
+            self.decref(digests)
+            raise
+        with self._lock:
+            self._conn.commit()
+            self._evict()
+        return html, digests
+
+    def internalize(self, html):
+        """
+        Put the payloads back into a page produced by externalize()
+        :raise AssetMissing: a referenced payload was evicted
+        """
+        def repl(mo):
+            digest = _text(mo.group(1), '')
+            payload = self.get(digest)
+            if payload is None:
+                raise AssetMissing(digest)
+            return _text(';base64,', html) + _text(payload, html)
+        if isinstance(html, bytes):
+            return re_asset_ref_b.sub(repl, html)
+        return re_asset_ref.sub(repl, html)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['memory_bytes'] = self._memory_bytes
+            stats['disk_bytes'] = self._disk_bytes
+            stats['assets'] = self._conn.execute('SELECT COUNT(*) FROM assets').fetchone()[0]
+        return stats
+
+
+_shared = []
+_shared_lock = threading.Lock()
+
+
+def shared_store(path='assetstore.db'):
+    """
+    :return: the process wide AssetStore, opened at path on first use
+    """
+    with _shared_lock:
+        if not _shared:
+            _shared.append(AssetStore(path))
+        return _shared[0]
@@ -1,58 +1,35 @@
 # start simple by adding html file into db
 #  from htmlcombine import mergeHTML
 from pymongo import MongoClient
-import datetime, time
+import assetstore
+import inlinepolicy
 from htmlcombine import generate
-def savetoAndReadfromDB(conn, url, threshold):
+from pagecache import mongo_page_cache
+
+
+def page_cache(conn):
+    """
+    :param conn: db connection
+    :return: the PageCache stored in conn, pages are generated with generate()
+    """
+    return mongo_page_cache(conn, generate, store=assetstore.shared_store())
+
+
+def savetoAndReadfromDB(conn, url, threshold, user_agent=None):
     """
 
     :param conn: db connection
     :param url: web page url
-    :param htmlsrc: processed html file
-    :param threshold: expiration threshold
+    :param threshold: expiration threshold (seconds), an expired page is still returned while it is regenerated
+    :param user_agent: User-Agent of the client, mobile, tablet and desktop get their own page
     :return: html source code
     """
-    db = conn.webcache
+    try:
+        return page_cache(conn).get(url, ttl=threshold, device=inlinepolicy.device_class(user_agent))
+    except Exception as err:
+        return "Opps, it appears that something went wrong" + str(err)
 
-    # use hash to represent url because mongodb can not handle . in key
-    webcache = db.webcache_test1
-    existcache = webcache.find_one({"url" : str(hash(url))})
-    if not existcache:
-        try:
-            htmlsrc = generate(url)
-            cachefile = {
-                "url": str(hash(url)), "src": htmlsrc, "date": str(datetime.datetime.utcnow()),
-                "recent_access_time": 0,
-            }
-            cachefile_id = webcache.insert_one(cachefile).inserted_id
-        except  Exception as err:
-            err_handle = {
-                "Error": "ERROR %s"%str(err), "data": datetime.datetime.utcnow()
-            }
-            cachefile_id = webcache.insert_one(err_handle).inserted_id
-    elif isexpired(existcache, threshold):
-        try:
-            #  update src file and datetime
-            htmlsrc = generate(url)
-            existcache['src'] = htmlsrc
-            existcache['date'] = datetime.datetime.utcnow()
-        except Exception as err:
-            err_handle = {
-                "Error": "ERROR %s"%str(err), "data": datetime.datetime.utcnow()
-            }
-            cachefile_id = webcache.insert_one(err_handle).inserted_id
-    return webcache.find_one({"url" : str(hash(url))})['src']
 
-def isexpired(cache, threshold):
-    current_time = str(datetime.datetime.utcnow()).split('.')[0]
-    current_timestamp = time.mktime(current_time)
-    cache_time = cache['date'].split('.')[0]
-    cache_timestamp = time.mktime(cache_time)
-    live_time = int(current_timestamp) - int(cache_timestamp)
-    if live_time > threshold:
-        return True
-    else:
-        return False
 if __name__ == "__main__":
     test_urls = [
         "https://www.baidu.com",
@@ -68,5 +45,4 @@ if __name__ == "__main__":
     PORT = 27017
     conn = MongoClient(host=HOST, port=PORT)
     for url in test_urls:
-        htmlsrc = "This is supposed to be html src of %s" %url
-        savetodb(conn, url, htmlsrc)
\ No newline at end of file
+        htmlsrc = savetoAndReadfromDB(conn, url, threshold=600)
\ No newline at end of file
@@ -0,0 +1,234 @@
+# coding=utf-8
+"""
+Concurrent sub-resource fetching for the single html generator.
+
+generate() used to download every stylesheet, script, image and css url() one
+after another. The engine below collects every sub-resource url from the soup
+up front, fetches them in parallel (a global cap plus a per-host cap, like a
+browser does) and hands back a dict {url: (content, extra_data)} that the DOM
+rewrite pass reads from, so the soup itself is only ever touched by one thread.
+
+Stylesheets are expanded as soon as they arrive: the url()s found inside them
+are queued right away instead of waiting for every other resource, so the
+total time is roughly the depth of the html -> css -> font/image chain.
+
+The worker threads live as long as the engine: fetcher keeps a requests.Session
+per thread, so a page fetched on the threads of the previous one reuses its
+kept-alive connections. engine_for() hands out one engine per setting for the
+whole process.
+"""
+import os
+import re
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import fetcher
+
+try:
+    import urlparse
+except ImportError:
+    from urllib import parse as urlparse
+
+re_css_url = re.compile(r'url\s*\((.+?)\)')
+
+ICON_RELS = ('mask-icon', 'icon', 'apple-touch-icon', 'apple-touch-icon-precomposed')
+
+
+def css_urls(css):
+    """
+    :param css: css text
+    :return: every url() referenced by the css, data URIs excluded
+    """
+    if not css:
+        return []
+    urls = []
+    for mo in re_css_url.finditer(css):
+        src = mo.group(1).strip('\'"')
+        if src and not src.startswith('data:'):
+            urls.append(src)
+    return urls
+
+
+def is_stylesheet(link):
+    rel = link.get('rel') or []
+    return link.get('type') == 'text/css' or link['href'].lower().endswith('.css') or 'stylesheet' in rel
+
+
+def collect_resources(soup, index, resolve, keep_script=True):
+    """
+    Walk the soup once and collect the url of every sub-resource generate() will inline
+    :param soup: parsed document
+    :param index: url of the document, relative paths are resolved against it
+    :param resolve: resolve(index, relpath) -> absolute url or None (local file, invalid path)
+    :param keep_script: external scripts are only fetched when they are kept
+    :return: (urls, stylesheets) lists of absolute urls, stylesheets is a subset of urls
+    """
+    urls, stylesheets = [], []
+
+    def add(relpath, base=index, sheet=False):
+        if not relpath or relpath.strip().startswith('data:'):
+            return
+        url = resolve(base, relpath)
+        if not url:
+            return
+        urls.append(url)
+        if sheet:
+            stylesheets.append(url)
+
+    for link in soup('link'):
+        if not link.get('href'):
+            continue
+        rel = link.get('rel') or []
+        if any(r in rel for r in ICON_RELS):
+            add(link['href'])
+        elif is_stylesheet(link):
+            add(link['href'], sheet=True)
+    if keep_script:
+        for js in soup('script'):
+            add(js.get('src'))
+    for img in soup('img'):
+        add(img.get('src'))
+    for tag in soup(True):
+        if tag.get('style'):
+            for src in css_urls(tag['style']):
+                add(src)
+    return urls, stylesheets
+
+
+class FetchEngine(object):
+    """
+    Fetch a batch of urls on a bounded thread pool.
+
+    max_workers caps the number of requests in flight for the whole batch, per_host
+    caps it for a single host so one CDN does not eat every slot (and does not get
+    hammered with 40 parallel connections either). Batches fetched at the same time
+    share the max_workers threads.
+    """
+
+    def __init__(self, fetch=None, max_workers=16, per_host=6, dns_cache=True):
+        """
+        :param fetch: fetch(url) -> (content, extra_data), must be thread safe; or given to fetch_all()
+        :param max_workers: global cap of concurrent requests
+        :param per_host: cap of concurrent requests to the same host
+        :param dns_cache: cache name resolution while the engine is open, see fetcher.install_dns_cache
+        """
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.dns_cache = dns_cache
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if dns_cache:
+            fetcher.install_dns_cache()
+
+    def pool(self):
+        #  started on first use, kept until close(); a forked child can not use the threads of its parent
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            dns_cache, self.dns_cache = self.dns_cache, False
+        if pool is not None:
+            pool.shutdown(wait=True)
+        if dns_cache:
+            fetcher.uninstall_dns_cache()
+
+    @staticmethod
+    def _safe_fetch(fetch, url):
+        try:
+            return fetch(url)
+        except Exception:
+            return '', None
+
+    def fetch_all(self, urls, expand=None, on_result=None, fetch=None):
+        """
+        :param urls: urls to fetch, duplicates are fetched once
+        :param expand: expand(url, result) -> more urls to fetch, called as soon as url is done
+        :param on_result: on_result(url, result) called as soon as url is done, after expand
+        :param fetch: fetch(url) for this batch, default the one of the engine
+        :return: dict {url: (content, extra_data)}
+        """
+        fetch = fetch or self.fetch
+        results = {}
+        queues = defaultdict(deque)  # host -> urls waiting for a slot
+        active = defaultdict(int)  # host -> requests in flight
+        seen = set()
+        state = {'inflight': 0}
+        cond = threading.Condition()
+
+        def enqueue(url):
+            # caller holds cond
+            if url in seen:
+                return
+            seen.add(url)
+            queues[urlparse.urlsplit(url).netloc].append(url)
+
+        def on_done(host, url, future):
+            result = future.result()
+            try:
+                more = expand(url, result) if expand else None
+            except Exception:
+                more = None
+            with cond:
+                results[url] = result
+                active[host] -= 1
+                state['inflight'] -= 1
+                for u in more or ():
+                    enqueue(u)
+                cond.notify()
+            if on_result:
+                on_result(url, result)
+
+        with cond:
+            for url in urls:
+                enqueue(url)
+
+        pool = self.pool()
+        with cond:
+            while True:
+                scheduled = False
+                for host, queue in list(queues.items()):
+                    while queue and active[host] < self.per_host and state['inflight'] < self.max_workers:
+                        url = queue.popleft()
+                        active[host] += 1
+                        state['inflight'] += 1
+                        future = pool.submit(self._safe_fetch, fetch, url)
+                        future.add_done_callback(lambda f, h=host, u=url: on_done(h, u, f))
+                        scheduled = True
+                    if not queue:
+                        del queues[host]
+                if not queues and not state['inflight']:
+                    break
+                if not scheduled:
+                    cond.wait()
+        return results
+
+
+_engines = {}  # (max_workers, per_host) -> FetchEngine
+_engines_lock = threading.Lock()
+
+
+def engine_for(max_workers=16, per_host=6):
+    """
+    :return: the FetchEngine of the process for these caps, pass the fetch function to fetch_all()
+    """
+    with _engines_lock:
+        engine = _engines.get((max_workers, per_host))
+        if engine is None:
+            engine = _engines[(max_workers, per_host)] = FetchEngine(max_workers=max_workers, per_host=per_host)
+        return engine
+
+
+def close_engines():
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.close()
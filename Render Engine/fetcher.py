@@ -0,0 +1,212 @@
+# coding=utf-8
+"""
+Pooled HTTP fetching shared by every Render Engine module.
+
+A bare requests.get opens a fresh TCP (+TLS) connection for every asset, even when
+the whole page lives on the same CDN host. Here every worker thread keeps its own
+requests.Session (Session is not thread safe) mounted with a pooled adapter, so
+connections to a host are kept alive and reused across assets and across pages.
+Name resolution is cached for a short while as well, once install_dns_cache()
+has been called (FetchEngine does).
+
+    >>> import fetcher
+    >>> fetcher.configure(pool_maxsize=16)
+    >>> fetcher.install_dns_cache()
+    >>> response = fetcher.fetch('https://www.yahoo.co.jp/')
+    >>> fetcher.stats()
+    {'requests': 1, 'pool_hits': 0, 'pool_misses': 1, 'dns_hits': 0, 'dns_misses': 1}
+"""
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3 import connectionpool
+except ImportError:
+    from requests.packages.urllib3 import connectionpool
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Win64; x64; Trident/6.0)'
+}
+
+config = {
+    'pool_connections': 32,  # number of hosts whose pools are kept per session
+    'pool_maxsize': 8,  # keep-alive connections kept per host
+    'pool_block': False,  # wait for a free connection instead of opening an extra one
+    'max_retries': 0,
+    'dns_ttl': 300,  # seconds, 0 disables the dns cache
+    'dns_entries': 1024,  # names kept, least recently used are dropped first
+    'timeout': None,
+}
+
+
+class FetchStats(object):
+    """
+    Thread safe counters
+    pool_hits: a kept-alive connection was reused
+    pool_misses: a new connection had to be opened (handshake paid)
+    """
+    FIELDS = ('requests', 'pool_hits', 'pool_misses', 'dns_hits', 'dns_misses')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, field, n=1):
+        with self._lock:
+            self._counts[field] += n
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict((field, 0) for field in self.FIELDS)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+_stats = FetchStats()
+
+
+def _counted_get_conn(pool_class):
+    original = pool_class._get_conn
+
+    def _get_conn(self, timeout=None):
+        conn = original(self, timeout=timeout)
+        # a connection coming out of the pool still holds its socket, a new one connects lazily
+        _stats.incr('pool_hits' if getattr(conn, 'sock', None) is not None else 'pool_misses')
+        return conn
+    return _get_conn
+
+
+class CountingHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    _get_conn = _counted_get_conn(connectionpool.HTTPConnectionPool)
+
+
+class CountingHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    _get_conn = _counted_get_conn(connectionpool.HTTPSConnectionPool)
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+#  DNS cache
+_dns_cache = OrderedDict()  # getaddrinfo arguments -> (expires at, result), least recently used first
+_dns_lock = threading.Lock()
+_dns_users = [0]  # install_dns_cache() calls not undone yet
+_original_getaddrinfo = socket.getaddrinfo
+
+
+def _cached_getaddrinfo(*args, **kwargs):
+    ttl = config['dns_ttl']
+    if not ttl:
+        return _original_getaddrinfo(*args, **kwargs)
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.time()
+    with _dns_lock:
+        hit = _dns_cache.pop(key, None)
+        if hit and hit[0] > now:
+            _dns_cache[key] = hit
+    if hit and hit[0] > now:
+        _stats.incr('dns_hits')
+        return hit[1]
+    _stats.incr('dns_misses')
+    result = _original_getaddrinfo(*args, **kwargs)
+    with _dns_lock:
+        _dns_cache.pop(key, None)
+        _dns_cache[key] = (now + ttl, result)
+        while len(_dns_cache) > config['dns_entries']:
+            _dns_cache.popitem(last=False)
+    return result
+
+
+def install_dns_cache():
+    """
+    urllib3 resolves through socket.getaddrinfo, so the cache is installed there, for the whole process
+    until every install_dns_cache() has been matched by an uninstall_dns_cache()
+    """
+    with _dns_lock:
+        _dns_users[0] += 1
+        socket.getaddrinfo = _cached_getaddrinfo
+
+
+def uninstall_dns_cache():
+    with _dns_lock:
+        _dns_users[0] = max(0, _dns_users[0] - 1)
+        #  left alone if someone patched it after us
+        if not _dns_users[0] and socket.getaddrinfo is _cached_getaddrinfo:
+            socket.getaddrinfo = _original_getaddrinfo
+            _dns_cache.clear()
+
+
+def clear_dns_cache():
+    with _dns_lock:
+        _dns_cache.clear()
+
+
+#  Session per worker
+_local = threading.local()
+_generation = [0]  # bumped by configure() so every thread rebuilds its session
+
+
+def configure(**kwargs):
+    """
+    Change the pool settings, see config for the keys
+    """
+    for key in kwargs:
+        if key not in config:
+            raise KeyError('unknown fetcher option: %s' % key)
+    config.update(kwargs)
+    _generation[0] += 1
+
+
+def new_session():
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = PooledAdapter(pool_connections=config['pool_connections'], pool_maxsize=config['pool_maxsize'],
+                            max_retries=config['max_retries'], pool_block=config['pool_block'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session():
+    """
+    :return: the requests.Session of the calling thread
+    """
+    current = getattr(_local, 'session', None)
+    if current is None or _local.generation != _generation[0]:
+        if current is not None:
+            current.close()
+        current = _local.session = new_session()
+        _local.generation = _generation[0]
+    return current
+
+
+def fetch(url, headers=None, verify=True, timeout=None, **kwargs):
+    """
+    GET url through the pooled session of the calling thread
+    :return: requests.Response
+    """
+    _stats.incr('requests')
+    if timeout is None:
+        timeout = config['timeout']
+    return session().get(url, headers=headers, verify=verify, timeout=timeout, **kwargs)
+
+
+def stats():
+    return _stats.snapshot()
+
+
+def reset_stats():
+    _stats.reset()
+
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Decides which assets data_to_base64 inlines.
+
+Inlining saves a round trip but costs 4/3 of the asset size in the html, the
+html can not be cached per asset and a big inlined image delays everything
+after it. data_to_base64 used to inline whatever it fetched (its size check was
+dead code), so multi-megabyte photos, videos and fonts went into the page.
+
+An InlinePolicy holds
+ - a size threshold per MIME type (longest matching prefix wins)
+ - a budget of inlined bytes per page, per device class picked from the User-Agent
+   (tools/identifyUser.device_class, shared with the image optimizer of the proxy)
+Images, fonts and css url()s go through it in data_to_base64, stylesheets and
+external scripts where the generators inline them. An asset that is not
+inlined keeps its absolute url.
+
+Every page gets its own PageBudget from policy.start(user_agent), which counts
+the inlined and the linked bytes.
+
+    >>> budget = default_policy.start(flow.request.headers.get('User-Agent'))
+    >>> html = generate(url, budget=budget)
+    >>> budget.report()
+    {'device': 'mobile', 'inlined': 12, 'inlined_bytes': 48213, 'encoded_bytes': 64284, 'linked': 3, ...}
+"""
+import os
+import sys
+import threading
+
+try:
+    from tools.identifyUser import device_class
+except ImportError:
+    #  run from Render Engine itself, tools is next to it
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from tools.identifyUser import device_class
+
+#  (mime prefix, largest size inlined in bytes), 0 never inlines
+DEFAULT_THRESHOLDS = (
+    ('image/svg+xml', 16 * 1024),
+    ('image/', 8 * 1024),
+    ('font/', 32 * 1024),
+    ('application/font', 32 * 1024),
+    ('application/x-font', 32 * 1024),
+    ('application/vnd.ms-fontobject', 0),
+    ('text/css', 32 * 1024),
+    ('application/javascript', 32 * 1024),
+    ('text/javascript', 32 * 1024),
+    ('video/', 0),
+    ('audio/', 0),
+    ('', 4 * 1024),
+)
+
+#  device class -> inlined bytes per page, None for no budget
+DEFAULT_BUDGETS = {
+    'mobile': 256 * 1024,
+    'tablet': 512 * 1024,
+    'desktop': 2 * 1024 * 1024,
+}
+
+
+class InlinePolicy(object):
+    def __init__(self, thresholds=DEFAULT_THRESHOLDS, budgets=None):
+        """
+        :param thresholds: [(mime prefix, max bytes)], the longest matching prefix applies
+        :param budgets: {device class: max inlined bytes per page}, defaults to DEFAULT_BUDGETS
+        """
+        self.thresholds = sorted(thresholds, key=lambda t: len(t[0]), reverse=True)
+        self.budgets = DEFAULT_BUDGETS if budgets is None else budgets
+
+    def threshold(self, mime):
+        mime = (mime or '').lower()
+        for prefix, limit in self.thresholds:
+            if mime.startswith(prefix):
+                return limit
+        return 0
+
+    def start(self, user_agent=None, device=None):
+        """
+        :param device: device class, when the caller already has it instead of the User-Agent
+        :return: PageBudget for one page requested with user_agent
+        """
+        device = device or device_class(user_agent)
+        return PageBudget(self, device, self.budgets.get(device))
+
+
+class PageBudget(object):
+    """
+    Inlining decisions and byte counts of one page, shared by the threads rewriting it
+    """
+
+    def __init__(self, policy, device, budget):
+        self.policy = policy
+        self.device = device
+        self.budget = budget
+        self.inlined = 0
+        self.inlined_bytes = 0
+        self.linked = 0
+        self.linked_bytes = 0
+        self._lock = threading.Lock()
+
+    def inline(self, url, mime, size):
+        """
+        :return: True if the asset goes into the page, otherwise it is recorded as linked
+        """
+        with self._lock:
+            fits = size <= self.policy.threshold(mime) and \
+                (self.budget is None or self.inlined_bytes + size <= self.budget)
+            if fits:
+                self.inlined += 1
+                self.inlined_bytes += size
+                return True
+            self.linked += 1
+            self.linked_bytes += size
+            return False
+
+    def report(self):
+        with self._lock:
+            return {
+                'device': self.device,
+                'budget': self.budget,
+                'inlined': self.inlined,
+                'inlined_bytes': self.inlined_bytes,
+                #  what base64 costs in the html
+                'encoded_bytes': (self.inlined_bytes + 2) // 3 * 4,
+                'linked': self.linked,
+                #  bytes kept out of the html, base64 overhead included
+                'saved_bytes': (self.linked_bytes + 2) // 3 * 4,
+            }
+
+
+default_policy = InlinePolicy()
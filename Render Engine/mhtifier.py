@@ -4,7 +4,8 @@
 import os, sys, re, base64, urlparse, urllib2, urllib, datetime
 from bs4 import BeautifulSoup
 import lxml
-import requests
+import assetcache
+import assetstore
 import argparse
 
 re_css_url = re.compile('(url\(.*?\))') #  get css url
@@ -39,11 +40,8 @@ def absurl(index, relpath=None, normpath=None):
         else:
             return index
 
-webpage2html_cache = {}
-
 
 def get(index, relpath=None, verbose=True, usecache=True, verify=True, ignore_error=False):
-    global webpage2html_cache
     if index.startswith('http') or (relpath and relpath.startswith('http')):
         fullpath = absurl(index, relpath)
         if not fullpath:
@@ -52,24 +50,19 @@ def get(index, relpath=None, verbose=True, usecache=True, verify=True, ignore_er
         # urllib2 only accepts valid url, the following code is taken from urllib
         # http://svn.python.org/view/python/trunk/Lib/urllib.py?r1=71780&r2=71779&pathrev=71780
         fullpath = urllib.quote(fullpath, safe="%/:=&?~#+!$,;'@()*[]")
-        if usecache:
-            if fullpath in webpage2html_cache:
-                if verbose: log('[ CACHE HIT ] - %s' % fullpath)
-                return webpage2html_cache[fullpath], None
         headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Win64; x64; Trident/6.0)'
         }
         try:
-            response = requests.get(fullpath, headers=headers, verify=verify)
-            if verbose: log('[ GET ] %d - %s' % (response.status_code, response.url))
+            response = assetcache.fetch(fullpath, headers=headers, verify=verify, usecache=usecache)
+            if verbose and getattr(response, 'from_cache', False): log('[ CACHE HIT ] - %s' % fullpath)
+            elif verbose: log('[ GET ] %d - %s' % (response.status_code, response.url))
             if not ignore_error and (response.status_code >= 400 or response.status_code < 200):
                 content = ''
             # elif response.headers.get('content-type', '').lower().startswith('text/'):
             #     content = response.text
             else:
                 content = response.content
-            if usecache:
-                webpage2html_cache[response.url] = content
             return content, {'url': response.url, 'content-type': response.headers.get('content-type')}
         except Exception as ex:
             if verbose: log('[ WARN ] %s - %s %s' % ('???', fullpath, ex), 'yellow')
@@ -140,7 +133,7 @@ def data_to_base64(index, src, verbose=True):
     if extra_data and extra_data.get('content-type'):
         fmt = extra_data.get('content-type').replace(' ', '')
     if data:
-        return ('data:%s;base64,' % fmt) + base64.b64encode(data)
+        return assetstore.shared_store().data_uri(data, fmt)
     else:
         return absurl(index, src)
 
@@ -224,7 +217,7 @@ def generate(index, verbose=True, comment=True, keep_script=True, prettify=False
         try:
             js_str, _ = get(index, relpath=js['src'], verbose=verbose)
             if js_str.find('</script>') > -1:
-                code['src'] = 'data:text/javascript;base64,' + base64.b64encode(js_str)
+                code['src'] = assetstore.shared_store().data_uri(js_str, 'text/javascript')
             elif js_str.find(']]>') < 0:
                 code.string = '<!--//--><![CDATA[//><!--\n' + js_str + '\n//--><!]]>'
             else:
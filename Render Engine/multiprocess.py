@@ -5,14 +5,17 @@
 import re
 import sys, urlparse, os
 import urllib
-import requests
+import assetcache
+import assetstore
+import inlinepolicy
 import base64
 from bs4 import BeautifulSoup
 import datetime, time
 from multiprocessing import Pool
 from pymongo import MongoClient
+from pagecache import mongo_page_cache
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+from fetchengine import collect_resources, css_urls, engine_for
 re_css_url = re.compile('(url\(.*?\))') #  get css url
 
 #  colored logging, at present, stderr is used, may shift to log file system
@@ -61,9 +64,22 @@ def absurl(index, relpath=None, normpath=None):
             return normpath(os.path.join(os.path.dirname(index), relpath))
         else:
             return index
+def resolve(index, relpath=None):
+    """
+    :return: the quoted absolute url get() would request, None for local files and invalid paths
+    """
+    if index.startswith('http') or (relpath and relpath.startswith('http')):
+        fullpath = absurl(index, relpath)
+        if not fullpath:
+            return None
+        # urllib2 only accepts valid url, the following code is taken from urllib
+        # http://svn.python.org/view/python/trunk/Lib/urllib.py?r1=71780&r2=71779&pathrev=71780
+        #  按照标准， URL 只允许一部分 ASCII 字符（数字字母和部分符号），其他的字符（如汉字）是不符合 URL 标准的。
+        #  所以 URL 中使用其他字符就需要进行 URL 编码
+        return urllib.quote(fullpath, safe="%/:=&?~#+!$,;'@()*[]")
+    return None
 #  get web Content
-webpage2html_cache = {}
-def get(index, relpath=None, verbose=False, usecache=True, verify=True, ignore_error=False):
+def get(index, relpath=None, verbose=False, usecache=True, verify=True, ignore_error=False, resources=None):
     """
 
     :param index:
@@ -72,40 +88,31 @@ def get(index, relpath=None, verbose=False, usecache=True, verify=True, ignore_e
     :param usecache: use cache?
     :param verify: verify cache?
     :param ignore_error:
+    :param resources: results of the concurrent fetch stage, {url: (content, extra_data)}
     :return: content(str), extra_data(dict, url, content-type e.t.c)
     """
-    global webpage2html_cache
     if index.startswith('http') or (relpath and relpath.startswith('http')):
-        fullpath = absurl(index, relpath)
+        fullpath = resolve(index, relpath)
         if not fullpath:
             if verbose: log('[WARN] invalid path, %s %s' %(index, relpath), 'yellow')
             return '', None
-        # urllib2 only accepts valid url, the following code is taken from urllib
-        # http://svn.python.org/view/python/trunk/Lib/urllib.py?r1=71780&r2=71779&pathrev=71780
-        #  按照标准， URL 只允许一部分 ASCII 字符（数字字母和部分符号），其他的字符（如汉字）是不符合 URL 标准的。
-        #  所以 URL 中使用其他字符就需要进行 URL 编码
-        fullpath = urllib.quote(fullpath, safe="%/:=&?~#+!$,;'@()*[]")
-        if usecache:
-            if fullpath in webpage2html_cache:
-                if verbose: log('[CACHE-HIT] -%s' %fullpath)
-                return webpage2html_cache[fullpath], None
+        if resources is not None and fullpath in resources:
+            return resources[fullpath]
         headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Win64; x64; Trident/6.0)'
         }
         try:
-            response = requests.get(fullpath, headers=headers, verify=verify)
+            response = assetcache.fetch(fullpath, headers=headers, verify=verify, usecache=usecache)
             #  Some web page not encoded with UTF-8, which could cause problem
             # TODO need an RE here to find out the encoding
 
 
-            if verbose: log('[GET] %d -%s' %(response.status_code, response.url))
+            if verbose and getattr(response, 'from_cache', False): log('[CACHE-HIT] -%s' %fullpath)
+            elif verbose: log('[GET] %d -%s' %(response.status_code, response.url))
             if not ignore_error and response.status_code >= 400 or response.status_code < 200:
                 content = ''
             else:
                 content = response.content
-            if usecache:
-                #  Save as Cache
-                webpage2html_cache[response.url] = response.content
             return content, {'url' : response.url, 'content-type' : response.headers.get('content-type'),
             'content-length' : response.headers.get('content-length')}
         except Exception as ex:
@@ -153,7 +160,7 @@ data:[<mime type>][;charset=<charset>][;<encoding>],<encoded data>
 4.  [;<encoding>] ：数据编码方式（默认US-ASCII，BASE64两种）
 5.  ,<encoded data> ：编码后的数据
 """
-def data_to_base64(index, src, verbose=False):
+def data_to_base64(index, src, verbose=False, resources=None, budget=None):
     sp = urlparse.urlparse(src).path.lower()
     if src.strip().startswith('data:'):
         return src
@@ -186,14 +193,15 @@ def data_to_base64(index, src, verbose=False):
     else:
         # what if it's not a valid font type? may not matter
         fmt = 'image/png'
-    data, extra_data = get(index, src, verbose)
+    data, extra_data = get(index, src, verbose, resources=resources)
     if extra_data and extra_data.get('content-type'):
         fmt = extra_data.get('content-type').replace(' ', '')
-    if data and extra_data and (sp.endswith('.png') or sp.endswith('.jpg')) and int(extra_data.get('content-length')) < 2000:
-        #  print(extra_data.get('content-length'))
-        return('data:%s;base64,'%fmt) + base64.b64encode(data)
-    elif data and extra_data:
-        return('data:%s;base64,'%fmt) + base64.b64encode(data)
+    if data and extra_data:
+        #  what is too big for the page stays a link, see inlinepolicy
+        if budget is not None and not budget.inline(absurl(index, src), fmt, len(data)):
+            if verbose: log('[LINK] %d bytes %s - %s' %(len(data), fmt, absurl(index, src)))
+            return absurl(index, src)
+        return assetstore.shared_store().data_uri(data, fmt)
     else:
         return absurl(index, src)
 
@@ -201,7 +209,7 @@ def data_to_base64(index, src, verbose=False):
 #  Handle CSS
 css_encoding_re = re.compile(r'''@charset\s+["']([-_a-zA-Z0-9]+)["']\;''', re.I)
 
-def handle_css_content(index, css, verbose=True, debug=True):
+def handle_css_content(index, css, verbose=True, debug=True, resources=None, budget=None):
     if not css:
         return css
     if not isinstance(css, unicode):
@@ -220,16 +228,17 @@ def handle_css_content(index, css, verbose=True, debug=True):
 
     def repl(matchobj):
         src = matchobj.group(1).strip('\'"')
-        return 'url(' + data_to_base64(index, src, verbose=verbose) + ')'
+        return 'url(' + data_to_base64(index, src, verbose=verbose, resources=resources, budget=budget) + ')'
+    css = reg.sub(repl, css)
     return css
 
-def process_link(link, index, soup, verbose, full_url):
+def process_link(link, index, soup, verbose, full_url, resources=None, budget=None):
     if link.get('href'):
         if 'mask-icon' in (link.get('rel') or []) or 'icon' in (link.get('rel') or []) or 'apple-touch-icon' in (
             link.get('rel') or []) or 'apple-touch-icon-precomposed' in (link.get('rel') or []):
             #  Convert icon into URI form with base64
             link['data-href'] = link['href']
-            link['href'] = data_to_base64(index, link['href'], verbose=verbose)
+            link['href'] = data_to_base64(index, link['href'], verbose=verbose, resources=resources, budget=budget)
             #  print link['href']
         #  now the css part needs to be handled encoding with base64
         elif link.get('type') == 'text/css' or link['href'].lower().endswith('.css') or 'stylesheet' in (
@@ -247,8 +256,14 @@ def process_link(link, index, soup, verbose, full_url):
             for attr in link.attrs:
                 if attr in ['href']: continue  # ignore href
                 css[attr] = link[attr]
-            css_data, _ = get(index, relpath=link['href'], verbose=verbose)
-            new_css_content = handle_css_content(absurl(index, link['href']), css_data, verbose=verbose)
+            css_data, _ = get(index, relpath=link['href'], verbose=verbose, resources=resources)
+            #  a stylesheet too big for the page stays a link, see inlinepolicy
+            if css_data and budget is not None and not budget.inline(absurl(index, link['href']), 'text/css', len(css_data)):
+                if verbose: log('[LINK] %d bytes text/css - %s' %(len(css_data), absurl(index, link['href'])))
+                link['data-href'] = link['href']
+                link['href'] = absurl(index, link['href'])
+                return
+            new_css_content = handle_css_content(absurl(index, link['href']), css_data, verbose=verbose, resources=resources, budget=budget)
             if False:
                 link['href'] = 'data:text/css;base64,' + base64.b64encode(new_css_content)
             else:
@@ -258,17 +273,23 @@ def process_link(link, index, soup, verbose, full_url):
             link['data-href'] = link['href']
             link['href'] = absurl(index, link['href'])
 
-def process_js(js, index, soup, verbose, keep_script):
+def process_js(js, index, soup, verbose, keep_script, resources=None, budget=None):
     if not keep_script:
         js.replace_with('')
+        return
     if js.get('src'):
         new_type = 'text/javascript' if not js.has_attr('type') or not js['type'] else js['type']
         code = soup.new_tag('script', type=new_type)
         code['data-src'] = js['src']
         try:
-            js_str, _ = get(index, relpath=js['src'], verbose=verbose)
+            js_str, _ = get(index, relpath=js['src'], verbose=verbose, resources=resources)
+            if js_str and budget is not None and not budget.inline(absurl(index, js['src']), 'application/javascript', len(js_str)):
+                if verbose: log('[LINK] %d bytes application/javascript - %s' %(len(js_str), absurl(index, js['src'])))
+                js['data-src'] = js['src']
+                js['src'] = absurl(index, js['src'])
+                return
             if js_str.find('</script>') > -1:
-                code['src'] = 'data:text/javascript;base64,' + base64.b64encode(js_str)
+                code['src'] = assetstore.shared_store().data_uri(js_str, 'text/javascript')
             # the CDATA part
             elif js_str.find(']]>') < 0:
                 code.string = '<!--//--><![CDATA[//><!--\n' + js_str + '\n//--><!]]>'
@@ -289,10 +310,10 @@ def process_js(js, index, soup, verbose, keep_script):
             if verbose: log(repr(js_str))
             raise
         js.replace_with(code)
-def process_img(img, index, verbose=True):
+def process_img(img, index, verbose=True, resources=None, budget=None):
     if img.get('src'):
         img['data-src'] = img['src']
-        img['src'] = data_to_base64(index, img['src'], verbose=verbose)
+        img['src'] = data_to_base64(index, img['src'], verbose=verbose, resources=resources, budget=budget)
         # `img` elements may have `srcset` attributes with multiple sets of images.
         # To get a lighter document it will be cleared, and used only the standard `src` attribute
         # Maybe add a flag to enable the base64 conversion of each `srcset`?
@@ -318,7 +339,7 @@ def process_img(img, index, verbose=True):
     check_alt('onmouseover')
     check_alt('onmouseout')
 
-def process_tag(tag, index, full_url, verbose):
+def process_tag(tag, index, full_url, verbose, resources=None, budget=None):
     if full_url and tag.name == 'a' and tag.has_attr('href') and not tag['href'].startswith('#'):
         #  Hyperlink
         tag['data-href'] = tag['href']
@@ -327,57 +348,58 @@ def process_tag(tag, index, full_url, verbose):
         #  print tag
         # style sheet
         if tag['style']:
-            tag['style'] = handle_css_content(index, tag['style'], verbose=verbose)
+            tag['style'] = handle_css_content(index, tag['style'], verbose=verbose, resources=resources, budget=budget)
             #  print tag['style']
         elif tag.name == 'link' and tag.has_attr('type') and tag['type'] == 'text/css':
             if tag.string:
-                tag.string = handle_css_content(index, tag.string, verbose=verbose)
+                tag.string = handle_css_content(index, tag.string, verbose=verbose, resources=resources, budget=budget)
         elif tag.name == 'style':
             if tag.string:
-                tag.string = handle_css_content(index, tag.string, verbose=verbose)
-def run_link_process(args):
-    process_link(args[0],args[1],args[2],args[3],args[4])
-    #print("LInk Processing")
-def run_js_process(args):
-    process_js(args[0],args[1],args[2],args[3],args[4])
-    #print("js processing")
-def run_img_process(args):
-    process_img(args[0],args[1],args[2])
-    #print("img processing")
-def run_tag_process(args):
-    process_tag(args[0],args[1],args[2],args[3])
-    #print("tag processing")
-def generate_parallel(index, verbose=False, comment=True, keep_script=True, prettify=False, full_url=True, verify=False, erropage=False):
+                tag.string = handle_css_content(index, tag.string, verbose=verbose, resources=resources, budget=budget)
+def prefetch(soup, index, verbose=False, keep_script=True, max_workers=16, per_host=6):
+    """
+    Fetch every sub-resource of the page concurrently before the DOM rewrite
+    :return: {url: (content, extra_data)}, pass it to get() as resources
+    """
+    urls, stylesheets = collect_resources(soup, index, resolve, keep_script=keep_script)
+    stylesheets = set(stylesheets)
+
+    def expand(url, result):
+        #  url() inside a stylesheet is relative to the stylesheet itself
+        if url not in stylesheets:
+            return []
+        css, _ = result
+        return [u for u in (resolve(url, src) for src in css_urls(css)) if u]
+
+    engine = engine_for(max_workers=max_workers, per_host=per_host)
+    return engine.fetch_all(urls, expand=expand, fetch=lambda url: get(url, verbose=verbose))
+def generate_parallel(index, verbose=False, comment=True, keep_script=True, prettify=False, full_url=True, verify=False, erropage=False,
+                      max_workers=40, per_host=6, user_agent=None, budget=None, device=None):
+    """
+    :param user_agent: User-Agent of the client, picks the inlining budget of its device class
+    :param device: device class of the client, instead of user_agent (the page cache keys pages by it)
+    :param budget: inlinepolicy.PageBudget deciding what is inlined, read budget.report() afterwards;
+                   defaults to inlinepolicy.default_policy.start(user_agent)
+    """
+    if budget is None:
+        budget = inlinepolicy.default_policy.start(user_agent, device=device)
     orgin_index = index
     html_doc, extra_data = get(index, verbose=verbose, verify=verify, ignore_error=erropage)
     if extra_data and extra_data.get('url'):
         index = extra_data['url']
     soup = BeautifulSoup(html_doc, 'lxml')
     soup_title = soup.title.string if soup.title else ''
-    link_tasks = [(link, index, soup, verbose, full_url) for link in soup('link')]
-    js_tasks = [(js, index, soup, verbose, keep_script) for js in soup('script')]
-    img_tasks = [(img, index, verbose) for img in soup('img')]
-    tag_tasks = [(tag, index, full_url, verbose) for tag in soup(True)]
-    """
-    link_pool = Pool(processes=5)
-    js_pool = Pool(processes=5)
-    img_pool = Pool(processes=20)
-    tag_pool = Pool(processes=5)
-    """
-    # concurrent test here
-
-    with ThreadPoolExecutor(max_workers=40) as executor:
-        executor.map(run_link_process, link_tasks)
-        executor.map(run_js_process, js_tasks)
-        executor.map(run_img_process, img_tasks)
-        executor.map(run_tag_process, tag_tasks)
-
-    """
-    link_pool.map(run_link_process, link_tasks)
-    js_pool.map(run_js_process, js_tasks)
-    img_pool.map(run_img_process, img_tasks)
-    tag_pool.map(run_tag_process, tag_tasks)
-    """
+    #  Only the network part runs in parallel, the soup is not thread safe so the rewrite
+    #  below runs in this thread and just reads the prefetched resources
+    resources = prefetch(soup, index, verbose=verbose, keep_script=keep_script, max_workers=max_workers, per_host=per_host)
+    for link in soup('link'):
+        process_link(link, index, soup, verbose, full_url, resources=resources, budget=budget)
+    for js in soup('script'):
+        process_js(js, index, soup, verbose, keep_script, resources=resources, budget=budget)
+    for img in soup('img'):
+        process_img(img, index, verbose, resources=resources, budget=budget)
+    for tag in soup(True):
+        process_tag(tag, index, full_url, verbose, resources=resources, budget=budget)
    # Insert some comment
     if comment:
         for html in soup('html'):
@@ -386,92 +408,47 @@ def generate_parallel(index, verbose=False, comment=True, keep_script=True, pret
                 soup_title, index, datetime.datetime.now().ctime()
             ), 'lxml'))
             break
+    if verbose: log('[INLINE] %s' % budget.report())
     if prettify:
         return soup.prettify(formatter='html')
     else:
         return str(soup)
 
 
+def page_cache(conn):
+    """
+    :param conn: db connection
+    :return: the PageCache stored in conn, pages are generated with generate_parallel()
+    """
+    return mongo_page_cache(conn, generate_parallel, store=assetstore.shared_store())
 
 
-
-
-def savetoAndReadfromDB(conn, url, threshold, debug=True):
+def savetoAndReadfromDB(conn, url, threshold, user_agent=None, debug=True):
     """
 
     :param conn: db connection
     :param url: web page url
-    :param htmlsrc: processed html file
-    :param threshold: expiration threshold
-    :return: ht]ml source code
+    :param threshold: expiration threshold (seconds), an expired page is still returned while it is regenerated
+    :param user_agent: User-Agent of the client, mobile, tablet and desktop get their own page
+    :return: html source code
     """
-    db = conn.webcache
-
-    # use hash to represent url because mongodb can not handle . in key
-    webcache = db.webcache_test1
-    existcache = webcache.find_one({"url" : str(hash(url))})
-
-    def isexpired(cache, threshold):
-        current_time = time.strptime(str(datetime.datetime.utcnow()).split('.')[0], "%Y-%m-%d %H:%M:%S")
-        current_timestamp = int(time.mktime(current_time))
-        cache_time = time.strptime(cache['date'].split('.')[0], "%Y-%m-%d %H:%M:%S")
-        cache_timestamp = int(time.mktime(cache_time))
-        live_time = current_timestamp - cache_timestamp
-        #  print "live time" + str(live_time)
-        if live_time > threshold:
-            return True
-        else:
-            return False
-    if not existcache:
-        try:
-            htmlsrc = generate_parallel(url)
-            cachefile = {
-                "url": str(hash(url)), "src": htmlsrc, "date": str(datetime.datetime.utcnow()),
-                "recent_access_time": 1
-            }
-            cachefile_id = webcache.insert_one(cachefile).inserted_id
-        except  Exception as err:
-            if not debug:
-                err_handle = {
-                    "url": str(hash(url)),
-                    "Error": "ERROR on page generation %s"%str(err), "date": str(datetime.datetime.utcnow())
-                }
-                cachefile_id = webcache.insert_one(err_handle).inserted_id
-            else:
-                traceback.print_exc()
-    elif isexpired(existcache, threshold):
-        try:
-            #  update src file and datetime
-            htmlsrc = generate_parallel(url)
-            #  print "expired!"
-            #  existcache['src'] = htmlsrc
-            #  print existcache['date']
-            #  existcache['date'] = str(datetime.datetime.utcnow())
-            #  修改记录 db.Account.update({"UserName":"libing"},{"$set":{"Email":"libing@126.com","Password":"123"}})
-
-            webcache.update_one({'url':str(hash(url))}, {"$set" : {"src":htmlsrc, "date":str(datetime.datetime.utcnow())}})
-        except Exception as err:
-            if not debug:
-                err_handle = {
-                    "url": str(hash(url)),
-                    "Error": "ERROR on expiration check %s"%str(err), "date": str(datetime.datetime.utcnow())
-                }
-                cachefile_id = webcache.insert_one(err_handle).inserted_id
-            else:
-                traceback.print_exc()
-    # return HTML page if there is nothing wrong else return an Error page
     try:
-        return webcache.find_one({"url" : str(hash(url))})['src']
+        return page_cache(conn).get(url, ttl=threshold, device=inlinepolicy.device_class(user_agent))
     except Exception as err:
+        if debug:
+            traceback.print_exc()
         return "Opps, it appears that something went wrong" + str(err)
+
+
 #  TODO Create a database for image encoding to avoid redundancy.
 
-def mergeHTML(conn, url, output):
+def mergeHTML(conn, url, output, user_agent=None):
     """
 
     :param url: access url
     :param output: processed html src
     :param conn: database connection
+    :param user_agent: User-Agent of the client
     :return: NONE
     """
 
@@ -488,7 +465,7 @@ def mergeHTML(conn, url, output):
     sys.setdefaultencoding('utf8') #  This is the pain in the ass for python in windows, set sys to utf8 to avoid ascii bs!
     # rs = generate(url)
     with open(output, "wb") as f:
-        f.write(savetoAndReadfromDB(conn, url, threshold=1))
+        f.write(savetoAndReadfromDB(conn, url, threshold=1, user_agent=user_agent))
     #  print page_cache
     #  print savetoAndReadfromDB(conn, url, threshold=600)
 
@@ -5,13 +5,15 @@
 import re
 import sys, urlparse, os
 import urllib
-import requests
+import assetcache
+import assetstore
 import base64
 from bs4 import BeautifulSoup
 import datetime, time
 from multiprocessing import Pool
 import multiprocessing
 from pymongo import MongoClient
+from pagecache import mongo_page_cache
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 
@@ -71,7 +73,6 @@ def absurl(index, relpath=None, normpath=None):
 
 
 # get web Content
-webpage2html_cache = {}
 
 
 def get(index, relpath=None, verbose=True, usecache=True, verify=True, ignore_error=False):
@@ -85,7 +86,6 @@ def get(index, relpath=None, verbose=True, usecache=True, verify=True, ignore_er
     :param ignore_error:
     :return: content(str), extra_data(dict, url, content-type e.t.c)
     """
-    global webpage2html_cache
     if index.startswith('http') or (relpath and relpath.startswith('http')):
         fullpath = absurl(index, relpath)
         if not fullpath:
@@ -96,27 +96,21 @@ def get(index, relpath=None, verbose=True, usecache=True, verify=True, ignore_er
         #  按照标准， URL 只允许一部分 ASCII 字符（数字字母和部分符号），其他的字符（如汉字）是不符合 URL 标准的。
         #  所以 URL 中使用其他字符就需要进行 URL 编码
         fullpath = urllib.quote(fullpath, safe="%/:=&?~#+!$,;'@()*[]")
-        if usecache:
-            if fullpath in webpage2html_cache:
-                if verbose: log('[CACHE-HIT] -%s' % fullpath)
-                return webpage2html_cache[fullpath], None
         headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Win64; x64; Trident/6.0)'
         }
         try:
-            response = requests.get(fullpath, headers=headers, verify=verify)
+            response = assetcache.fetch(fullpath, headers=headers, verify=verify, usecache=usecache)
             #  Some web page not encoded with UTF-8, which could cause problem
             # TODO need an RE here to find out the encoding
 
 
-            if verbose: log('[GET] %d -%s' % (response.status_code, response.url))
+            if verbose and getattr(response, 'from_cache', False): log('[CACHE-HIT] -%s' % fullpath)
+            elif verbose: log('[GET] %d -%s' % (response.status_code, response.url))
             if not ignore_error and response.status_code >= 400 or response.status_code < 200:
                 content = ''
             else:
                 content = response.content
-            if usecache:
-                #  Save as Cache
-                webpage2html_cache[response.url] = response.content
             return content, {'url': response.url, 'content-type': response.headers.get('content-type')}
         except Exception as ex:
             if verbose: log('[WARN] Opps - %s %s' % (fullpath, ex), 'yellow')
@@ -203,7 +197,7 @@ def data_to_base64(index, src, verbose=True):
     if extra_data and extra_data.get('content-type'):
         fmt = extra_data.get('content-type').replace(' ', '')
     if data:
-        return ('data:%s;base64,' % fmt) + base64.b64encode(data)
+        return assetstore.shared_store().data_uri(data, fmt)
     else:
         return absurl(index, src)
 
@@ -284,7 +278,7 @@ def process_js(js, index, soup, verbose, keep_script):
         try:
             js_str, _ = get(index, relpath=js['src'], verbose=verbose)
             if js_str.find('</script>') > -1:
-                code['src'] = 'data:text/javascript;base64,' + base64.b64encode(js_str)
+                code['src'] = assetstore.shared_store().data_uri(js_str, 'text/javascript')
             # the CDATA part
             elif js_str.find(']]>') < 0:
                 code.string = '<!--//--><![CDATA[//><!--\n' + js_str + '\n//--><!]]>'
@@ -453,79 +447,31 @@ def generate_parallel(index, verbose=True, comment=True, keep_script=True, prett
         return str(soup)
 
 
+def page_cache(conn):
+    """
+    :param conn: db connection
+    :return: the PageCache stored in conn, pages are generated with generate_parallel()
+    """
+    return mongo_page_cache(conn, generate_parallel, store=assetstore.shared_store())
+
+
 def savetoAndReadfromDB(conn, url, threshold, debug=True):
     """
 
     :param conn: db connection
     :param url: web page url
-    :param htmlsrc: processed html file
-    :param threshold: expiration threshold
-    :return: ht]ml source code
+    :param threshold: expiration threshold (seconds), an expired page is still returned while it is regenerated
+    :return: html source code
     """
-    db = conn.webcache
-
-    # use hash to represent url because mongodb can not handle . in key
-    webcache = db.webcache_test1
-    existcache = webcache.find_one({"url": str(hash(url))})
-
-    def isexpired(cache, threshold):
-        current_time = time.strptime(str(datetime.datetime.utcnow()).split('.')[0], "%Y-%m-%d %H:%M:%S")
-        current_timestamp = int(time.mktime(current_time))
-        cache_time = time.strptime(cache['date'].split('.')[0], "%Y-%m-%d %H:%M:%S")
-        cache_timestamp = int(time.mktime(cache_time))
-        live_time = current_timestamp - cache_timestamp
-        #  print "live time" + str(live_time)
-        if live_time > threshold:
-            return True
-        else:
-            return False
-
-    if not existcache:
-        try:
-            htmlsrc = generate_parallel(url)
-            cachefile = {
-                "url": str(hash(url)), "src": htmlsrc, "date": str(datetime.datetime.utcnow()),
-                "recent_access_time": 1
-            }
-            cachefile_id = webcache.insert_one(cachefile).inserted_id
-        except  Exception as err:
-            if not debug:
-                err_handle = {
-                    "url": str(hash(url)),
-                    "Error": "ERROR on page generation %s" % str(err), "date": str(datetime.datetime.utcnow())
-                }
-                cachefile_id = webcache.insert_one(err_handle).inserted_id
-            else:
-                traceback.print_exc()
-    elif isexpired(existcache, threshold):
-        try:
-            #  update src file and datetime
-            htmlsrc = generate_parallel(url)
-            #  print "expired!"
-            #  existcache['src'] = htmlsrc
-            #  print existcache['date']
-            #  existcache['date'] = str(datetime.datetime.utcnow())
-            #  修改记录 db.Account.update({"UserName":"libing"},{"$set":{"Email":"libing@126.com","Password":"123"}})
-
-            webcache.update_one({'url': str(hash(url))},
-                                {"$set": {"src": htmlsrc, "date": str(datetime.datetime.utcnow())}})
-        except Exception as err:
-            if not debug:
-                err_handle = {
-                    "url": str(hash(url)),
-                    "Error": "ERROR on expiration check %s" % str(err), "date": str(datetime.datetime.utcnow())
-                }
-                cachefile_id = webcache.insert_one(err_handle).inserted_id
-            else:
-                traceback.print_exc()
-    # return HTML page if there is nothing wrong else return an Error page
     try:
-        return webcache.find_one({"url": str(hash(url))})['src']
+        return page_cache(conn).get(url, ttl=threshold)
     except Exception as err:
+        if debug:
+            traceback.print_exc()
         return "Opps, it appears that something went wrong" + str(err)
 
 
-# TODO Create a database for image encoding to avoid redundancy.
+#  TODO Create a database for image encoding to avoid redundancy.
 
 def mergeHTML(conn, url, output):
     """
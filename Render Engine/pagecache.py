@@ -0,0 +1,292 @@
+# coding=utf-8
+"""
+Cache of generated single html pages.
+
+savetoAndReadfromDB used to find the page, generate it synchronously on a miss or
+when it expired and then read it back, so every request hitting an expired popular
+page paid a full generate() and concurrent requests all generated it again.
+
+PageCache instead
+ - keys pages by the sha256 of the url (hash() is randomized per process) and the
+   device class they were generated for: the inlining budget differs per device
+ - serves an expired page immediately and regenerates it on a background worker
+   (stale-while-revalidate), until it is older than ttl + max_stale
+ - collapses concurrent generations of the same url into one (single-flight)
+ - stores pages through a pluggable backend: MemoryBackend, SqliteBackend, MongoBackend
+ - with an AssetStore, keeps the inlined base64 payloads out of the stored pages so
+   an asset shared by many pages is stored once
+
+    >>> cache = PageCache(SqliteBackend('pages.db'), generate, ttl=600)
+    >>> html = cache.get('https://www.yahoo.co.jp', device='mobile')
+
+mongo_page_cache(conn, generate) hands out one PageCache per MongoClient and
+generate function for the whole process, close_page_caches() stops their workers.
+"""
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def page_key(url, device=None):
+    """
+    :param device: device class the page is generated for, None for one page whatever the device
+    :return: stable digest of url and device, the same in every process
+    """
+    if not isinstance(url, bytes):
+        url = url.encode('utf-8')
+    if device:
+        url = device.encode('ascii') + b' ' + url
+    return hashlib.sha256(url).hexdigest()
+
+
+class MemoryBackend(object):
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._records.get(key)
+
+    def put(self, key, record):
+        with self._lock:
+            self._records[key] = record
+
+    def delete(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+
+
+class SqliteBackend(object):
+    def __init__(self, path='pagecache.db'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS pages '
+                               '(key TEXT PRIMARY KEY, url TEXT, src BLOB, date REAL, assets TEXT)')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(pages)')]
+            if 'assets' not in columns:
+                self._conn.execute('ALTER TABLE pages ADD COLUMN assets TEXT')
+            self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT url, src, date, assets FROM pages WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        src = row[1]
+        if not isinstance(src, (bytes, type(u''))):
+            src = bytes(src)  # BLOB comes back as buffer/memoryview
+        return {'url': row[0], 'src': src, 'date': row[2], 'assets': (row[3] or '').split()}
+
+    def put(self, key, record):
+        src = record['src']
+        if isinstance(src, bytes):
+            src = sqlite3.Binary(src)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO pages (key, url, src, date, assets) VALUES (?, ?, ?, ?, ?)',
+                               (key, record['url'], src, record['date'], ' '.join(record.get('assets') or ())))
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM pages WHERE key = ?', (key,))
+            self._conn.commit()
+
+
+class MongoBackend(object):
+    def __init__(self, conn, database='webcache', collection='webcache_test1'):
+        """
+        :param conn: pymongo MongoClient
+        """
+        self._collection = conn[database][collection]
+        self._collection.create_index('key', unique=True, sparse=True)
+
+    def get(self, key):
+        return self._collection.find_one({'key': key}, {'_id': False})
+
+    def put(self, key, record):
+        document = dict(record, key=key)
+        self._collection.update_one({'key': key}, {'$set': document}, upsert=True)
+
+    def delete(self, key):
+        self._collection.delete_one({'key': key})
+
+
+class _Flight(object):
+    """
+    One generation in progress, every caller asking for the same page waits on it
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PageCache(object):
+    def __init__(self, backend, generate, ttl=600, max_stale=24 * 3600, workers=4, store=None):
+        """
+        :param backend: MemoryBackend, SqliteBackend, MongoBackend or anything with get/put/delete
+        :param generate: generate(url) -> html, generate(url, device=device) for a page asked for with a device
+        :param ttl: seconds a page is served without regeneration
+        :param max_stale: seconds past ttl a page is still served while it is regenerated in the background
+        :param workers: background regeneration workers
+        :param store: AssetStore the inlined payloads are moved to, None stores pages as they are
+        """
+        self.backend = backend
+        self.generate = generate
+        self.store = store
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._counts = dict.fromkeys(('fresh', 'stale', 'misses', 'generations', 'errors'), 0)
+
+    def _record(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['in_flight'] = len(self._flights)
+        return stats
+
+    def get(self, url, ttl=None, device=None):
+        """
+        :param ttl: overrides the cache ttl for this lookup
+        :param device: device class of the client (tools/identifyUser.device_class), each has its own page
+        :return: html of url, possibly stale
+        """
+        ttl = self.ttl if ttl is None else ttl
+        key = page_key(url, device)
+        record = self.backend.get(key)
+        src = self._load(record)
+        if src is not None:
+            age = time.time() - record['date']
+            if age <= ttl:
+                self._record('fresh')
+                return src
+            if age <= ttl + self.max_stale:
+                self._record('stale')
+                self.refresh(url, device)
+                return src
+        self._record('misses')
+        flight, leader = self._join(key)
+        if leader:
+            self._run(flight, key, url, device)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def refresh(self, url, device=None):
+        """
+        Regenerate url on a background worker unless it is already being generated
+        """
+        key = page_key(url, device)
+        flight, leader = self._join(key)
+        if leader:
+            self._executor.submit(self._run, flight, key, url, device)
+        return flight
+
+    def invalidate(self, url, device=None):
+        key = page_key(url, device)
+        record = self.backend.get(key)
+        self.backend.delete(key)
+        self._release(record)
+
+    def _load(self, record):
+        """
+        :return: html of a stored record, None when there is none or one of its assets is gone
+        """
+        if record is None or record.get('src') is None:
+            return None
+        if self.store is None or not record.get('assets'):
+            return record['src']
+        try:
+            return self.store.internalize(record['src'])
+        except KeyError:
+            # AssetMissing, regenerate the page
+            return None
+
+    def _release(self, record):
+        if self.store is not None and record and record.get('assets'):
+            self.store.decref(record['assets'])
+
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _run(self, flight, key, url, device=None):
+        self._record('generations')
+        try:
+            html = self.generate(url) if device is None else self.generate(url, device=device)
+            record = {'url': url, 'device': device, 'src': html, 'date': time.time()}
+            if self.store is not None:
+                record['src'], record['assets'] = self.store.externalize(html)
+            old = self.backend.get(key)
+            self.backend.put(key, record)
+            self._release(old)
+            flight.result = html
+        except Exception as err:
+            # a failed regeneration keeps serving the stale page
+            self._record('errors')
+            flight.error = err
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+#  PageCache per MongoClient, shared by the modules generating pages
+#  a WeakKeyDictionary would never drop an entry: the MongoBackend of the cache holds the client
+_mongo_caches = {}  # MongoClient -> {generate: PageCache}
+_mongo_caches_lock = threading.Lock()
+
+
+def mongo_page_cache(conn, generate, store=None):
+    """
+    :param conn: pymongo MongoClient
+    :param generate: generate(url) -> html
+    :param store: AssetStore, see PageCache
+    :return: the PageCache of the pages of generate stored in conn, created on first use
+    """
+    with _mongo_caches_lock:
+        caches = _mongo_caches.setdefault(conn, {})
+        cache = caches.get(generate)
+        if cache is None:
+            cache = caches[generate] = PageCache(MongoBackend(conn), generate, store=store)
+        return cache
+
+
+def close_page_caches(conn=None, wait=True):
+    """
+    Stop the background workers of the caches of conn, of every cache when conn is None
+    """
+    with _mongo_caches_lock:
+        if conn is None:
+            closed = list(_mongo_caches.values())
+            _mongo_caches.clear()
+        else:
+            closed = [_mongo_caches.pop(conn, {})]
+    for caches in closed:
+        for cache in caches.values():
+            cache.close(wait=wait)
+
+
+atexit.register(close_page_caches, wait=False)
@@ -0,0 +1,403 @@
+# coding=utf-8
+"""
+Streaming single html assembly.
+
+generate() parses the page into a BeautifulSoup tree, rewrites it and serializes
+it with str(soup), so the whole page (and every base64 copy of every asset) sits
+in memory several times over and nothing can be sent before the last image is
+encoded.
+
+generate_stream() tokenizes the page instead and turns it into a list of segments:
+literal markup copied as is, and pending tags that need a sub-resource. The
+sub-resources are fetched by the FetchEngine in the background while the segments
+are written out in document order, each pending tag as soon as what it needs has
+arrived. The markup before the first stylesheet goes out right away and the
+rest follows at the speed of the slowest asset still ahead of it.
+
+    >>> with open('test.html', 'wb') as f:
+    ...     generate_stream('https://www.yahoo.co.jp', f)
+    >>> for chunk in iter_generate('https://www.yahoo.co.jp'):
+    ...     client.sendall(chunk)
+"""
+import datetime
+import re
+import threading
+
+try:
+    from HTMLParser import HTMLParser
+except ImportError:
+    from html.parser import HTMLParser
+
+import assetstore
+import inlinepolicy
+from fetchengine import ICON_RELS, css_urls, engine_for
+from htmlcombine import get, resolve, absurl, data_to_base64, handle_css_content, log
+
+re_title = re.compile(r'<title[^>]*>(.*?)</title>', re.I | re.S)
+
+
+def escape_attr(value):
+    return value.replace('&', '&amp;').replace('"', '&quot;').replace('<', '&lt;')
+
+
+def format_tag(tag, attrs, close=False):
+    """
+    :param attrs: list of (name, value), value None for bare attributes
+    :return: serialized start tag
+    """
+    parts = [tag]
+    for name, value in attrs:
+        parts.append(name if value is None else '%s="%s"' % (name, escape_attr(value)))
+    return '<%s%s>' % (' '.join(parts), ' /' if close else '')
+
+
+def to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+class ResourceBoard(object):
+    """
+    Results of the background fetch, readers block until the url they need is in
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.finished = False
+        self._cond = threading.Condition()
+
+    def put(self, url, result):
+        with self._cond:
+            self.results[url] = result
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def wait(self, urls):
+        """
+        Block until every url is fetched, or the fetch is over
+        """
+        with self._cond:
+            while not self.finished and any(url not in self.results for url in urls):
+                self._cond.wait()
+
+
+class Pending(object):
+    """
+    A tag whose output depends on sub-resources
+    :param render: render() -> markup, called once the urls are on the board
+    :param urls: urls render() reads, relative urls inside stylesheets are added by needs()
+    """
+
+    def __init__(self, render, urls=(), needs=None):
+        self.render = render
+        self.urls = [u for u in urls if u]
+        self.needs = needs
+
+
+class StreamAssembler(HTMLParser):
+    """
+    Split a page into literal markup and Pending tags, collecting the urls to fetch
+    """
+
+    def __init__(self, index, board, verbose=False, keep_script=True, full_url=True, comment=True, title='', budget=None):
+        try:
+            #  py3 unescapes the text by default, the entities have to be written back as they came
+            HTMLParser.__init__(self, convert_charrefs=False)
+        except TypeError:
+            HTMLParser.__init__(self)
+        self.index = index
+        self.board = board
+        self.budget = budget
+        self.verbose = verbose
+        self.keep_script = keep_script
+        self.full_url = full_url
+        self.comment = comment
+        self.title = title
+        self.segments = []
+        self.urls = []
+        self.stylesheets = set()
+        self._skip = None  # name of the element whose content is dropped
+        self._in_style = False
+        self._comment_done = False
+
+    #  collecting
+    def emit(self, s):
+        if self._skip:
+            return
+        if self.segments and isinstance(self.segments[-1], list):
+            self.segments[-1].append(s)
+        else:
+            self.segments.append([s])
+
+    def emit_pending(self, pending):
+        if self._skip:
+            return
+        self.segments.append(pending)
+        self.urls.extend(pending.urls)
+
+    def want(self, relpath, base=None, sheet=False):
+        if not relpath or relpath.strip().startswith('data:'):
+            return None
+        url = resolve(base or self.index, relpath)
+        if url and sheet:
+            self.stylesheets.add(url)
+        return url
+
+    def inline_css(self, base, css):
+        """
+        :return: Pending rendering css with its url()s inlined, relative to base
+        """
+        urls = [self.want(src, base) for src in css_urls(css)]
+        return Pending(lambda: handle_css_content(base, css, verbose=self.verbose, resources=self.board.results, budget=self.budget), urls)
+
+    #  HTMLParser callbacks
+    def handle_starttag(self, tag, attrs, close=False):
+        if self._skip:
+            return
+        a = dict(attrs)
+        text = self.get_starttag_text()
+        if tag == 'link' and a.get('href'):
+            self.handle_link(a, attrs, text)
+        elif tag == 'script':
+            self.handle_script(a, attrs, text, close)
+        elif tag == 'img' and a.get('src'):
+            self.handle_img(a, attrs, close)
+        elif tag == 'a' and self.full_url and a.get('href') is not None and not a['href'].startswith('#'):
+            attrs = [(k, absurl(self.index, v)) if k == 'href' else (k, v) for k, v in attrs]
+            self.handle_style(tag, attrs + [('data-href', a['href'])], close)
+        elif a.get('style'):
+            self.handle_style(tag, attrs, close)
+        else:
+            self.emit(text)
+        if tag == 'style' and not close:
+            self._in_style = True
+        if tag == 'html' and self.comment and not self._comment_done:
+            self._comment_done = True
+            self.emit('<!-- \n single html Orginal:https://github.com/zTrix/webpage2html\n Modified by https://github.com/YagiGo\n title: %s\n url: %s\n date: %s\n-->' % (
+                self.title, self.index, datetime.datetime.now().ctime()))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, close=True)
+
+    def handle_endtag(self, tag):
+        if self._skip:
+            if tag == self._skip:
+                self._skip = None
+            return
+        if tag == 'style':
+            self._in_style = False
+        self.emit('</%s>' % tag)
+
+    def handle_data(self, data):
+        if self._in_style and not self._skip and data.strip():
+            self.emit_pending(self.inline_css(self.index, data))
+        else:
+            self.emit(data)
+
+    def handle_entityref(self, name):
+        self.emit('&%s;' % name)
+
+    def handle_charref(self, name):
+        self.emit('&#%s;' % name)
+
+    def handle_comment(self, data):
+        self.emit('<!--%s-->' % data)
+
+    def handle_decl(self, decl):
+        self.emit('<!%s>' % decl)
+
+    def unknown_decl(self, data):
+        self.emit('<![%s]>' % data)
+
+    def handle_pi(self, data):
+        self.emit('<?%s>' % data)
+
+    #  tags
+    def handle_link(self, a, attrs, text):
+        href = a['href']
+        rel = (a.get('rel') or '').split()
+        if any(r in rel for r in ICON_RELS):
+            url = self.want(href)
+            attrs = [(k, v) for k, v in attrs if k != 'href'] + [('data-href', href)]
+            self.emit_pending(Pending(
+                lambda: format_tag('link', attrs + [('href', data_to_base64(self.index, href, verbose=self.verbose, resources=self.board.results, budget=self.budget))]),
+                [url]))
+        elif a.get('type') == 'text/css' or href.lower().endswith('.css') or 'stylesheet' in rel:
+            url = self.want(href, sheet=True)
+            style_attrs = [('type', a.get('type') or 'text/css'), ('data-href', href)] + \
+                          [(k, v) for k, v in attrs if k not in ('href', 'type')]
+
+            def needs():
+                #  the stylesheet is in, wait for its url()s too
+                css, _ = self.board.results.get(url) or ('', None)
+                return [resolve(url, src) for src in css_urls(css)]
+
+            def render():
+                css, _ = get(self.index, relpath=href, verbose=self.verbose, resources=self.board.results)
+                #  a stylesheet too big for the page stays a link, see inlinepolicy
+                if css and self.budget is not None and not self.budget.inline(absurl(self.index, href), 'text/css', len(css)):
+                    return format_tag('link', [(k, absurl(self.index, v)) if k == 'href' else (k, v) for k, v in attrs] +
+                                      [('data-href', href)])
+                return format_tag('style', style_attrs) + \
+                    handle_css_content(absurl(self.index, href), css, verbose=self.verbose, resources=self.board.results, budget=self.budget) + '</style>'
+            self.emit_pending(Pending(render, [url], needs))
+        elif self.full_url:
+            attrs = [(k, absurl(self.index, v)) if k == 'href' else (k, v) for k, v in attrs]
+            self.emit(format_tag('link', attrs + [('data-href', href)]))
+        else:
+            self.emit(text)
+
+    def handle_script(self, a, attrs, text, close):
+        if not self.keep_script:
+            if not close:
+                self._skip = 'script'
+            return
+        src = a.get('src')
+        if not src:
+            self.emit(text)
+            return
+        url = self.want(src)
+        new_type = a.get('type') or 'text/javascript'
+
+        def render():
+            js_str, _ = get(self.index, relpath=src, verbose=self.verbose, resources=self.board.results)
+            if js_str and self.budget is not None and not self.budget.inline(absurl(self.index, src), 'application/javascript', len(js_str)):
+                return format_tag('script', [(k, absurl(self.index, v)) if k == 'src' else (k, v) for k, v in attrs] +
+                                  [('data-src', src)]) + '</script>'
+            if js_str.find('</script>') > -1:
+                return format_tag('script', [('type', new_type), ('data-src', src),
+                                             ('src', assetstore.shared_store().data_uri(js_str, 'text/javascript'))]) + '</script>'
+            elif js_str.find(']]>') < 0:
+                js_str = '<!--//--><![CDATA[//><!--\n' + js_str + '\n//--><!]]>'
+            return format_tag('script', [('type', new_type), ('data-src', src)]) + js_str + '</script>'
+        self.emit_pending(Pending(render, [url]))
+        if not close:
+            #  the (empty) body and </script> of an external script are replaced as well
+            self._skip = 'script'
+
+    def handle_img(self, a, attrs, close):
+        src = a['src']
+        url = self.want(src)
+        attrs = [(k, v) for k, v in attrs if k not in ('src', 'srcset')] + [('data-src', src)]
+        if a.get('srcset'):
+            attrs.append(('data-srcset', a['srcset']))
+            if self.verbose: log('[WARN] srcset found in img tag. Attribute will be cleared. File src = %s' % src, 'yellow')
+        if a.get('style'):
+            style = self.inline_css(self.index, a['style'])
+            attrs = [(k, v) for k, v in attrs if k != 'style']
+        else:
+            style = None
+
+        def render():
+            extra = [('style', style.render())] if style else []
+            return format_tag('img', attrs + extra + [('src', data_to_base64(self.index, src, verbose=self.verbose, resources=self.board.results, budget=self.budget))], close)
+        self.emit_pending(Pending(render, [url] + (style.urls if style else [])))
+
+    def handle_style(self, tag, attrs, close):
+        """
+        Inline the url()s of a style attribute
+        """
+        style = dict(attrs).get('style')
+        if not style:
+            self.emit(format_tag(tag, attrs, close))
+            return
+        inline = self.inline_css(self.index, style)
+        self.emit_pending(Pending(
+            lambda: format_tag(tag, [(k, inline.render() if k == 'style' else v) for k, v in attrs], close), inline.urls))
+
+
+def iter_generate(index, verbose=False, comment=True, keep_script=True, full_url=True, verify=False, erropage=False,
+                  chunk_size=64 * 1024, max_workers=16, per_host=6, user_agent=None, budget=None):
+    """
+    Same output as generate(), produced incrementally
+    :param chunk_size: literal markup is buffered up to chunk_size bytes, pending tags flush the buffer first
+    :param budget: inlinepolicy.PageBudget, defaults to inlinepolicy.default_policy.start(user_agent)
+    :return: generator of byte chunks
+    """
+    if budget is None:
+        budget = inlinepolicy.default_policy.start(user_agent)
+    html_doc, extra_data = get(index, verbose=verbose, verify=verify, ignore_error=erropage)
+    if extra_data and extra_data.get('url'):
+        index = extra_data['url']
+    mo = re_title.search(html_doc or '')
+    board = ResourceBoard()
+    assembler = StreamAssembler(index, board, verbose=verbose, keep_script=keep_script, full_url=full_url,
+                                comment=comment, title=mo.group(1).strip() if mo else '', budget=budget)
+    assembler.feed(html_doc or '')
+    assembler.close()
+    segments, stylesheets = assembler.segments, assembler.stylesheets
+    #  the tokens are all that is needed from here on
+    del html_doc, assembler
+
+    def expand(url, result):
+        #  url() inside a stylesheet is relative to the stylesheet itself
+        if url not in stylesheets:
+            return []
+        css, _ = result
+        return [u for u in (resolve(url, src) for src in css_urls(css)) if u]
+
+    engine = engine_for(max_workers=max_workers, per_host=per_host)
+    urls = [u for segment in segments if isinstance(segment, Pending) for u in segment.urls]
+
+    def run():
+        try:
+            engine.fetch_all(urls, expand=expand, on_result=board.put, fetch=lambda url: get(url, verbose=verbose))
+        finally:
+            board.finish()
+    fetch_thread = threading.Thread(target=run, name='stream-fetch')
+    fetch_thread.daemon = True
+    fetch_thread.start()
+
+    buf, size = [], 0
+    for i, segment in enumerate(segments):
+        if isinstance(segment, list):
+            for s in segment:
+                s = to_bytes(s)
+                buf.append(s)
+                size += len(s)
+            segments[i] = None
+            if size >= chunk_size:
+                yield b''.join(buf)
+                buf, size = [], 0
+            continue
+        if not (segment.urls and all(u in board.results for u in segment.urls)) and buf:
+            #  about to block, let the client have what is ready
+            yield b''.join(buf)
+            buf, size = [], 0
+        board.wait(segment.urls)
+        if segment.needs:
+            board.wait([u for u in segment.needs() if u])
+        s = to_bytes(segment.render())
+        segments[i] = None
+        buf.append(s)
+        size += len(s)
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+    fetch_thread.join()
+
+
+def generate_stream(index, out, verbose=False, comment=True, keep_script=True, full_url=True, verify=False,
+                    erropage=False, chunk_size=64 * 1024, max_workers=16, per_host=6, user_agent=None, budget=None):
+    """
+    Write the single html page of index to out as it is assembled
+    :param out: file-like object with write(), or a socket (sendall is used)
+    :return: number of bytes written
+    """
+    write = out.sendall if hasattr(out, 'sendall') else out.write
+    written = 0
+    for chunk in iter_generate(index, verbose=verbose, comment=comment, keep_script=keep_script, full_url=full_url,
+                               verify=verify, erropage=erropage, chunk_size=chunk_size,
+                               max_workers=max_workers, per_host=per_host, user_agent=user_agent, budget=budget):
+        write(chunk)
+        if hasattr(out, 'flush'):
+            out.flush()
+        written += len(chunk)
+    return written
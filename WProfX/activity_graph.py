@@ -0,0 +1,171 @@
+#!/usr/bin/env python3.5
+"""
+Dependency graph of the activities of a Trace.
+
+Trace kept its activities in a networkx MultiDiGraph: every add_node copied the
+attribute dict of the activity, every add_edge made a dict of dicts, and
+dependency() read self.G.node[...]['startTime'] in its loops, an API that is
+gone from networkx >= 2.4. ActivityGraph numbers the activities 0..n-1 in the
+order they are added and keeps
+ - startTime / endTime / type in parallel arrays, the activity dict by reference
+ - the edges in arrays (source, target, startTime, endTime), indexed in CSR
+   form (offsets into the edges sorted by source, and by target) the first time
+   they are walked
+Activities are addressed by their id ('Networking_3') or by their number.
+to_networkx() builds the MultiDiGraph, for drawing only.
+
+    G = ActivityGraph()
+    G.add_node('Networking_0', {'startTime': 0.0, 'endTime': 20.0, ...})
+    G.add_node('Loading_0', {'startTime': 21.0, 'endTime': 21.4, ...})
+    G.add_edge('Networking_0', 'Loading_0', startTime=20.0, endTime=21.0)
+    G.start_of('Loading_0'), G.predecessors('Loading_0')
+"""
+from array import array
+
+NETWORKING, LOADING, SCRIPTING, OTHER = 0, 1, 2, 3
+_TYPES = (('Networking', NETWORKING), ('Loading', LOADING), ('Scripting', SCRIPTING))
+
+
+def activity_type(_nodeId):
+    for prefix, code in _TYPES:
+        if _nodeId.startswith(prefix):
+            return code
+    return OTHER
+
+
+class ActivityGraph(object):
+    def __init__(self):
+        self.graph = {}  # graph attributes: download_0, parse_0
+        self.ids = []
+        self.index = {}  # activity id -> number
+        self.data = []  # activity dicts, not copied
+        self.starts = array('d')
+        self.ends = array('d')
+        self.types = array('b')
+        self.edge_sources = array('l')
+        self.edge_targets = array('l')
+        self.edge_starts = array('d')
+        self.edge_ends = array('d')
+        self._csr = None
+
+    #  building
+    def add_node(self, _nodeId, _nodeData):
+        """
+        :return: number of the activity; adding it again only updates its data
+        """
+        n = self.index.get(_nodeId)
+        if n is not None:
+            self.data[n] = _nodeData
+            self.starts[n] = _nodeData['startTime']
+            self.ends[n] = _nodeData['endTime']
+            return n
+        n = len(self.ids)
+        self.index[_nodeId] = n
+        self.ids.append(_nodeId)
+        self.data.append(_nodeData)
+        self.starts.append(_nodeData['startTime'])
+        self.ends.append(_nodeData['endTime'])
+        self.types.append(activity_type(_nodeId))
+        return n
+
+    def add_edge(self, u, v, startTime=-1, endTime=-1):
+        """
+        Parallel edges are kept, like a MultiDiGraph
+        """
+        self.edge_sources.append(self.number(u))
+        self.edge_targets.append(self.number(v))
+        self.edge_starts.append(startTime)
+        self.edge_ends.append(endTime)
+        self._csr = None
+
+    #  activities
+    def number(self, n):
+        return n if isinstance(n, int) else self.index[n]
+
+    def __contains__(self, _nodeId):
+        return _nodeId in self.index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def number_of_edges(self):
+        return len(self.edge_sources)
+
+    def nodes(self):
+        return list(self.ids)
+
+    def start_of(self, n):
+        return self.starts[self.number(n)]
+
+    def end_of(self, n):
+        return self.ends[self.number(n)]
+
+    def type_of(self, n):
+        return self.types[self.number(n)]
+
+    def node_data(self, n):
+        return self.data[self.number(n)]
+
+    #  edges
+    def _index_edges(self):
+        # counting sort of the edge numbers by source and by target, stable so parallel edges keep their order
+        if self._csr is None:
+            self._csr = (self._offsets(self.edge_sources), self._offsets(self.edge_targets))
+        return self._csr
+
+    def _offsets(self, ends):
+        offsets = array('l', [0]) * (len(self.ids) + 1)
+        for n in ends:
+            offsets[n + 1] += 1
+        for i in range(len(self.ids)):
+            offsets[i + 1] += offsets[i]
+        edges = array('l', [0]) * len(ends)
+        fill = array('l', offsets[:-1])
+        for e, n in enumerate(ends):
+            edges[fill[n]] = e
+            fill[n] += 1
+        return offsets, edges
+
+    def out_edges(self, n):
+        """
+        :return: numbers of the edges leaving n, in the order they were added
+        """
+        (offsets, edges), _ = self._index_edges()
+        n = self.number(n)
+        return edges[offsets[n]:offsets[n + 1]]
+
+    def in_edges(self, n):
+        _, (offsets, edges) = self._index_edges()
+        n = self.number(n)
+        return edges[offsets[n]:offsets[n + 1]]
+
+    def successors(self, n):
+        return [self.ids[self.edge_targets[e]] for e in self.out_edges(n)]
+
+    def predecessors(self, n):
+        return [self.ids[self.edge_sources[e]] for e in self.in_edges(n)]
+
+    def edges(self, data=False):
+        """
+        :return: [(u, v)], [(u, v, {'startTime', 'endTime'})] with data
+        """
+        if data:
+            return [(self.ids[u], self.ids[v], {'startTime': s, 'endTime': e}) for u, v, s, e in
+                    zip(self.edge_sources, self.edge_targets, self.edge_starts, self.edge_ends)]
+        return [(self.ids[u], self.ids[v]) for u, v in zip(self.edge_sources, self.edge_targets)]
+
+    #  drawing
+    def to_networkx(self):
+        """
+        :return: networkx MultiDiGraph with a copy of the activity dicts, for visualization
+        """
+        import networkx as nx
+        G = nx.MultiDiGraph()
+        G.graph.update(self.graph)
+        for _nodeId, _nodeData in zip(self.ids, self.data):
+            G.add_node(_nodeId, **_nodeData)
+        G.add_edges_from(self.edges(data=True))
+        return G
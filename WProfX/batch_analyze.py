@@ -0,0 +1,264 @@
+#!/usr/bin/env python3.5
+"""
+Batch analysis of every trace under an output tree.
+
+analyze.py walks one hard-coded experiment directory serially, and one bad trace
+stops the whole walk. Here
+ - every <tree>/.../run_*/trace/* file is found (plain or .gz)
+ - traces are analyzed on up to --workers processes, one process per trace: a
+   trace that crashes its analysis, or runs past --timeout, is recorded as
+   failed / timeout and the batch goes on
+ - each analysis is written to run_*/analysis/<trace>.json, as analyze.py does
+ - a manifest (sha256 of the trace -> result) lets a re-run skip the traces
+   already analyzed, and summary.csv gets one row per trace
+
+    python3 batch_analyze.py desktop_livetest --workers 8 --timeout 300
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+# imported once here, the forked workers inherit it
+import trace_parser as tp
+
+MANIFEST = 'analysis_manifest.json'
+SUMMARY = 'summary.csv'
+SUMMARY_FIELDS = ['site', 'run', 'trace', 'status', 'load', 'cpu_time', 'networks', 'scripts', 'loadings',
+                  'critical_path', 'networkingTime', 'computationTime', 'seconds', 'error']
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def trace_name(trace_file):
+    return os.path.basename(trace_file).split('.trace')[0]
+
+
+def discover(tree):
+    """
+    :return: sorted paths of the files in every run_*/trace directory under tree
+    """
+    traces = []
+    for root, dirs, files in os.walk(tree):
+        dirs.sort()
+        if os.path.basename(root) == 'trace' and os.path.basename(os.path.dirname(root)).startswith('run_'):
+            traces.extend(os.path.join(root, f) for f in sorted(files) if not f.startswith('.'))
+    return traces
+
+
+def load_time(run_dir, start_ts):
+    """
+    :return: onload in ms from the start of the trace, from summary/*.times; None without one
+    """
+    summary_dir = os.path.join(run_dir, 'summary')
+    if not os.path.isdir(summary_dir):
+        return None
+    _time = None
+    for _f in sorted(os.listdir(summary_dir)):
+        if _f.endswith('times'):
+            with open(os.path.join(summary_dir, _f)) as _t:
+                for line in _t:
+                    if line.strip():
+                        _time = json.loads(line)
+    if not _time or 'load' not in _time:
+        return None
+    return round(((float(_time['load']) * 1000000) - float(start_ts)) / 1000, 2)
+
+
+def analyze_trace(trace_file, output_file):
+    """
+    Analyze one trace and write its json, in a worker process
+    :return: summary row
+    """
+    run_dir = os.path.dirname(os.path.dirname(trace_file))
+    row = {'site': os.path.basename(os.path.dirname(run_dir)), 'run': os.path.basename(run_dir),
+           'trace': trace_name(trace_file)}
+    start = time.time()
+    trace = tp.Trace(trace_file)
+    # trace_parser prints every node and edge it creates
+    with open(os.devnull, 'w') as devnull:
+        _stdout, sys.stdout = sys.stdout, devnull
+        try:
+            _result, _start_ts, _cpu_times = trace.analyze()
+        finally:
+            sys.stdout = _stdout
+    if not _result or not _start_ts or not _cpu_times:
+        raise ValueError('Incomplete trace file')
+    _load_time = load_time(run_dir, _start_ts)
+    _result.insert(0, {'load': _load_time, 'cpu_time': _cpu_times.get('total_usecs')})
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    trace.WriteJson(output_file, _result)
+    row.update({'status': 'ok', 'load': _load_time, 'cpu_time': _cpu_times.get('total_usecs'),
+                'networks': len(trace.networks_list), 'scripts': len(trace.scripts_list),
+                'loadings': len(trace.loading_list), 'critical_path': len(trace.critical_path),
+                'networkingTime': trace.networkingTime, 'computationTime': trace.computationTime,
+                'seconds': round(time.time() - start, 3)})
+    return row
+
+
+def _worker(conn, trace_file, output_file):
+    try:
+        conn.send(('ok', analyze_trace(trace_file, output_file)))
+    except BaseException as e:
+        conn.send(('failed', '%s: %s\n%s' % (e.__class__.__name__, e, traceback.format_exc(limit=5))))
+    finally:
+        conn.close()
+
+
+class BatchAnalyzer(object):
+    def __init__(self, tree, workers=None, timeout=300, manifest=None, summary=None, graphs_dir=None, force=False):
+        """
+        :param tree: output tree holding <site>/run_*/trace/*
+        :param workers: traces analyzed at the same time, default the cpu count
+        :param timeout: seconds one trace may take before its process is killed
+        :param manifest: manifest path, default <tree>/analysis_manifest.json
+        :param summary: summary table path, default <tree>/summary.csv
+        :param graphs_dir: where the analysis jsons are also copied (the WProfX graphs directory)
+        :param force: analyze traces the manifest already has
+        """
+        self.tree = tree
+        self.workers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.manifest_file = manifest or os.path.join(tree, MANIFEST)
+        self.summary_file = summary or os.path.join(tree, SUMMARY)
+        self.graphs_dir = graphs_dir
+        self.force = force
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+    @staticmethod
+    def output_file(trace_file):
+        run_dir = os.path.dirname(os.path.dirname(trace_file))
+        return os.path.join(run_dir, 'analysis', trace_name(trace_file) + '.json')
+
+    def pending(self):
+        """
+        :return: [(sha256, trace file)] of the traces to analyze
+        """
+        jobs = []
+        for trace_file in discover(self.tree):
+            digest = file_hash(trace_file)
+            entry = self.manifest.get(digest)
+            if not self.force and entry and entry['status'] == 'ok' and os.path.exists(entry['output']):
+                logging.info('Already analyzed: ' + trace_file)
+                continue
+            jobs.append((digest, trace_file))
+        return jobs
+
+    def record(self, digest, trace_file, status, row):
+        row = dict(row)
+        row['status'] = status
+        output = self.output_file(trace_file)
+        self.manifest[digest] = {'trace': os.path.relpath(trace_file, self.tree), 'output': output,
+                                 'status': status, 'analyzed': time.time(), 'summary': row}
+        if status == 'ok' and self.graphs_dir:
+            shutil.copy(output, self.graphs_dir)
+        # rewritten after every trace, an interrupted batch keeps what it did
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest_file)
+
+    def run(self):
+        """
+        :return: {status: count} of the traces analyzed by this run
+        """
+        jobs = self.pending()
+        logging.info('%d traces to analyze on %d processes' % (len(jobs), self.workers))
+        counts = {'ok': 0, 'failed': 0, 'timeout': 0}
+        running = {}  # connection -> (process, digest, trace file, deadline)
+        while jobs or running:
+            while jobs and len(running) < self.workers:
+                digest, trace_file = jobs.pop(0)
+                reader, writer = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_worker, args=(writer, trace_file,
+                                                                        self.output_file(trace_file)))
+                process.daemon = True
+                process.start()
+                writer.close()
+                running[reader] = (process, digest, trace_file, time.time() + self.timeout)
+            next_deadline = min(job[3] for job in running.values())
+            for reader in wait(list(running), timeout=max(0, next_deadline - time.time())):
+                process, digest, trace_file, _ = running.pop(reader)
+                try:
+                    status, result = reader.recv()
+                except EOFError:
+                    # killed, or died without a word (out of memory)
+                    status, result = 'failed', 'worker exited with code %s' % process.exitcode
+                reader.close()
+                process.join()
+                self.finished(digest, trace_file, status, result, counts)
+            now = time.time()
+            for reader, (process, digest, trace_file, deadline) in list(running.items()):
+                if now >= deadline:
+                    process.terminate()
+                    process.join()
+                    reader.close()
+                    del running[reader]
+                    self.finished(digest, trace_file, 'timeout', 'no result after %ss' % self.timeout, counts)
+        self.write_summary()
+        return counts
+
+    def finished(self, digest, trace_file, status, result, counts):
+        counts[status] += 1
+        if status == 'ok':
+            logging.info('Analyzed %s in %ss' % (trace_file, result['seconds']))
+            row = result
+        else:
+            logging.warning('%s: %s %s' % (status, trace_file, result))
+            run_dir = os.path.dirname(os.path.dirname(trace_file))
+            row = {'site': os.path.basename(os.path.dirname(run_dir)), 'run': os.path.basename(run_dir),
+                   'trace': trace_name(trace_file), 'error': result.strip().splitlines()[0]}
+        self.record(digest, trace_file, status, row)
+
+    def write_summary(self):
+        """
+        One row per trace of the manifest, this run's and the earlier ones
+        """
+        rows = sorted((entry['summary'] for entry in self.manifest.values()),
+                      key=lambda row: (row.get('site', ''), row.get('run', ''), row.get('trace', '')))
+        with open(self.summary_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze every run_*/trace/* under an output tree')
+    parser.add_argument('tree', help='output tree, e.g. desktop_livetest')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='traces analyzed at the same time')
+    parser.add_argument('-t', '--timeout', type=float, default=300, help='seconds allowed per trace')
+    parser.add_argument('--manifest', help='manifest file, default <tree>/' + MANIFEST)
+    parser.add_argument('--summary', help='summary table, default <tree>/' + SUMMARY)
+    parser.add_argument('--graphs', help='directory the analysis jsons are copied to')
+    parser.add_argument('-f', '--force', action='store_true', help='analyze traces already in the manifest')
+    args = parser.parse_args(argv)
+    batch = BatchAnalyzer(args.tree, args.workers, args.timeout, args.manifest, args.summary, args.graphs,
+                          args.force)
+    start = time.time()
+    counts = batch.run()
+    logging.info('%s in %.1fs, summary: %s' % (counts, time.time() - start, batch.summary_file))
+    return 0 if not counts['failed'] and not counts['timeout'] else 1
+
+
+if __name__ == '__main__':
+    import coloredlogs
+    coloredlogs.install(level='INFO')
+    sys.exit(main())
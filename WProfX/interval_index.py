@@ -0,0 +1,70 @@
+#!/usr/bin/env python3.5
+"""
+Time-sorted index of activities for the dependency lookups of trace_parser.
+
+Trace.dependency() asks, for every activity, for the network / script / parse
+activity that precedes it: the one that started before it with the end closest
+to its start. find_url, find_parse_id and find_scripting_id answered that by
+scanning every candidate, which made dependency() quadratic in the number of
+activities. IntervalIndex keeps the candidates sorted by startTime, with the
+running maximum of endTime, so a query is a bisect on the start plus a walk
+back over the activities that can still be closer, and keeps them sorted by
+endTime for the range query of find_blocking_css.
+Results are those of the scans, ties going to the activity first in the list.
+
+    index = IntervalIndex((_id, data['startTime'], data['endTime']) for _id, data in scripts_list)
+    index.closest_before(activity['startTime'])
+"""
+from bisect import bisect_left, bisect_right
+
+
+class IntervalIndex(object):
+    def __init__(self, activities):
+        """
+        :param activities: (id, startTime, endTime), ordered by startTime
+        """
+        self.ids = []
+        self.starts = []
+        self.ends = []
+        self.max_ends = []  # max_ends[i] = max(ends[:i + 1])
+        for _id, _startTime, _endTime in activities:
+            if self.starts and _startTime < self.starts[-1]:
+                raise ValueError('activities are not sorted by startTime: ' + str(_id))
+            self.ids.append(_id)
+            self.starts.append(_startTime)
+            self.ends.append(_endTime)
+            self.max_ends.append(_endTime if not self.max_ends else max(self.max_ends[-1], _endTime))
+        self._by_end = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def closest_before(self, time, end_before=None):
+        """
+        :param time: startTime of the activity
+        :param end_before: only activities ending before it, when given
+        :return: id of the activity started before time with the end closest to time, None if there is none
+        """
+        selected = None
+        best = float('inf')
+        i = bisect_left(self.starts, time) - 1
+        #  nothing further back can end within best of time
+        while i >= 0 and self.max_ends[i] >= time - best:
+            _endTime = self.ends[i]
+            if end_before is None or _endTime < end_before:
+                diff = abs(time - _endTime)
+                if diff <= best:
+                    selected = i
+                    best = diff
+            i -= 1
+        return None if selected is None else self.ids[selected]
+
+    def ending_between(self, after, before):
+        """
+        :return: ids of the activities with after < endTime < before, in index order
+        """
+        if self._by_end is None:
+            order = sorted(range(len(self.ids)), key=lambda i: self.ends[i])
+            self._by_end = ([self.ends[i] for i in order], order)
+        ends, order = self._by_end
+        return [self.ids[i] for i in sorted(order[bisect_right(ends, after):bisect_left(ends, before)])]
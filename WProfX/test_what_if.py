@@ -0,0 +1,94 @@
+#!/usr/bin/env python3.5
+"""
+WhatIfEngine on small hand-made dependency graphs, python3 -m unittest test_what_if
+"""
+import random
+import unittest
+
+from what_if import Scenario, WhatIfEngine, compress
+
+
+class FakeTrace(object):
+    # what WhatIfEngine reads from an analyzed Trace
+    def __init__(self, activities, deps_parent):
+        self.all_dict = activities
+        self.deps_parent = deps_parent
+
+
+def page():
+    # HTML -> parse -> JS download -> eval, the eval also waiting on the parse
+    activities = {
+        'Networking_0': {'startTime': 0.0, 'endTime': 20.0, 'mimeType': 'text/html', 'url': 'https://a.com/'},
+        'Loading_0': {'startTime': 21.0, 'endTime': 30.0, 'name': 'ParseHTML'},
+        'Networking_1': {'startTime': 25.0, 'endTime': 85.0, 'mimeType': 'application/javascript',
+                         'url': 'https://a.com/app.js'},
+        'Scripting_0': {'startTime': 86.0, 'endTime': 90.0, 'url': 'https://a.com/app.js'},
+    }
+    deps_parent = {
+        'Loading_0': [('Networking_0', 20.0)],
+        'Networking_1': [('Loading_0', 25.0)],
+        'Scripting_0': [('Loading_0', 30.0), ('Networking_1', 85.0)],
+    }
+    return FakeTrace(activities, deps_parent)
+
+
+def full_retime(engine, durations):
+    # every activity re-timed in topological order, what retime() must match
+    times = {}
+    for _id in engine.order:
+        _startTime = engine.start[_id]
+        if engine.parents.get(_id):
+            _last = max(engine.new_trigger(_pId, _trigger, times) for _pId, _trigger in engine.parents[_id])
+            if _last != engine.last_trigger[_id]:
+                _startTime = _last + (engine.start[_id] - engine.last_trigger[_id])
+        times[_id] = (_startTime, _startTime + durations.get(_id, engine.end[_id] - engine.start[_id]))
+    return times
+
+
+class WhatIfTest(unittest.TestCase):
+    def test_baseline(self):
+        engine = WhatIfEngine(page())
+        result, = engine.evaluate([Scenario('none', lambda _id, data: None)])
+        self.assertEqual(result.load, 90.0)
+        self.assertEqual(result.saving, 0)
+        self.assertEqual(result.retimed, 0)
+        self.assertEqual(result.critical_path, ['Networking_0', 'Loading_0', 'Networking_1', 'Scripting_0'])
+
+    def test_unmoved_parent_does_not_hold_back_a_multi_parent_activity(self):
+        engine = WhatIfEngine(page())
+        result, = engine.evaluate([compress(ratio=6)])  # 60 ms download -> 10 ms
+        self.assertEqual(result.changed, 1)
+        self.assertAlmostEqual(result.saving, 50.0)
+        self.assertAlmostEqual(result.load, 40.0)
+        self.assertEqual(result.critical_path, ['Networking_0', 'Loading_0', 'Networking_1', 'Scripting_0'])
+
+    def test_parent_off_the_critical_path_becomes_critical(self):
+        engine = WhatIfEngine(page())
+        result, = engine.evaluate([compress(ratio=600)])  # 0.1 ms: the eval now waits on the parse
+        self.assertAlmostEqual(result.load, 35.0)
+        self.assertEqual(result.critical_path, ['Networking_0', 'Loading_0', 'Scripting_0'])
+
+    def test_incremental_matches_full_retime(self):
+        rng = random.Random(7)
+        activities = {}
+        deps_parent = {}
+        for i in range(300):
+            _startTime = i * 3.0 + rng.random()
+            activities['Loading_%d' % i] = {'startTime': _startTime, 'endTime': _startTime + rng.uniform(0, 20)}
+            if i:
+                parents = rng.sample(range(max(0, i - 10), i), min(i, rng.randint(1, 3)))
+                deps_parent['Loading_%d' % i] = [
+                    ('Loading_%d' % p, min(activities['Loading_%d' % p]['endTime'], _startTime)) for p in parents]
+        engine = WhatIfEngine(FakeTrace(activities, deps_parent))
+        for seed in range(20):
+            picked = set(rng.sample(sorted(activities), 5))
+            scenario = Scenario('halve %d' % seed, lambda _id, data: (data['endTime'] - data['startTime']) / 2
+                                if _id in picked else None)
+            durations, times = engine.retime(scenario)
+            expected = full_retime(engine, durations)
+            for _id in engine.order:
+                self.assertEqual(times.get(_id, (engine.start[_id], engine.end[_id])), expected[_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,7 +30,6 @@ import time
 import sys
 import csv
 from urllib.parse import urldefrag
-import networkx as nx
 import matplotlib.pyplot as plt
 import tldextract
 
@@ -38,9 +37,11 @@ import tldextract
 # try a fast json parser if it is installed
 from collections import defaultdict
 
-from networkx.readwrite import json_graph
-
 import waterfall_draw
+from trace_reader import iter_trace_events, TimestampMerger
+from interval_index import IntervalIndex
+from activity_graph import ActivityGraph
+from what_if import WhatIfEngine
 
 try:
     import ujson as json
@@ -72,6 +73,7 @@ class Trace():
         self.netlog_trace_events = []
         self.painting_trace_events = []
         self.rendering_trace_events = []
+        self.trace_read = False
         self.networks = {}
         self.networks_list = []
         self.networks_lookup_url = {}
@@ -80,6 +82,11 @@ class Trace():
         self.loading_list = []
         self.loading_lookup_url = {}
         self.loading_lookup_id = {}
+        self.networks_url_index = {}
+        self.scripts_url_index = {}
+        self.parse_html_index = None
+        self.scripting_index = None
+        self.css_index = None
         self.painting = {}
         self.painting_list = []
         self.rendering = {}
@@ -102,10 +109,11 @@ class Trace():
         self.feature_usage = None
         self.feature_usage_start_time = None
         self.netlog = {'bytes_in': 0, 'bytes_out': 0, 'ssl_bytes_in': 0, 'ssl_bytes_out': 0}
-        self.G = nx.MultiDiGraph()
+        self.G = ActivityGraph()
         self.deps = []
         self.deps_parent = {}
         self.critical_path = []
+        self.what_if_engine = None
         self.visited = []
         self.fringe = []
         self.mark = {}
@@ -294,41 +302,46 @@ class Trace():
 
         if f is not None:
             f.close()"""
-        with open(self.trace, 'r') as content_file:
-            content = content_file.read()
-        trace_events = json.loads(content)
-        for trace_event in trace_events:
-            trace_event = json.loads(trace_event)
-            try:
-                cat = trace_event['cat']
-                name = trace_event['name']
-                if (cat == 'devtools.timeline' and name == 'ParseHTML') or (
-                                cat == 'blink,devtools.timeline' and name == 'ParseAuthorStyleSheet'):
-                    self.loading_trace_events.append(trace_event)
-                ### removed to speed up plotting tests
-                if (cat == 'disabled-by-default-devtools.timeline' or cat.find('devtools.timeline') >= 0) \
-                        and name in ['CompositeLayers', 'Paint']:
-                    self.painting_trace_events.append(trace_event)
-                if (cat == 'devtools.timeline' or cat.find('devtools.timeline') >= 0) \
-                        and name in ['Layout', 'UpdateLayerTree', 'HitTest', 'RecalculateStyles']:
-                    self.rendering_trace_events.append(trace_event)
-                if cat == 'devtools.timeline' and \
-                        (name in ['ResourceSendRequest', 'ResourceReceiveResponse', 'ResourceReceivedData',
-                                  'ResourceFinish']):
-                    self.network_trace_events.append(trace_event)
-                if cat == 'netlog':
-                    self.netlog_trace_events.append(trace_event)
-            except:
-                raise
-
-        self.network_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
-        self.rendering_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
-        self.loading_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
-        self.painting_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
-        self.netlog_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
+        if not self.trace_read:
+            self.ReadTrace()
         # Convert the source event id to hex if one exists in netlog
         self.convertIdtoHex(self.netlog_trace_events)
 
+    def ReadTrace(self):
+        """
+        One pass over the trace file: every event is decoded once and routed to all the lists it belongs to,
+        each list merged by timestamp at the end. Events nobody keeps are dropped as they are read.
+        """
+        buckets = {name: TimestampMerger() for name in ('trace', 'loading', 'painting', 'rendering', 'network',
+                                                        'netlog')}
+        for trace_event in iter_trace_events(self.trace):
+            cat = trace_event['cat']
+            name = trace_event['name']
+            timeline = cat.find('devtools.timeline') >= 0
+            if cat != 'toplevel' and cat != 'ipc,toplevel' and \
+                    (timeline or cat.find('blink.feature_usage') >= 0 or cat.find('blink.user_timing') >= 0):
+                buckets['trace'].add(trace_event)
+            # Process*Events rewrite 'ts' and 'dur' in place: they get their own copy
+            if (cat == 'devtools.timeline' and name == 'ParseHTML') or (
+                    cat == 'blink,devtools.timeline' and name == 'ParseAuthorStyleSheet'):
+                buckets['loading'].add(dict(trace_event))
+            elif timeline and name in ('CompositeLayers', 'Paint'):
+                buckets['painting'].add(dict(trace_event))
+            elif timeline and name in ('Layout', 'UpdateLayerTree', 'HitTest', 'RecalculateStyles'):
+                buckets['rendering'].add(dict(trace_event))
+            elif cat == 'devtools.timeline' and name in ('ResourceSendRequest', 'ResourceReceiveResponse',
+                                                         'ResourceReceivedData', 'ResourceFinish'):
+                buckets['network'].add(trace_event)
+            elif cat == 'netlog':
+                buckets['netlog'].add(trace_event)
+        self.trace_events = buckets['trace'].merge()
+        self.loading_trace_events = buckets['loading'].merge()
+        self.painting_trace_events = buckets['painting'].merge()
+        self.rendering_trace_events = buckets['rendering'].merge()
+        self.network_trace_events = buckets['network'].merge()
+        self.netlog_trace_events = buckets['netlog'].merge()
+        self.trace_read = True
+
     def convertIdtoHex(self, _trace):
         for trace_event in _trace:
             if 'args' in trace_event and 'id' in trace_event and 'name' in trace_event and 'source_type' in trace_event[
@@ -341,15 +354,8 @@ class Trace():
         return _trace
 
     def Process(self):
-        with open(self.trace, 'r') as content_file:
-            content = content_file.read()
-        trace_events = json.loads(content)
-        for trace_event in trace_events:
-            trace_event = json.loads(trace_event)
-            try:
-                self.FilterTraceEvent(trace_event)
-            except:
-                raise
+        if not self.trace_read:
+            self.ReadTrace()
         """f = None
         line_mode = False
         self.__init__()
@@ -992,20 +998,18 @@ class Trace():
 
 
     def find_critical_path_mod(self, source):
-        self.critical_path += [source]
-        if source in self.deps_parent:
-            source = self.find_cp_max_end(self.deps_parent_mod[source])
-            return self.find_critical_path_mod(source)
-        else:
-            return
-
-    def find_critical_path(self, source):
-        self.critical_path += [source]
-        if source in self.deps_parent:
-            source = self.find_cp_max_end(self.deps_parent[source])
-            return self.find_critical_path(source)
-        else:
-            return
+        return self.find_critical_path(source, self.deps_parent_mod)
+
+    def find_critical_path(self, source, deps_parent=None):
+        # walk back through the parent triggering last, a loop rather than recursion for long chains
+        deps_parent = self.deps_parent if deps_parent is None else deps_parent
+        _visited = set()
+        while source is not None and source not in _visited:
+            _visited.add(source)
+            self.critical_path += [source]
+            if source not in deps_parent:
+                return
+            source = self.find_cp_max_end(deps_parent[source])
 
     def find_critical_path_old(self, source, download_0=None):
         # this version uses max prev trigger time. Need to consider duration.
@@ -1129,9 +1133,30 @@ class Trace():
             self.all_modified_dict[_item[0]] = _item[1]
         _tmp_merged = max_net_time + max_load_time + max_script_time
         self.last_activity = sorted(_tmp_merged, key=lambda tup: tup[1], reverse=True)
+        self.build_lookup_indexes()
         # print(_tmp_merged)
         # print('Last activity: ' + str(self.last_activity[0]))
 
+    def build_lookup_indexes(self):
+        # interval indexes of the lookups of dependency(), over the lists sorted above
+        def _index(ids, lookup):
+            return IntervalIndex((_id, lookup[_id]['startTime'], lookup[_id]['endTime']) for _id in ids)
+
+        self.networks_url_index = dict((_url, _index(ids, self.networks_lookup_id))
+                                       for _url, ids in self.networks_lookup_url.items())
+        self.scripts_url_index = dict((_url, _index(ids, self.scripts_lookup_id))
+                                      for _url, ids in self.scripts_lookup_url.items())
+        self.parse_html_index = IntervalIndex((load_id, load_data['startTime'], load_data['endTime'])
+                                              for load_id, load_data in self.loading_list
+                                              if load_data['name'].startswith('ParseHTML') and
+                                              load_data['url'] not in ['', 'about:blank'])
+        self.css_index = IntervalIndex((load_id, load_data['startTime'], load_data['endTime'])
+                                       for load_id, load_data in self.loading_list
+                                       if load_data['name'].startswith('ParseAuthorStyleSheet'))
+        self.scripting_index = IntervalIndex((script_id, script_data['startTime'], script_data['endTime'])
+                                             for script_id, script_data in self.scripts_list
+                                             if script_data['url'] not in ['', 'about:blank'])
+
     def order_layout(self):
         i = 0
         for net_obj in self.networks_list:
@@ -1202,7 +1227,7 @@ class Trace():
             #print(self.all)
             if obj[0].startswith('Networking') or obj[0].startswith('Loading') or obj[0].startswith('Scripting'):
                 print('obj0: {0} \n obj1: {1}'.format(obj[0], obj[1]))
-                self.G.add_node(obj[0], obj[1]) # can only run under version 2.0!!!
+                self.G.add_node(obj[0], obj[1])
         return True
 
     def edge_start(self, e1, s2):
@@ -1229,84 +1254,38 @@ class Trace():
     def find_url(self, _url, activitiy_data, _type):
         activity_startTime = activitiy_data['startTime']
         activity_endTime = activitiy_data['endTime']
-        selected = ['', float('inf')]
         if _type == 'network':
-            for net_id in self.networks_lookup_url[_url]:
-                net_startTime = self.networks_list[int(net_id.split('_')[1])][1]['startTime']
-                net_endTime = self.networks_list[int(net_id.split('_')[1])][1]['endTime']
-                if activity_startTime > net_startTime and activity_endTime > net_endTime:
-                    diff = abs(activity_startTime - net_endTime)
-                    if diff < selected[1]:
-                        selected = [net_id, diff]
-            return selected[0]
+            selected = self.networks_url_index[_url].closest_before(activity_startTime, end_before=activity_endTime)
+            return selected or ''
         elif _type == 'script':
-            # print(self.scripts_lookup_url[_url])
-            for s_id in self.scripts_lookup_url[_url]:
-                _startTime = self.scripts_list[int(s_id.split('_')[1])][1]['startTime']
-                _endTime = self.scripts_list[int(s_id.split('_')[1])][1]['endTime']
-                # print(_startTime, _endTime)
-                if activity_startTime > _startTime:
-                    diff = abs(activity_startTime - _endTime)
-                    if diff < selected[1]:
-                        selected = [s_id, diff]
-            if selected[0] == '':
-                print('script', self.scripts_lookup_url[_url], _startTime, _endTime, _url, activitiy_data)
+            _index = self.scripts_url_index[_url]
+            selected = _index.closest_before(activity_startTime)
+            if selected is None:
+                print('script', self.scripts_lookup_url[_url], _index.starts[-1], _index.ends[-1], _url,
+                      activitiy_data)
                 exit()
-            return selected[0]
+            return selected
 
     #JavaScript execution is blocked until CSS is fetched and then CSSOM is built then finish js and build the DOM
     # Find all Scripting's download activities that their download time is before CSS execution --> add dep css_eval--> js_eval
     def find_blocking_css(self, js_networking_endTime, js_scripting_endTime):
-        id_list = []
-        for loadings in self.loading_list:
-            load_id = loadings[0]
-            load_data = loadings[1]
-            load_name = load_data['name']
-            if load_name.startswith('ParseAuthorStyleSheet'):
-                _css_endTime = load_data['endTime']
-                if _css_endTime > js_networking_endTime and _css_endTime < js_scripting_endTime:
-                    id_list.append(load_id)
-        return id_list
+        return self.css_index.ending_between(js_networking_endTime, js_scripting_endTime)
 
     # Find latest parse HTML before activity
     def find_parse_id(self, activitiy_data):
-        activity_startTime = activitiy_data['startTime']
-        selected = ['', float('inf')]
-        for loadings in self.loading_list:
-            load_id = loadings[0]
-            load_data = loadings[1]
-            load_name = load_data['name']
-            if load_name.startswith('ParseHTML'):
-                _startTime = load_data['startTime']
-                _endTime = load_data['endTime']
-                _url = load_data['url']
-                if _url not in ['', 'about:blank'] and activity_startTime > _startTime:
-                    diff = abs(activity_startTime - _endTime)
-                    if diff < selected[1]:
-                        selected = [load_id, diff]
-        if selected[0] in ['', None]:
-            print(selected[0], activitiy_data)
+        selected = self.parse_html_index.closest_before(activitiy_data['startTime'])
+        if selected in ['', None]:
+            print(selected, activitiy_data)
             return ''
-        return selected[0]
+        return selected
 
     # Find latest scripting before parsing
     def find_scripting_id(self, activitiy_data):
-        activity_startTime = activitiy_data['startTime']
-        selected = ['', float('inf')]
-        for scriptings in self.scripts_list:
-            script_id = scriptings[0]
-            script_data = scriptings[1]
-            _startTime = script_data['startTime']
-            _endTime = script_data['endTime']
-            _url = script_data['url']
-            if _url not in ['', 'about:blank'] and activity_startTime > _startTime:
-                diff = abs(activity_startTime - _endTime)
-                if diff < selected[1]:
-                    selected = [script_id, diff]
-        if selected[0] in ['', None]:
-            print(selected[0], activitiy_data)
+        selected = self.scripting_index.closest_before(activitiy_data['startTime'])
+        if selected in ['', None]:
+            print(selected, activitiy_data)
             return None
-        return selected[0]
+        return selected
 
 
     def crp_analysis(self):
@@ -1318,9 +1297,9 @@ class Trace():
             _nodeId = self.critical_path[i]
             _prev = self.critical_path[i - 1]
             if i == cr_len - 1:
-                duration = self.G.node[_nodeId]['endTime'] - self.G.node[_nodeId]['startTime']
+                duration = self.G.end_of(_nodeId) - self.G.start_of(_nodeId)
             else:
-                duration = _endTime - self.G.node[_nodeId]['startTime']
+                duration = _endTime - self.G.start_of(_nodeId)
             # Calculate triggerTime for prev
             for _tup in self.deps_parent[_nodeId]:
                 if _tup[0] == _prev:
@@ -1331,7 +1310,7 @@ class Trace():
                 _networkingTime += duration
             else:
                 _computationTime += duration
-        duration = _endTime - self.G.node[_prev]['startTime']
+        duration = _endTime - self.G.start_of(_prev)
         if _nodeId.startswith('Networking'):
             _networkingTime += duration
         else:
@@ -1351,14 +1330,14 @@ class Trace():
             return False
         _parse0Id = self.G.graph['parse_0']
         print(_download0Id,_parse0Id)
-        a2_startTime, a1_triggered = self.edge_start(self.G.node[_download0Id]['endTime'],
-                                                     self.G.node[_parse0Id]['startTime'])
+        a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_download0Id),
+                                                     self.G.start_of(_parse0Id))
         self.G.add_edge(_download0Id, _parse0Id,
                         startTime=a2_startTime,
-                        endTime=self.G.node[_parse0Id]['startTime'])
+                        endTime=self.G.start_of(_parse0Id))
         self.deps.append({'time': a1_triggered, 'a1': _download0Id, 'a2': _parse0Id})
         if a1_triggered == -1:
-            a1_triggered = self.G.node[_download0Id]['endTime']
+            a1_triggered = self.G.end_of(_download0Id)
         self.deps_parent.setdefault(_parse0Id, []).append((_download0Id, a1_triggered))
         for obj in self.all:
             _nodeId = obj[0]
@@ -1368,20 +1347,19 @@ class Trace():
             ###
             if _nodeId.startswith('Networking') or _nodeId.startswith('Loading') or _nodeId.startswith('Scripting'):
                 if _nodeId.startswith('Networking'):
-                    if _nodeData['fromScript'] in ['Null', None, ''] and _nodeData['startTime'] > \
-                            self.G.node[_parse0Id][
-                                'startTime']:
+                    if _nodeData['fromScript'] in ['Null', None, ''] and \
+                            _nodeData['startTime'] > self.G.start_of(_parse0Id):
                         _parseID = self.find_parse_id(_nodeData)
                         if _parseID in ['', None]:
                             _parseID = _parse0Id
-                        a2_startTime, a1_triggered = self.edge_start(self.G.node[_parseID]['endTime'],
-                                                                     self.G.node[_nodeId]['startTime'])
+                        a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_parseID),
+                                                                     self.G.start_of(_nodeId))
                         self.G.add_edge(_parseID, _nodeId,
                                         startTime=a2_startTime,
-                                        endTime=self.G.node[_nodeId]['startTime'])
+                                        endTime=self.G.start_of(_nodeId))
                         self.deps.append({'time': a1_triggered, 'a1': _parseID, 'a2': _nodeId})
                         if a1_triggered == -1:
-                            a1_triggered = self.G.node[_parseID]['endTime']
+                            a1_triggered = self.G.end_of(_parseID)
                         self.deps_parent.setdefault(_nodeId, []).append((_parseID, a1_triggered))
                     elif _nodeData['fromScript'] not in ['Null', None, '']:
 
@@ -1390,17 +1368,17 @@ class Trace():
                         else:
                             _script_nodeId = self.find_url(urldefrag(_nodeData['fromScript'])[0], _nodeData, 'script')
                         # _script_nodeId = self.scripts_lookup_url[urldefrag(_nodeData['fromScript'])[0]]
-                        _script_nodeData = self.scripts_list[int(_script_nodeId.split('_')[1])][1]
+                        _script_nodeData = self.scripts_lookup_id[_script_nodeId]
                         # There is a js before _nodeId
-                        if _script_nodeData['startTime'] < self.G.node[_nodeId]['startTime']:
-                            a2_startTime, a1_triggered = self.edge_start(self.G.node[_script_nodeId]['endTime'],
-                                                                         self.G.node[_nodeId]['startTime'])
+                        if _script_nodeData['startTime'] < self.G.start_of(_nodeId):
+                            a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_script_nodeId),
+                                                                         self.G.start_of(_nodeId))
                             self.G.add_edge(_script_nodeId, _nodeId,
                                             startTime=a2_startTime,
-                                            endTime=self.G.node[_nodeId]['startTime'])
+                                            endTime=self.G.start_of(_nodeId))
                             self.deps.append({'time': a1_triggered, 'a1': _script_nodeId, 'a2': _nodeId})
                             if a1_triggered == -1:
-                                a1_triggered = self.G.node[_script_nodeId]['endTime']
+                                a1_triggered = self.G.end_of(_script_nodeId)
                             self.deps_parent.setdefault(_nodeId, []).append((_script_nodeId, a1_triggered))
 
                 elif _nodeId.startswith('Scripting'):
@@ -1409,31 +1387,31 @@ class Trace():
                         _netowrk_nodeId = self.networks_lookup_url[urldefrag(_nodeData['url'])[0]][0]
                     else:
                         _netowrk_nodeId = self.find_url(urldefrag(_nodeData['url'])[0], _nodeData, 'network')
-                    _netowrk_nodeData = self.networks_list[int(_netowrk_nodeId.split('_')[1])][1]
+                    _netowrk_nodeData = self.networks_lookup_id[_netowrk_nodeId]
 
-                    if _netowrk_nodeData['startTime'] < self.G.node[_nodeId]['startTime']:
-                        a2_startTime, a1_triggered = self.edge_start(self.G.node[_netowrk_nodeId]['endTime'],
-                                                                     self.G.node[_nodeId]['startTime'])
+                    if _netowrk_nodeData['startTime'] < self.G.start_of(_nodeId):
+                        a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_netowrk_nodeId),
+                                                                     self.G.start_of(_nodeId))
                         self.G.add_edge(_netowrk_nodeId, _nodeId,
                                         startTime=a2_startTime,
-                                        endTime=self.G.node[_nodeId]['startTime'])
+                                        endTime=self.G.start_of(_nodeId))
                         self.deps.append({'time': a1_triggered, 'a1': _netowrk_nodeId, 'a2': _nodeId})
                         if a1_triggered == -1:
-                            a1_triggered = self.G.node[_netowrk_nodeId]['endTime']
+                            a1_triggered = self.G.end_of(_netowrk_nodeId)
                         self.deps_parent.setdefault(_nodeId, []).append((_netowrk_nodeId, a1_triggered))
 
                         ### Add css_eval to js_eval dep
-                        _cssEvalIds = self.find_blocking_css(_netowrk_nodeData['endTime'],self.G.node[_nodeId]['endTime'] )
+                        _cssEvalIds = self.find_blocking_css(_netowrk_nodeData['endTime'],self.G.end_of(_nodeId) )
                         for _cssEvalId in _cssEvalIds:
                             if _cssEvalId:
-                                a2_startTime, a1_triggered = self.edge_start(self.G.node[_cssEvalId]['endTime'],
-                                                                             self.G.node[_nodeId]['startTime'])
+                                a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_cssEvalId),
+                                                                             self.G.start_of(_nodeId))
                                 self.G.add_edge(_cssEvalId, _nodeId,
                                             startTime=a2_startTime,
-                                            endTime=self.G.node[_nodeId]['startTime'])
+                                            endTime=self.G.start_of(_nodeId))
                                 self.deps.append({'time': a1_triggered, 'a1': _cssEvalId, 'a2': _nodeId})
                                 if a1_triggered == -1:
-                                    a1_triggered = self.G.node[_cssEvalId]['endTime']
+                                    a1_triggered = self.G.end_of(_cssEvalId)
                                 self.deps_parent.setdefault(_nodeId, []).append((_cssEvalId, a1_triggered))
 
 
@@ -1462,16 +1440,16 @@ class Trace():
                         except Exception as e:
                             print(e)
                             continue
-                        _netowrk_nodeData = self.networks_list[int(_netowrk_nodeId.split('_')[1])][1]
-                        if _netowrk_nodeData['startTime'] < self.G.node[_nodeId]['startTime']:
-                            a2_startTime, a1_triggered = self.edge_start(self.G.node[_netowrk_nodeId]['endTime'],
-                                                                         self.G.node[_nodeId]['startTime'])
+                        _netowrk_nodeData = self.networks_lookup_id[_netowrk_nodeId]
+                        if _netowrk_nodeData['startTime'] < self.G.start_of(_nodeId):
+                            a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_netowrk_nodeId),
+                                                                         self.G.start_of(_nodeId))
                             self.G.add_edge(_netowrk_nodeId, _nodeId,
                                             startTime=a2_startTime,
-                                            endTime=self.G.node[_nodeId]['startTime'])
+                                            endTime=self.G.start_of(_nodeId))
                             self.deps.append({'time': a1_triggered, 'a1': _netowrk_nodeId, 'a2': _nodeId})
                             if a1_triggered == -1:
-                                a1_triggered = self.G.node[_netowrk_nodeId]['endTime']
+                                a1_triggered = self.G.end_of(_netowrk_nodeId)
                             self.deps_parent.setdefault(_nodeId, []).append((_netowrk_nodeId, a1_triggered))
 
                     elif _nodeData['name'] == 'ParseHTML' and _nodeData['fromScript'] in ['Null', None, '']:
@@ -1479,7 +1457,7 @@ class Trace():
                         # We are currently skipping about:blanks which occur before parse_0
                         # Update: no need if a clean start happens in testbed.
                         ###
-                        if _nodeData['startTime'] > self.G.node[_parse0Id]['startTime'] and not _nodeData['url'] == '':
+                        if _nodeData['startTime'] > self.G.start_of(_parse0Id) and not _nodeData['url'] == '':
                             try:
                                 if len(self.networks_lookup_url[urldefrag(_nodeData['url'])[0]]) <= 1:
                                     _netowrk_nodeId = self.networks_lookup_url[urldefrag(_nodeData['url'])[0]][0]
@@ -1487,29 +1465,29 @@ class Trace():
                                     _netowrk_nodeId = self.find_url(urldefrag(_nodeData['url'])[0], _nodeData, 'network')
                             except Exception as e:
                                 continue
-                            _netowrk_nodeData = self.networks_list[int(_netowrk_nodeId.split('_')[1])][1]
-                            a2_startTime, a1_triggered = self.edge_start(self.G.node[_netowrk_nodeId]['endTime'],
-                                                                         self.G.node[_nodeId]['startTime'])
+                            _netowrk_nodeData = self.networks_lookup_id[_netowrk_nodeId]
+                            a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_netowrk_nodeId),
+                                                                         self.G.start_of(_nodeId))
                             self.G.add_edge(_netowrk_nodeId, _nodeId,
                                             startTime=a2_startTime,
-                                            endTime=self.G.node[_nodeId]['startTime'])
+                                            endTime=self.G.start_of(_nodeId))
                             self.deps.append({'time': a1_triggered, 'a1': _netowrk_nodeId, 'a2': _nodeId})
                             if a1_triggered == -1:
-                                a1_triggered = self.G.node[_netowrk_nodeId]['endTime']
+                                a1_triggered = self.G.end_of(_netowrk_nodeId)
                             self.deps_parent.setdefault(_nodeId, []).append((_netowrk_nodeId, a1_triggered))
                             ###
                             # find latest scripting too
                             ###
                             _script_nodeId = self.find_scripting_id(_nodeData)
                             if _script_nodeId is not None:
-                                a2_startTime, a1_triggered = self.edge_start(self.G.node[_script_nodeId]['endTime'],
-                                                                             self.G.node[_nodeId]['startTime'])
+                                a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_script_nodeId),
+                                                                             self.G.start_of(_nodeId))
                                 self.G.add_edge(_script_nodeId, _nodeId,
                                                 startTime=a2_startTime,
-                                                endTime=self.G.node[_nodeId]['startTime'])
+                                                endTime=self.G.start_of(_nodeId))
                                 self.deps.append({'time': a1_triggered, 'a1': _script_nodeId, 'a2': _nodeId})
                                 if a1_triggered == -1:
-                                    a1_triggered = self.G.node[_script_nodeId]['endTime']
+                                    a1_triggered = self.G.end_of(_script_nodeId)
                                 self.deps_parent.setdefault(_nodeId, []).append((_script_nodeId, a1_triggered))
 
                             ###
@@ -1518,14 +1496,14 @@ class Trace():
                             _parseID = self.find_parse_id(_nodeData)
                             if _parseID in ['', None]:
                                 _parseID = _parse0Id
-                            a2_startTime, a1_triggered = self.edge_start(self.G.node[_parseID]['endTime'],
-                                                                         self.G.node[_nodeId]['startTime'])
+                            a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_parseID),
+                                                                         self.G.start_of(_nodeId))
                             self.G.add_edge(_parseID, _nodeId,
                                             startTime=a2_startTime,
-                                            endTime=self.G.node[_nodeId]['startTime'])
+                                            endTime=self.G.start_of(_nodeId))
                             self.deps.append({'time': a1_triggered, 'a1': _parseID, 'a2': _nodeId})
                             if a1_triggered == -1:
-                                a1_triggered = self.G.node[_parseID]['endTime']
+                                a1_triggered = self.G.end_of(_parseID)
                             self.deps_parent.setdefault(_nodeId, []).append((_parseID, a1_triggered))
 
                         else:
@@ -1539,17 +1517,17 @@ class Trace():
                             _script_nodeId = self.scripts_lookup_url[urldefrag(_nodeData['fromScript'])[0]][0]
                         else:
                             _script_nodeId = self.find_url(urldefrag(_nodeData['fromScript'])[0], _nodeData, 'script')
-                        _script_nodeData = self.scripts_list[int(_script_nodeId.split('_')[1])][1]
+                        _script_nodeData = self.scripts_lookup_id[_script_nodeId]
                         # There is a js before _nodeId
-                        if _script_nodeData['startTime'] < self.G.node[_nodeId]['startTime']:
-                            a2_startTime, a1_triggered = self.edge_start(self.G.node[_script_nodeId]['endTime'],
-                                                                         self.G.node[_nodeId]['startTime'])
+                        if _script_nodeData['startTime'] < self.G.start_of(_nodeId):
+                            a2_startTime, a1_triggered = self.edge_start(self.G.end_of(_script_nodeId),
+                                                                         self.G.start_of(_nodeId))
                             self.G.add_edge(_script_nodeId, _nodeId,
                                             startTime=a2_startTime,
-                                            endTime=self.G.node[_nodeId]['startTime'])
+                                            endTime=self.G.start_of(_nodeId))
                             self.deps.append({'time': a1_triggered, 'a1': _script_nodeId, 'a2': _nodeId})
                             if a1_triggered == -1:
-                                a1_triggered = self.G.node[_script_nodeId]['endTime']
+                                a1_triggered = self.G.end_of(_script_nodeId)
                             self.deps_parent.setdefault(_nodeId, []).append((_script_nodeId, a1_triggered))
         self.deps_modified = copy.deepcopy(self.deps)
         return True
@@ -1652,32 +1630,6 @@ class Trace():
         elif mode == 'lib':
             return self.output
 
-    def update_nodeData(self, _nodeId, _delta, _function):
-        self.all_modified_dict[_nodeId]['startTime'] -= _delta
-        self.all_modified_dict[_nodeId]['endTime'] -= _delta
-        self.all_modified_dict[_nodeId]['endTime'] = _function(_nodeId)
-
-    def _compression(self, _nodeId):
-        _startTime = self.all_modified_dict[_nodeId]['startTime']
-        _endTime = self.all_modified_dict[_nodeId]['endTime']
-        if _nodeId.startswith('Networking') and _nodeId not in self.mark:
-            _mimeType = self.all_modified_dict[_nodeId]['mimeType']
-            #_compressable = self.javascript_type_list + self.css_type_list + self.text_type_list
-            _compressable = self.javascript_type_list
-            if _mimeType in _compressable:
-                return _startTime + ((_endTime - _startTime) / 15.7)
-        return _endTime
-
-    def _caching(self, _nodeId):
-        _startTime = self.all_modified_dict[_nodeId]['startTime']
-        _endTime = self.all_modified_dict[_nodeId]['endTime']
-        if _nodeId.startswith('Networking') and _nodeId not in self.mark:
-            _mimeType = self.all_modified_dict[_nodeId]['mimeType']
-            if _mimeType.startswith('image'):
-                print(_nodeId)
-                return _startTime + 2
-        return _endTime
-
     def isAd(self, _url):
         if _url is  None or 'testbed01' in _url:
             return False
@@ -1771,50 +1723,14 @@ class Trace():
         elif mode == 'lib':
             return self.output
 
-    def update_nodeData(self, _nodeId, _delta, _function):
-        self.all_modified_dict[_nodeId]['startTime'] -= _delta
-        self.all_modified_dict[_nodeId]['endTime'] -= _delta
-        self.all_modified_dict[_nodeId]['endTime'] = _function(_nodeId)
-
-    def _compression(self, _nodeId):
-        _startTime = self.all_modified_dict[_nodeId]['startTime']
-        _endTime = self.all_modified_dict[_nodeId]['endTime']
-        if _nodeId.startswith('Networking') and _nodeId not in self.mark:
-            _mimeType = self.all_modified_dict[_nodeId]['mimeType']
-            #_compressable = self.javascript_type_list + self.css_type_list + self.text_type_list
-            _compressable = self.javascript_type_list
-            if _mimeType in _compressable:
-                return _startTime + ((_endTime - _startTime) / 15.7)
-        return _endTime
-
-    def _caching(self, _nodeId):
-        _startTime = self.all_modified_dict[_nodeId]['startTime']
-        _endTime = self.all_modified_dict[_nodeId]['endTime']
-        if _nodeId.startswith('Networking') and _nodeId not in self.mark:
-            _mimeType = self.all_modified_dict[_nodeId]['mimeType']
-            if _mimeType.startswith('image'):
-                print(_nodeId)
-                return _startTime + 2
-        return _endTime
-
-
-    def shift_time(self, _nodeId, _function):
-        if _nodeId not in self.deps_parent:  # Orphans
-            self.all_modified_dict[_nodeId]['endTime'] = _function(_nodeId)
-            self.mark[_nodeId] = True
-            return
-        for _parentId in self.deps_parent[_nodeId]:
-            if _parentId[0] not in self.mark:
-                self.shift_time(_parentId[0], _function)
-        _maxEndTime = float('-inf')
-        for _parentId in self.deps_parent[_nodeId]:
-            _endTime = _function(_parentId[0])
-            #print(_parentId[0], _endTime, self.all_dict[_parentId[0]]['endTime'] )
-            if _endTime > _maxEndTime:
-                _maxEndTime = _endTime
-                _delta = self.all_dict[_parentId[0]]['endTime'] - _endTime
-        self.update_nodeData(_nodeId, _delta, _function)
-        self.mark[_nodeId] = True
+    def what_if(self, scenarios):
+        """
+        :param scenarios: what_if.Scenario list, e.g. [what_if.compress(), what_if.scale_rtt(0.5)]
+        :return: what_if.WhatIfResult per scenario
+        """
+        if self.what_if_engine is None:
+            self.what_if_engine = WhatIfEngine(self)
+        return self.what_if_engine.evaluate(scenarios)
 
     def shift_deps(self):
         self.deps_parent_mod = {}
@@ -1855,19 +1771,7 @@ class Trace():
         if not self.dependency():
             return False, False, False
         self.order_layout()
-        #self.adjust_time_compressed()
-        ###
-        # Do the same untill all are marked
-        #keep track of marked
-        ###
-        _nodeId_list = [x[0] for x in self.all_modified]
-        _nodeId_list.reverse()
-        """ Fix the issue with new css_blocking dep
-        for _nodeId in _nodeId_list:
-            if _nodeId not in self.mark:
-                #self.shift_time(_nodeId, self._compression)
-                self.shift_time(_nodeId, self._compression)"""
-        #self.shift_deps()
+        # what-if scenarios (compression, caching, rtt): self.what_if([...]) once analyzed
         download_0, parse_0 = self.find_download0()
         self.find_critical_path(self.last_activity[0][0])  # , download_0[0])
         #self.find_critical_path_mod(self.last_activity[0][0])  # , download_0[0])
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3.5
+"""
+Streaming reader for Chrome trace files.
+
+Trace.Process() and Trace.Process_Loading_Render_Painting_Network() used to
+read the whole file into one string, json.loads it, json.loads every element a
+second time, and each kept its own decoded copy of the trace. iter_trace_events
+reads the file a chunk at a time and decodes one event at a time, so only the
+events somebody keeps stay in memory. Accepted layouts, plain or .gz:
+ - [ "{...event...}", ... ]     what chrome_launcher.js writes (events as json strings)
+ - [ {...event...}, ... ]       DevTools "Save profile"
+ - {"traceEvents": [ ... ], ...}
+
+TimestampMerger collects the events of one category: Chrome writes every thread
+in (nearly) timestamp order, so each thread is a sorted run, and the runs are
+merged with a heap instead of sorting the whole list.
+
+    merger = TimestampMerger()
+    for trace_event in iter_trace_events('0_www.example.com.trace.gz'):
+        merger.add(trace_event)
+    events = merger.merge()
+"""
+import gzip
+import heapq
+import json as _json
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+CHUNK_SIZE = 1024 * 1024
+_WHITESPACE = ' \t\n\r'
+
+
+class TraceFormatError(ValueError):
+    pass
+
+
+def open_trace(trace):
+    if trace.lower().endswith('.gz'):
+        return gzip.open(trace, 'rt', encoding='utf-8')
+    return open(trace, 'r', encoding='utf-8')
+
+
+class _Scanner(object):
+    """
+    A text file decoded one json value at a time, reading more only when a value is cut by the end of the buffer
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = _json.JSONDecoder()
+
+    def _fill(self):
+        # with the consumed part of the buffer dropped
+        if self.eof:
+            return False
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        :return: next character that is not whitespace, '' at the end of the file
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars or not c:
+            raise TraceFormatError('expected one of %r, found %r' % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                #  cut by the end of the buffer, or broken
+                if not self._fill():
+                    raise TraceFormatError('truncated or invalid trace at offset %d' % self.pos)
+                continue
+            if end == len(self.buf) and not self.eof and isinstance(value, (int, float)):
+                #  a number may go on in the next chunk
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def _array(scanner):
+    """
+    Elements of the array the scanner is at, strings decoded as json
+    """
+    scanner.expect('[')
+    if scanner.peek() == ']':
+        scanner.pos += 1
+        return
+    while True:
+        element = scanner.value()
+        if isinstance(element, str):
+            element = json.loads(element)
+        yield element
+        if scanner.expect(',]') == ']':
+            return
+
+
+def iter_trace_events(trace, chunk_size=CHUNK_SIZE):
+    """
+    :param trace: path of a trace file, .gz for a gzipped one
+    :return: iterator over the decoded events, in file order
+    """
+    with open_trace(trace) as f:
+        scanner = _Scanner(f, chunk_size)
+        first = scanner.peek()
+        if first == '[':
+            for trace_event in _array(scanner):
+                yield trace_event
+        elif first == '{':
+            scanner.pos += 1
+            while scanner.peek() != '}':
+                key = scanner.value()
+                scanner.expect(':')
+                if key == 'traceEvents':
+                    for trace_event in _array(scanner):
+                        yield trace_event
+                else:
+                    scanner.value()  # metadata, skipped
+                if scanner.expect(',}') == '}':
+                    break
+        elif first:
+            raise TraceFormatError('not a trace file: starts with %r' % first)
+
+
+class TimestampMerger(object):
+    """
+    Events of one category, sorted by 'ts', ties kept in file order like list.sort
+    """
+
+    def __init__(self):
+        self._runs = {}  # (pid, tid) -> [(ts, seq, event)]
+        self._sorted = {}  # (pid, tid) -> run still in ts order
+        self._seq = 0
+
+    def add(self, trace_event):
+        thread = (trace_event.get('pid'), trace_event.get('tid'))
+        item = (trace_event['ts'], self._seq, trace_event)
+        self._seq += 1
+        run = self._runs.get(thread)
+        if run is None:
+            self._runs[thread] = [item]
+            self._sorted[thread] = True
+            return
+        if item[0] < run[-1][0]:
+            self._sorted[thread] = False
+        run.append(item)
+
+    def __len__(self):
+        return self._seq
+
+    def merge(self):
+        """
+        :return: list of the events by timestamp, the merger is emptied
+        """
+        runs = []
+        for thread, run in self._runs.items():
+            if not self._sorted[thread]:
+                #  nearly sorted: timsort does this in about one pass
+                run.sort(key=lambda item: item[:2])
+            runs.append(run)
+        self._runs = {}
+        self._sorted = {}
+        self._seq = 0
+        if len(runs) == 1:
+            return [item[2] for item in runs[0]]
+        #  (ts, seq) never ties, the events themselves are never compared
+        return [item[2] for item in heapq.merge(*runs, key=lambda item: item[:2])]
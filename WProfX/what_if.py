@@ -0,0 +1,280 @@
+#!/usr/bin/env python3.5
+"""
+What-if analysis over the dependency graph of an analyzed Trace.
+
+The what-if code trace_parser had (shift_time with _compression / _caching) was
+recursive, re-timed the whole page, and handled one optimization per run.
+WhatIfEngine takes the activities and deps_parent of a Trace once, and
+ - orders the activities topologically (Kahn's algorithm, no recursion)
+ - keeps, for each activity, its parent on the critical path (find_cp_max_end)
+ - for every scenario, changes the durations the scenario picks and re-times
+   only the activities downstream of those, in topological order. An activity
+   starts as long after the last of its parents' triggers as it did in the
+   trace, and a trigger inside its parent moves with the parent's new duration
+   (as shift_deps does)
+With no change every activity keeps its times, so the critical path of the
+baseline is the one of Trace.find_critical_path.
+
+    engine = WhatIfEngine(trace)  # after trace.analyze()
+    for result in engine.evaluate([compress(), cache(domain='doubleclick.net'), scale_rtt(0.5)]):
+        print(result.name, result.load, result.saving)
+"""
+import heapq
+import logging
+import time
+from collections import namedtuple
+
+import tldextract
+
+WhatIfResult = namedtuple('WhatIfResult', ['name', 'load', 'saving', 'changed', 'retimed', 'critical_path',
+                                           'seconds'])
+
+
+class Scenario(object):
+    def __init__(self, name, change):
+        """
+        :param change: callable (activity id, activity data) -> new duration in ms, None to leave it
+        """
+        self.name = name
+        self.change = change
+
+    def __repr__(self):
+        return 'Scenario(%r)' % self.name
+
+
+def _is_network(_nodeId):
+    return _nodeId.startswith('Networking')
+
+
+def compress(ratio=15.7, mime_types=None, url=None):
+    """
+    Downloads of compressible resources take 1/ratio of the time
+    :param mime_types: compressible types, default the javascript types of Trace
+    :param url: only the resources whose url contains it
+    """
+    if mime_types is None:
+        mime_types = ['application/x-javascript', 'application/javascript', 'application/ecmascript',
+                      'text/javascript', 'text/ecmascript', 'application/json', 'javascript/text']
+    mime_types = frozenset(mime_types)
+
+    def change(_nodeId, _nodeData):
+        if _is_network(_nodeId) and _nodeData.get('mimeType') in mime_types and \
+                (url is None or url in (_nodeData.get('url') or '')):
+            return (_nodeData['endTime'] - _nodeData['startTime']) / ratio
+
+    return Scenario('compress %s' % (url or 'all'), change)
+
+
+def cache(domain=None, mime_prefix=None, duration=2):
+    """
+    Downloads served from the cache in duration ms
+    :param domain: registered domain (example.com) whose resources are cached
+    :param mime_prefix: resources whose mimeType starts with it are cached, e.g. 'image'
+    """
+    _domains = {}
+
+    def registered_domain(_url):
+        if _url not in _domains:
+            s = tldextract.extract(_url)
+            _domains[_url] = s.domain + '.' + s.suffix
+        return _domains[_url]
+
+    def change(_nodeId, _nodeData):
+        if not _is_network(_nodeId):
+            return None
+        if domain is not None and registered_domain(_nodeData.get('url') or '') != domain:
+            return None
+        if mime_prefix is not None and not (_nodeData.get('mimeType') or '').startswith(mime_prefix):
+            return None
+        return min(duration, _nodeData['endTime'] - _nodeData['startTime'])
+
+    return Scenario('cache %s' % (domain or mime_prefix or 'all'), change)
+
+
+def scale_rtt(factor=0.5):
+    """
+    The request part of every download (startTime to responseReceivedTime) scaled by factor
+    """
+    def change(_nodeId, _nodeData):
+        if not _is_network(_nodeId):
+            return None
+        _startTime = _nodeData['startTime']
+        _endTime = _nodeData['endTime']
+        _response = _nodeData.get('responseReceivedTime')
+        if _response is None or not _startTime <= _response <= _endTime:
+            return None
+        return (_endTime - _startTime) - (_response - _startTime) * (1 - factor)
+
+    return Scenario('rtt x%s' % factor, change)
+
+
+class WhatIfEngine(object):
+    def __init__(self, trace):
+        """
+        :param trace: trace_parser.Trace, analyzed
+        """
+        self.data = dict((_id, _data) for _id, _data in trace.all_dict.items()
+                         if _id.startswith('Networking') or _id.startswith('Loading') or _id.startswith('Scripting'))
+        self.start = dict((_id, _data['startTime']) for _id, _data in self.data.items())
+        self.end = dict((_id, _data['endTime']) for _id, _data in self.data.items())
+        self.parents = dict((_id, [(_pId, _trigger) for _pId, _trigger in _parents if _pId in self.data])
+                            for _id, _parents in trace.deps_parent.items() if _id in self.data)
+        self.last_trigger = dict((_id, max(_trigger for _, _trigger in _parents))
+                                 for _id, _parents in self.parents.items() if _parents)
+        self.children = {}
+        for _id, _parents in self.parents.items():
+            for _pId, _ in _parents:
+                _children = self.children.setdefault(_pId, [])
+                if not _children or _children[-1] != _id:
+                    _children.append(_id)
+        self.order = self.topological_order()
+        self.position = dict((_id, i) for i, _id in enumerate(self.order))
+        # baseline memo: critical parent of every activity, activities by end
+        self.critical_parent = dict((_id, self.max_trigger_parent(_id)) for _id in self.parents)
+        self.by_end = sorted(self.order, key=lambda _id: (-self.end[_id], self.position[_id]))
+        self.load = self.end[self.by_end[0]] if self.by_end else 0
+
+    def topological_order(self):
+        """
+        :return: activity ids, parents first, ties by startTime
+        """
+        indegree = dict((_id, 0) for _id in self.data)
+        for _id, _parents in self.parents.items():
+            indegree[_id] = len(set(_pId for _pId, _ in _parents))
+        ready = [(self.start[_id], _id) for _id, degree in indegree.items() if degree == 0]
+        heapq.heapify(ready)
+        by_start = sorted((self.start[_id], _id) for _id in indegree)
+        next_start = 0
+        order = []
+        done = set()
+        while len(order) < len(indegree):
+            if not ready:
+                # a cycle: broken at its earliest activity, whose parents inside it keep their times
+                while by_start[next_start][1] in done:
+                    next_start += 1
+                _id = by_start[next_start][1]
+                logging.warning('Dependency cycle broken at ' + _id)
+                indegree[_id] = 0
+                ready.append((self.start[_id], _id))
+            _, _id = heapq.heappop(ready)
+            if _id in done:
+                continue
+            order.append(_id)
+            done.add(_id)
+            for _child in self.children.get(_id, []):
+                indegree[_child] -= 1
+                if indegree[_child] == 0:
+                    heapq.heappush(ready, (self.start[_child], _child))
+        return order
+
+    def max_trigger_parent(self, _nodeId, triggers=None):
+        # find_cp_max_end: the parent triggering last, the first one on ties
+        _max = -10
+        _max_id = None
+        for i, (_pId, _trigger) in enumerate(self.parents.get(_nodeId, [])):
+            if triggers is not None:
+                _trigger = triggers[i]
+            if _trigger > _max:
+                _max = _trigger
+                _max_id = _pId
+        return _max_id
+
+    def new_trigger(self, _pId, _trigger, times):
+        # trigger time in the parent, moved with its new times
+        if _pId not in times:
+            return _trigger
+        _startTime, _endTime = self.start[_pId], self.end[_pId]
+        _newStart, _newEnd = times[_pId]
+        if _trigger >= _endTime:
+            return _newEnd + (_trigger - _endTime)
+        if _endTime > _startTime:
+            return _newStart + (_trigger - _startTime) * (_newEnd - _newStart) / (_endTime - _startTime)
+        return _newStart + (_trigger - _startTime)
+
+    def retime(self, scenario):
+        """
+        :return: ({id: new duration} of the activities the scenario changes,
+                  {id: (startTime, endTime)} of the activities that moved)
+        """
+        durations = {}
+        for _id in self.order:
+            _duration = scenario.change(_id, self.data[_id])
+            if _duration is not None and _duration != self.end[_id] - self.start[_id]:
+                durations[_id] = max(0, _duration)
+        times = {}
+        # downstream of the changed activities in topological order, the children of an activity that
+        # did not move are left alone
+        pending = [(self.position[_id], _id) for _id in durations]
+        heapq.heapify(pending)
+        queued = set(durations)
+        while pending:
+            _, _id = heapq.heappop(pending)
+            _startTime = self.start[_id]
+            if self.parents.get(_id):
+                # the gap is kept after the last trigger only, as shift_time used to shift by the max-end parent:
+                # a parent that did not move must not hold the activity at its old start
+                _last = max(self.new_trigger(_pId, _trigger, times) for _pId, _trigger in self.parents[_id])
+                if _last != self.last_trigger[_id]:
+                    _startTime = _last + (self.start[_id] - self.last_trigger[_id])
+            _endTime = _startTime + durations.get(_id, self.end[_id] - self.start[_id])
+            if _startTime == self.start[_id] and _endTime == self.end[_id]:
+                continue
+            times[_id] = (_startTime, _endTime)
+            for _child in self.children.get(_id, []):
+                if _child not in queued:
+                    queued.add(_child)
+                    heapq.heappush(pending, (self.position[_child], _child))
+        return durations, times
+
+    def end_of(self, _id, times):
+        return times[_id][1] if _id in times else self.end[_id]
+
+    def last_activity(self, times):
+        # the activity ending last, the first in topological order on ties
+        candidates = list(times)
+        for _id in self.by_end:
+            if _id not in times:
+                candidates.append(_id)
+                break
+        if not candidates:
+            return None
+        return min(candidates, key=lambda _id: (-self.end_of(_id, times), self.position[_id]))
+
+    def critical_path(self, times=None, source=None):
+        """
+        :param times: re-timed activities, from retime(); None for the trace as recorded
+        :param source: last activity, default the one ending last
+        :return: critical path, first activity first
+        """
+        times = times or {}
+        _nodeId = source or self.last_activity(times)
+        path = []
+        seen = set()
+        while _nodeId is not None and _nodeId not in seen:
+            path.append(_nodeId)
+            seen.add(_nodeId)
+            _parents = self.parents.get(_nodeId)
+            if not _parents:
+                break
+            if not any(_pId in times for _pId, _ in _parents):
+                _nodeId = self.critical_parent[_nodeId]
+            else:
+                _nodeId = self.max_trigger_parent(_nodeId, [self.new_trigger(_pId, _trigger, times)
+                                                            for _pId, _trigger in _parents])
+        path.reverse()
+        return path
+
+    def evaluate(self, scenarios):
+        """
+        :param scenarios: Scenario list
+        :return: WhatIfResult per scenario, load and saving in ms
+        """
+        results = []
+        for scenario in scenarios:
+            start = time.time()
+            durations, times = self.retime(scenario)
+            _last = self.last_activity(times)
+            _load = self.end_of(_last, times) if _last is not None else 0
+            results.append(WhatIfResult(scenario.name, round(_load, 3), round(self.load - _load, 3), len(durations),
+                                        len(times), self.critical_path(times, _last), round(time.time() - start, 6)))
+        return results
@@ -1,13 +1,20 @@
 """
-This script rotates all images passing through the proxy by 180 degrees.
+This script caches the html, js and images passing through the proxy and
+optimizes the images for the requesting client (see tools/imageopt.py).
 """
-import io
-
-# from PIL import Image
-from PIL import Image
 from mitmproxy import http
 import time
 from colorama import init, Fore, Back
+from tools.imageopt import ImageOptimizer
+from tools.workerpool import FlowWorkerPool
+from tools.cachewriter import CacheWriter
+
+init() # Color Print from colorama
+optimizer = ImageOptimizer()
+#  response() runs here instead of on the proxy master thread
+pool = FlowWorkerPool(workers=8, max_pending=32, timeout=10)
+#  intercepted bodies, written in the background; cache.get(url) reads them back
+cache = CacheWriter("Cache", quota_bytes=512 * 1024 * 1024)
 
 
 """
@@ -22,6 +29,7 @@ def response(flow: http.HTTPFlow) -> None:
 """
 
 
+@pool.concurrent
 def response(flow: http.HTTPFlow) -> None:
     # TODO wanna find out the host and create cache accordingly
     # print(flow.request.headers)
@@ -29,7 +37,6 @@ def response(flow: http.HTTPFlow) -> None:
     """
     Find the html and js files for minification purpose
     """
-    init() # Color Print from colorama
     if flow.response.headers.get("content-type", "").startswith("text/html"):
         htmlfile = flow.response.content
         htmlfileName = flow.request.headers.get("Host", "")
@@ -38,7 +45,8 @@ def response(flow: http.HTTPFlow) -> None:
         print(flow.request.headers.get("user-agent", ""))
         print(Fore.WHITE + Back.BLACK + "HTML Files Intercepted!")
         print(Fore.GREEN + "Host is " + htmlfileName)
-        open("Cache/{}{}.html".format(htmlfileName, time.time()), "wb").write(htmlfile)
+        with pool.stage("html_save"):
+            cache.put(flow.request.url, htmlfile, flow.response.headers.get("content-type", ""))
         # TODO Using the Minification System
 
     if flow.response.headers.get("content-type", "").startswith("text/javascript"):
@@ -48,7 +56,8 @@ def response(flow: http.HTTPFlow) -> None:
             jsfileName = flow.request.headers.get(":authority", "")
         print(Fore.WHITE + Back.BLACK + "JavaScript Files Intercepted!")
         print(Fore.GREEN + "Host is" + jsfileName)
-        open("Cache/{}{}.js".format(jsfileName, time.time()), "wb").write(jsfile)
+        with pool.stage("js_save"):
+            cache.put(flow.request.url, jsfile, flow.response.headers.get("content-type", ""))
         # TODO Using the Minification System
 
     """
@@ -66,35 +75,57 @@ def response(flow: http.HTTPFlow) -> None:
         if img_format == "image/jpeg":
             # TODO Do something about the jpeg, for now, just save it as cache
             img_save(imgname, flow, img_format="jpeg")
-            img_rotate(flow, img_format="JPEG", content_type="image/jpeg")
+            img_optimize(flow)
 
         elif img_format == "image/png":
             # TODO Do Something about the png, for now just save it as cache
             img_save(imgname, flow, img_format="png")
-            img_rotate(flow, img_format="PNG", content_type="image/png")
+            img_optimize(flow)
         elif img_format == "image/jpg":
             img_save(imgname, flow, img_format="jpg")
-            img_rotate(flow, img_format="JPG", content_type="image/jpg")
+            img_optimize(flow)
 
         elif img_format == "image/gif":
             img_save(imgname,flow, img_format="gif")
-            img_rotate(flow, img_format="GIF", content_type="image/gif")
 
     # TODO Monitoring the User, include but not limited to screen resolution, conncetion speed
+def done():
+    print(pool.report())
+    pool.shutdown(wait=False)
+    optimizer.close()
+    cache.close()
+
+
 def img_save(img_name, flow, img_format):
-    try:
-        img = Image.open(io.BytesIO(flow.response.content))
-        img.save("Cache/" + img_name +"{}.{}".format(time.time(), img_format),
-                 img_format)
+    with pool.stage("img_save"):
+        _img_save(img_name, flow, img_format)
 
-        print(Fore.WHITE + Back.BLACK + "Image Packet Intercepted, format:%s" %img_format)
-        print(Fore.WHITE + Back.BLACK + "Host is" + img_name)
-    except Exception as e:
-        print(Fore.BLUE + Back.WHITE + e)
-def img_rotate(flow, img_format, content_type):
-    s = io.BytesIO(flow.response.content)
-    img = Image.open(s).rotate(180)
-    s2 = io.BytesIO()
-    img.save(s2, img_format)
-    flow.response.content = s2.getvalue()
-    flow.response.headers["content-type"] = content_type
\ No newline at end of file
+
+def _img_save(img_name, flow, img_format):
+    #  the original bytes, before img_optimize rewrites them
+    cache.put(flow.request.url, flow.response.content, "image/%s" % img_format)
+    print(Fore.WHITE + Back.BLACK + "Image Packet Intercepted, format:%s" %img_format)
+    print(Fore.WHITE + Back.BLACK + "Host is" + img_name)
+def img_optimize(flow):
+    """
+    Downscale, recompress and maybe convert the image for the client that asked for it
+    """
+    original = flow.response.content
+    content_type = flow.response.headers.get("content-type", "")
+    with pool.stage("img_optimize"):
+        data, new_type = optimizer.optimize(original, content_type, flow.request.headers, timeout=pool.timeout)
+    if data is original:
+        return
+    with pool.changes() as live:
+        if not live:
+            #  timed out, the flow already went to the client as it was
+            return
+        flow.response.content = data
+        flow.response.headers["content-type"] = new_type
+        #  the result depends on what the client accepts and on its screen
+        vary = [v.strip() for v in flow.response.headers.get("Vary", "").split(",") if v.strip()]
+        for header in ("Accept", "User-Agent"):
+            if header not in vary:
+                vary.append(header)
+        flow.response.headers["Vary"] = ", ".join(vary)
+    print(Fore.GREEN + "Image optimized %d -> %d bytes, %s" % (len(original), len(data), new_type))
@@ -0,0 +1,241 @@
+"""
+Asynchronous cache of the bodies intercepted by the proxy.
+
+pagemodifier used to open("Cache/{host}{time}.html", "wb").write(...) right in
+the response hook: blocking disk I/O on the hot path, one new file per response
+named by timestamp, the same jQuery stored a thousand times and nothing ever
+deleted or read back.
+
+CacheWriter.put() only queues the body. A background thread
+ - stores each distinct body once, named by its sha256, in a sharded tree
+   (Cache/ab/cd/abcd...) so no directory grows huge
+ - writes a batch of files, then fsyncs them and their directories together
+ - keeps the url -> body index in sqlite (Cache/index.db)
+ - evicts the least recently used bodies once the cache is over quota
+
+get(url) returns a cached (body, content type) so it can be served back.
+
+    cache = CacheWriter("Cache", quota_bytes=512 * 1024 * 1024)
+    cache.put(flow.request.url, flow.response.content, flow.response.headers.get("content-type", ""))
+    hit = cache.get(flow.request.url)
+"""
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class CacheWriter(object):
+    def __init__(self, root="Cache", quota_bytes=512 * 1024 * 1024, batch_size=64, batch_interval=0.5,
+                 max_queue=1024, fsync=True):
+        """
+        :param root: cache directory
+        :param quota_bytes: total size of the stored bodies, least recently used ones are evicted past it
+        :param batch_size: bodies written per batch at most
+        :param batch_interval: seconds the writer waits to fill a batch
+        :param max_queue: bodies waiting to be written, put() drops (and counts) what does not fit
+        :param fsync: fsync every batch, False trades durability for speed
+        """
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+        self._queue = queue.Queue(max_queue)
+        self._pending = {}  # url -> (body, content type), queued but not written yet
+        self._touched = {}  # digest -> last access, applied to the index with the next batch
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "index.db"), check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS bodies "
+                             "(digest TEXT PRIMARY KEY, size INTEGER, content_type TEXT, atime REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS bodies_atime ON bodies (atime)")
+            self._db.commit()
+            self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+        self.stats = {"queued": 0, "dropped": 0, "written": 0, "deduplicated": 0, "evicted": 0,
+                      "batches": 0, "hits": 0, "misses": 0}
+        self._thread = threading.Thread(target=self._loop, name="CacheWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _count(self, field, n=1):
+        with self._lock:
+            self.stats[field] += n
+
+    #  hot path
+    def put(self, url, body, content_type=""):
+        """
+        Queue body for writing, never blocks
+        :return: False if the queue was full and the body dropped
+        """
+        with self._lock:
+            self._pending[url] = (body, content_type)
+        try:
+            self._queue.put_nowait((url, body, content_type))
+        except queue.Full:
+            with self._lock:
+                if self._pending.get(url, (None,))[0] is body:
+                    del self._pending[url]
+            self._count("dropped")
+            return False
+        self._count("queued")
+        return True
+
+    def get(self, url):
+        """
+        :return: (body, content type) cached for url, None on a miss
+        """
+        with self._lock:
+            if url in self._pending:
+                self.stats["hits"] += 1
+                return self._pending[url]
+            row = self._db.execute("SELECT b.digest, b.content_type FROM urls u JOIN bodies b ON u.digest = b.digest "
+                                   "WHERE u.url = ?", (url,)).fetchone()
+        if row is not None:
+            try:
+                with open(self.path(row[0]), "rb") as f:
+                    body = f.read()
+            except IOError:
+                row = None
+        if row is None:
+            self._count("misses")
+            return None
+        with self._lock:
+            self._touched[row[0]] = time.time()
+            self.stats["hits"] += 1
+        return body, row[1]
+
+    #  writer thread
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch([item for item in batch if item is not None])
+            except Exception as e:
+                print("CacheWriter: batch of %d failed: %r" % (len(batch), e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if None in batch:
+                return
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        now = time.time()
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        rows, urls, written, dirs = [], [], [], set()
+        committed = False
+        try:
+            with self._lock:
+                known = set(digest for digest, in self._db.execute(
+                    "SELECT digest FROM bodies WHERE digest IN (%s)" % ",".join("?" * len(batch)),
+                    [hashlib.sha256(body).hexdigest() for _, body, _ in batch]))
+            for url, body, content_type in batch:
+                digest = hashlib.sha256(body).hexdigest()
+                urls.append((url, digest))
+                if digest in known:
+                    touched[digest] = now
+                    self._count("deduplicated")
+                    continue
+                known.add(digest)
+                path = self.path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = path + ".tmp"
+                f = open(tmp, "wb")
+                written.append((f, tmp, path))
+                f.write(body)
+                dirs.add(os.path.dirname(path))
+                rows.append((digest, len(body), content_type, now))
+            #  one round of fsyncs for the whole batch
+            for f, tmp, path in written:
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+                f.close()
+                os.replace(tmp, path)
+            if self.fsync and hasattr(os, "O_DIRECTORY"):
+                for d in dirs:
+                    fd = os.open(d, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            with self._lock:
+                self._db.executemany("INSERT OR REPLACE INTO bodies (digest, size, content_type, atime) "
+                                     "VALUES (?, ?, ?, ?)", rows)
+                self._db.executemany("INSERT OR REPLACE INTO urls (url, digest) VALUES (?, ?)", urls)
+                self._db.executemany("UPDATE bodies SET atime = ? WHERE digest = ?",
+                                     [(atime, digest) for digest, atime in touched.items()])
+                self._db.commit()
+                committed = True
+                self._bytes += sum(row[1] for row in rows)
+                self.stats["written"] += len(rows)
+                self.stats["batches"] += 1
+        finally:
+            #  a failed batch leaves no open handle and no file the index does not know about,
+            #  and its bodies are not served from _pending forever
+            for f, tmp, path in written:
+                if not f.closed:
+                    f.close()
+                for leftover in (tmp,) if committed else (tmp, path):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+            with self._lock:
+                if not committed:
+                    self._db.rollback()
+                    for digest, atime in touched.items():
+                        self._touched.setdefault(digest, atime)
+                for url, body, _ in batch:
+                    if self._pending.get(url, (None,))[0] is body:
+                        del self._pending[url]
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            if self._bytes <= self.quota_bytes:
+                return
+            victims = []
+            excess = self._bytes - self.quota_bytes
+            for digest, size in self._db.execute("SELECT digest, size FROM bodies ORDER BY atime"):
+                if excess <= 0:
+                    break
+                victims.append(digest)
+                excess -= size
+                self._bytes -= size
+            self._db.executemany("DELETE FROM bodies WHERE digest = ?", [(d,) for d in victims])
+            self._db.executemany("DELETE FROM urls WHERE digest = ?", [(d,) for d in victims])
+            self._db.commit()
+            self.stats["evicted"] += len(victims)
+        for digest in victims:
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    def flush(self):
+        """
+        Block until everything queued so far is on disk
+        """
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        with self._lock:
+            self._db.close()
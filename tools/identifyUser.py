@@ -1,5 +1,32 @@
-from ua_parser import user_agent_parser
 import pprint
+import re
+
+try:
+    from ua_parser import user_agent_parser
+except ImportError:
+    user_agent_parser = None
+
+re_mobile = re.compile(r'Mobi|iPhone|iPod|Android.*Mobile|Windows Phone|BlackBerry|Opera Mini', re.I)
+re_tablet = re.compile(r'iPad|Tablet|Android(?!.*Mobile)|Kindle|Silk', re.I)
+
+
+def device_class(user_agent):
+    """
+    :return: 'mobile', 'tablet' or 'desktop', from ua_parser when installed and the User-Agent words otherwise
+    """
+    if not user_agent:
+        return 'desktop'
+    if user_agent_parser is not None:
+        device = user_agent_parser.Parse(user_agent)['device']['family'] or ''
+        if device == 'iPad' or 'Tablet' in device or 'Kindle' in device:
+            return 'tablet'
+    if re_tablet.search(user_agent):
+        return 'tablet'
+    if re_mobile.search(user_agent):
+        return 'mobile'
+    return 'desktop'
+
+
 class IdentifyDevice(object):
 
     @staticmethod
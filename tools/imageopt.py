@@ -0,0 +1,217 @@
+"""
+Image optimization for the images passing through the proxy.
+
+Every image is
+ - downscaled to the viewport of the client (Viewport-Width / Width / DPR client
+   hints when the browser sends them, otherwise guessed from the User-Agent)
+ - recompressed to a target quality
+ - converted to WebP when the client accepts it (Accept: image/webp)
+
+The work runs in a process pool and the result is cached by (content hash,
+variant), so an image seen before costs a dictionary lookup. Images that would
+not get smaller are passed through untouched.
+
+    optimizer = ImageOptimizer()
+    data, content_type = optimizer.optimize(flow.response.content,
+                                            flow.response.headers.get("content-type", ""),
+                                            flow.request.headers)
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, Future
+
+from PIL import Image, ImageOps
+
+from tools.identifyUser import device_class
+
+#  a variant is everything the output depends on besides the input bytes
+Variant = namedtuple("Variant", ["format", "quality", "max_width"])
+
+#  PIL format name -> content type
+CONTENT_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+SOURCE_FORMATS = {
+    "image/jpeg": "JPEG",
+    "image/jpg": "JPEG",
+    "image/pjpeg": "JPEG",
+    "image/png": "PNG",
+}
+
+#  css pixels of the widest viewport of a device class, None keeps the size
+DEVICE_WIDTHS = {
+    "mobile": 414,
+    "tablet": 1024,
+    "desktop": None,
+}
+
+
+def viewport_width(headers):
+    """
+    :param headers: request headers
+    :return: width in device pixels the image never needs to exceed, None if unknown
+    """
+    try:
+        dpr = float(headers.get("DPR") or headers.get("Sec-CH-DPR") or 1)
+    except ValueError:
+        dpr = 1.0
+    for name in ("Width", "Sec-CH-Width"):
+        #  Width is already in device pixels
+        if headers.get(name, "").isdigit():
+            return int(headers[name])
+    for name in ("Viewport-Width", "Sec-CH-Viewport-Width"):
+        if headers.get(name, "").isdigit():
+            return int(int(headers[name]) * dpr)
+    width = DEVICE_WIDTHS[device_class(headers.get("User-Agent", ""))]
+    if width is None:
+        return None
+    #  no DPR hint: assume a high density screen, as most phones have
+    return int(width * (dpr if "DPR" in headers or "Sec-CH-DPR" in headers else 2))
+
+
+def webp_supported():
+    #  Image.SAVE is filled as the plugins are imported, Image.init() imports them all
+    Image.init()
+    return "WEBP" in Image.SAVE
+
+
+def choose_variant(content_type, headers, quality=75):
+    """
+    :return: Variant to produce for a client sending headers, None if the image is left alone
+    """
+    source = SOURCE_FORMATS.get(content_type.split(";")[0].strip().lower())
+    if source is None:
+        #  gif (possibly animated), svg, webp already, ...
+        return None
+    target = source
+    if "image/webp" in headers.get("Accept", "") and webp_supported():
+        target = "WEBP"
+    return Variant(target, quality, viewport_width(headers))
+
+
+def transcode(data, variant):
+    """
+    Runs in a worker process
+    :return: (bytes, content type), None if the result is not smaller than data
+    """
+    img = Image.open(io.BytesIO(data))
+    #  the output has no EXIF orientation tag to rotate it back, nor the profile unless passed on
+    icc_profile = img.info.get("icc_profile")
+    img = ImageOps.exif_transpose(img)
+    if variant.max_width and img.width > variant.max_width:
+        height = max(1, int(img.height * variant.max_width / float(img.width)))
+        img = img.resize((variant.max_width, height), Image.LANCZOS)
+    options = {}
+    if variant.format == "JPEG":
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        options = {"quality": variant.quality, "optimize": True, "progressive": True}
+    elif variant.format == "PNG":
+        options = {"optimize": True}
+    elif variant.format == "WEBP":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+        options = {"quality": variant.quality, "method": 4}
+    if icc_profile:
+        options["icc_profile"] = icc_profile
+    out = io.BytesIO()
+    img.save(out, variant.format, **options)
+    result = out.getvalue()
+    if len(result) >= len(data):
+        return None
+    return result, CONTENT_TYPES[variant.format]
+
+
+class ImageOptimizer(object):
+    def __init__(self, workers=None, cache_entries=1024, min_bytes=1024, quality=75):
+        """
+        :param workers: worker processes, defaults to the number of cpus
+        :param cache_entries: results kept, least recently used are dropped first
+        :param min_bytes: smaller images are not worth a round trip to the pool
+        :param quality: jpeg/webp quality
+        """
+        self.workers = workers
+        self.cache_entries = cache_entries
+        self.min_bytes = min_bytes
+        self.quality = quality
+        self._pool = None
+        self._cache = OrderedDict()  # (sha256, variant) -> (bytes, content type), None keeps the original
+        self._pending = {}  # (sha256, variant) -> Future, identical images in flight share it
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "skipped": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def pool(self):
+        #  started on first use, not when mitmproxy loads the script
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def submit(self, data, content_type, headers):
+        """
+        :return: Future of (bytes, content type)
+        """
+        variant = choose_variant(content_type, headers, self.quality)
+        if variant is None or len(data) < self.min_bytes:
+            future = Future()
+            future.set_result((data, content_type))
+            with self._lock:
+                self.stats["skipped"] += 1
+            return future
+        key = (hashlib.sha256(data).hexdigest(), variant)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                future = Future()
+                future.set_result(self._cache[key] or (data, content_type))
+                return future
+            if key in self._pending:
+                self.stats["hits"] += 1
+                return self._pending[key]
+            self.stats["misses"] += 1
+            future = self._pending[key] = Future()
+        try:
+            work = self.pool().submit(transcode, data, variant)
+        except Exception as e:
+            self._pending.pop(key, None)
+            future.set_exception(e)
+            return future
+        work.add_done_callback(lambda w: self._done(key, data, content_type, w, future))
+        return future
+
+    def _done(self, key, data, content_type, work, future):
+        error = work.exception()
+        result = None if error is not None else work.result()
+        with self._lock:
+            self._pending.pop(key, None)
+            if error is not None:
+                self.stats["errors"] += 1
+            else:
+                self.stats["bytes_in"] += len(data)
+                self.stats["bytes_out"] += len(result[0]) if result else len(data)
+                #  None is cached too: the image is already as small as it gets
+                self._cache[key] = result
+                while len(self._cache) > self.cache_entries:
+                    self._cache.popitem(last=False)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result or (data, content_type))
+
+    def optimize(self, data, content_type, headers, timeout=None):
+        """
+        :return: (bytes, content type), the original when transcoding fails
+        """
+        try:
+            return self.submit(data, content_type, headers).result(timeout=timeout)
+        except Exception:
+            return data, content_type
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
@@ -0,0 +1,226 @@
+"""
+Bounded worker pool for mitmproxy addon hooks.
+
+A hook runs on the proxy master thread, which serves every other flow as well,
+so a slow response() (image decoding, disk writes) stalls the whole proxy.
+FlowWorkerPool.concurrent works like mitmproxy's @concurrent: the flow's reply is
+taken, the hook runs on a worker thread and the reply is committed when it is
+done. Unlike @concurrent, which starts a new thread per flow,
+
+ - at most workers hooks run at once, and at most max_pending more wait in the
+   queue; past that the master thread blocks (backpressure) instead of piling
+   up threads and memory
+ - a flow whose hook has not finished timeout seconds after it started is
+   released as it is, so one pathological image can not hold a client forever;
+   the hook writes the flow inside pool.changes(), which tells it the flow is
+   already gone
+ - the time spent queued, in every stage (with pool.stage("name")) and in total
+   is recorded in latency histograms, see report()
+
+    pool = FlowWorkerPool(workers=8, max_pending=32, timeout=10)
+
+    @pool.concurrent
+    def response(flow):
+        with pool.stage("image"):
+            data = ...
+        with pool.changes() as live:
+            if live:
+                flow.response.content = data
+"""
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+#  upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is the overflow bucket
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+            self.total += ms
+            self.count += 1
+            self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """
+        :return: upper bound (ms) of the bucket holding the p-th percentile, None without samples
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = p / 100.0 * self.count
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= rank:
+                    return self.buckets[i] if i < len(self.buckets) else self.max
+            return self.max
+
+    def snapshot(self):
+        with self._lock:
+            count, total, peak = self.count, self.total, self.max
+        return {
+            "count": count,
+            "mean_ms": total / count if count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99),
+            "max_ms": peak,
+        }
+
+
+class FlowWorkerPool(object):
+    def __init__(self, workers=8, max_pending=32, timeout=30.0):
+        """
+        :param workers: hooks running at the same time
+        :param max_pending: hooks waiting for a worker before the master thread blocks
+        :param timeout: seconds after which a flow is released even if its hook still runs, None waits forever
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._histograms = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.counts = {"flows": 0, "timeouts": 0, "errors": 0, "blocked": 0}
+
+    def histogram(self, name):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = LatencyHistogram()
+            return self._histograms[name]
+
+    def _count(self, field):
+        with self._lock:
+            self.counts[field] += 1
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the time spent in the with block under name
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.histogram(name).record(time.time() - start)
+
+    def concurrent(self, fn):
+        """
+        Decorator for a hook taking a flow (request, response, error, ...)
+        """
+        def _concurrent(flow):
+            if not self._slots.acquire(False):
+                #  every worker busy and the queue full: make the master thread wait
+                self._count("blocked")
+                with self.stage("backpressure"):
+                    self._slots.acquire()
+            self._count("flows")
+            flow.reply.take()
+            self._executor.submit(self._run, fn, flow, _Release(flow), time.time())
+        _concurrent.__name__ = fn.__name__
+        _concurrent.__doc__ = fn.__doc__
+        return _concurrent
+
+    def _run(self, fn, flow, done, queued):
+        started = time.time()
+        self.histogram("queue").record(started - queued)
+        #  the timeout counts the hook's own time, not the time it waited for a worker
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self._expire, (done, fn.__name__))
+            timer.daemon = True
+            timer.start()
+        self._local.done = done
+        try:
+            fn(flow)
+        except Exception:
+            self._count("errors")
+            logger.exception("%s failed for %s", fn.__name__, getattr(flow.request, "url", flow))
+        finally:
+            self._local.done = None
+            if timer is not None:
+                timer.cancel()
+            self.histogram(fn.__name__).record(time.time() - started)
+            self.histogram("total").record(time.time() - queued)
+            done()
+            self._slots.release()
+
+    def _expire(self, done, name):
+        if done():
+            self._count("timeouts")
+            logger.warning("%s timed out after %ss, flow released unfinished", name, self.timeout)
+
+    @contextmanager
+    def changes(self):
+        """
+        Hold off the timeout while the hook writes its flow
+        :return: (as the with target) False when the flow was already released and must be left alone
+        """
+        done = getattr(self._local, "done", None)
+        if done is None:
+            #  not on a worker of this pool
+            yield True
+            return
+        with done.lock:
+            yield not done.released
+
+    def report(self):
+        """
+        :return: text table of every histogram
+        """
+        lines = ["%-14s %7s %9s %9s %9s %9s %9s" % ("stage", "count", "mean ms", "p50", "p90", "p99", "max")]
+        with self._lock:
+            names = sorted(self._histograms)
+            counts = dict(self.counts)
+        for name in names:
+            s = self.histogram(name).snapshot()
+            lines.append("%-14s %7d %9.1f %9s %9s %9s %9.1f" % (
+                name, s["count"], s["mean_ms"], s["p50_ms"], s["p90_ms"], s["p99_ms"], s["max_ms"]))
+        lines.append(", ".join("%s: %d" % item for item in sorted(counts.items())))
+        return "\n".join(lines)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class _Release(object):
+    """
+    Commits the reply of a taken flow exactly once, from the worker or from the timeout timer
+    :return: True for the call that released the flow
+    """
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.lock = threading.Lock()
+        self.released = False
+
+    def __call__(self):
+        with self.lock:
+            if self.released:
+                return False
+            self.released = True
+        reply = self.flow.reply
+        if reply.state == "taken":
+            if not reply.has_message:
+                reply.ack()
+            reply.commit()
+        return True